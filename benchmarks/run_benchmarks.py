@@ -0,0 +1,280 @@
+"""
+Benchmark suite of the pipeline stages on synthetic data.
+Every function of include/transform.py, the extraction from a local S3 stand-in (moto) and the loader into a local
+SQLite stand-in are timed and their peak memory sampled. Results are saved as JSON, and compared with the
+thresholds of benchmarks/thresholds.yaml to a baseline result file of the same scale.
+
+    python -m benchmarks.run_benchmarks --rows 1M --output benchmarks/results/1M.json
+    python -m benchmarks.run_benchmarks --rows 1M --baseline benchmarks/results/1M.json
+
+It exits with status 1 when a benchmark regressed, so it can gate a change.
+"""
+import argparse
+import ctypes
+import ctypes.util
+import gc
+import inspect
+import json
+import logging
+import os
+import platform
+import sys
+import tempfile
+import time
+import warnings
+from datetime import datetime, timezone
+
+import pandas as pd
+import pyarrow as pa
+import yaml
+
+from benchmarks.synthetic_data import products_rows, synthetic_products, write_products_json, write_sales_csv
+from include import transform
+from include.instrumentation import PeakRss
+from include.intermediate_storage import write_frame
+from include.validation.validation_policy import configure_validation
+
+# Transform functions in pipeline order: the frames they read and the frame their result is kept as.
+TRANSFORM_STAGES = [
+    ("sales_data_transformation", ["raw_sales"], "sales"),
+    ("products_data_transformation", ["raw_products"], "products"),
+    ("merging_sales_data_with_products_data", ["sales", "products"], "merged"),
+    ("merged_data_enriched", ["merged"], "enriched"),
+    ("quarterly_sales_by_category", ["enriched"], None),
+    ("sales_revenue_by_region", ["enriched"], None),
+    ("sales_seasonality", ["enriched"], None),
+    ("weekly_order_counts_by_status", ["enriched"], None),
+    ("average_sales_and_units_by_sales_bucket", ["enriched"], None),
+    ("partial_aggregates", ["enriched"], None),
+    ("presentation_aggregates", ["enriched"], None),
+]
+
+SCALE_SUFFIXES = {"k": 1_000, "m": 1_000_000}
+
+# RSS sampling interval of the benchmarks, shorter than the pipeline one for the short stages.
+RSS_SAMPLE_SECONDS = 0.002
+
+
+def parse_rows(rows: str) -> int:
+    """Scales like 10k, 1M or 50M."""
+    suffix = rows[-1].lower()
+    return int(float(rows[:-1]) * SCALE_SUFFIXES[suffix]) if suffix in SCALE_SUFFIXES else int(rows)
+
+
+def _release_free_memory():
+    """
+    Gives the memory freed by earlier benchmarks back to the OS (glibc only), so the RSS growth of a benchmark
+    measures its own allocations instead of reusing the freed pages of the previous one.
+    """
+    gc.collect()
+    libc_name = ctypes.util.find_library("c")
+    if libc_name and hasattr(ctypes.CDLL(libc_name), "malloc_trim"):
+        ctypes.CDLL(libc_name).malloc_trim(0)
+
+
+def measured(function, rows: int, repeat: int = 1, setup=lambda: ()):
+    """
+    Runs the function repeat times on fresh arguments from setup, and keeps the fastest time and the smallest
+    peak memory growth. It returns the last result and the measures.
+    """
+    seconds, peak_memory = [], []
+    for _ in range(repeat):
+        arguments = setup()
+        _release_free_memory()
+        with PeakRss(RSS_SAMPLE_SECONDS) as rss:
+            started = time.perf_counter()
+            result = function(*arguments)
+            seconds.append(time.perf_counter() - started)
+        peak_memory.append(rss.growth)
+    return result, {
+        "rows": rows,
+        "seconds": round(min(seconds), 4),
+        "rows_per_second": round(rows / max(min(seconds), 1e-9)),
+        "peak_memory_mb": round(min(peak_memory) / 2 ** 20, 1),
+    }
+
+
+def transform_benchmarks(frames: dict, memory_lean: bool, repeat: int) -> dict:
+    """Times every transform function on copies of its input frames, the inputs are copied outside the timing."""
+    results = {}
+    for name, inputs, output in TRANSFORM_STAGES:
+        function = getattr(transform, name)
+        kwargs = {"memory_lean": memory_lean} if "memory_lean" in inspect.signature(function).parameters else {}
+        result, results[f"transform.{name}"] = measured(
+            lambda *dfs: function(*dfs, **kwargs), rows=len(frames[inputs[0]].index), repeat=repeat,
+            setup=lambda: [frames[frame].copy() for frame in inputs])
+        if output:
+            frames[output] = result
+    return results
+
+
+def extract_benchmark(directory: str, rows: int, products: pd.DataFrame, chunk_rows, repeat: int) -> dict:
+    """Extracts the synthetic files from a moto S3 bucket into a local intermediate storage."""
+    import boto3
+    import moto
+
+    from include.extract_s3_data import extract_to_storage
+
+    sales_path, products_path = f"{directory}/sales.csv", f"{directory}/products.json"
+    write_sales_csv(sales_path, rows, len(products.index))
+    write_products_json(products_path, products)
+    storage_config = {"backend": "local", "path": f"{directory}/storage", "format": "parquet", "compression": "zstd"}
+
+    os.environ.update({"AWS_ACCESS_KEY_ID": "benchmark", "AWS_SECRET_ACCESS_KEY": "benchmark",
+                       "AWS_DEFAULT_REGION": "us-east-1"})
+    with moto.mock_aws():
+        client = boto3.client("s3", region_name="us-east-1")
+        client.create_bucket(Bucket="benchmark")
+        client.upload_file(sales_path, "benchmark", "raw/sales.csv")
+        client.upload_file(products_path, "benchmark", "raw/products.json")
+        _, measures = measured(
+            lambda: extract_to_storage("benchmark", "raw", aws_conn_id=None, storage_config=storage_config,
+                                       key_prefix="run", chunksize=chunk_rows),
+            rows=rows + len(products.index), repeat=repeat)
+    return {"extract.extract_to_storage": measures}
+
+
+def load_benchmarks(directory: str, enriched_df: pd.DataFrame, bulk_load_min_rows: int, max_rows_per_file: int,
+                    repeat: int) -> dict:
+    """
+    Frames of bulk_load_min_rows rows or more are staged as Parquet files and copied by Snowflake, only the Parquet
+    files are written locally. Smaller frames are inserted, into a SQLite stand-in of Snowflake, replaced and then
+    upserted, with the first bulk_load_min_rows rows of the enriched frame.
+    """
+    import sqlalchemy
+
+    from include.load import load_targets, write_parquet_files
+
+    results = {}
+    _, results["load.write_parquet_files"] = measured(
+        lambda: write_parquet_files(enriched_df, tempfile.mkdtemp(dir=directory), max_rows_per_file),
+        rows=len(enriched_df.index), repeat=repeat)
+
+    storage_config = {"backend": "local", "path": f"{directory}/storage", "format": "parquet", "compression": "zstd"}
+    reference = write_frame(enriched_df.head(bulk_load_min_rows - 1), "run/enriched", storage_config)
+    engine = sqlalchemy.create_engine(f"sqlite:///{directory}/warehouse.db")
+    for load_mode in ("replace", "upsert"):
+        target = {"reference": reference, "schema": "main", "table": "enriched_data", "load_mode": load_mode,
+                  "merge_keys": ["sales_id"]}
+        _, results[f"load.load_targets.{load_mode}"] = measured(
+            lambda: load_targets([target], engine, max_workers=1, bulk_load_min_rows=sys.maxsize),
+            rows=reference["rows"], repeat=repeat)
+    engine.dispose()
+    return results
+
+
+def run_benchmarks(rows: int, memory_lean: bool = False, stages=("transform", "extract", "load"), repeat: int = 1,
+                   chunk_rows=None, bulk_load_min_rows: int = 100_000, max_rows_per_file: int = 1_000_000) -> dict:
+    """Runs the benchmarks of the selected stages at a scale and returns the results, in the saved format."""
+    products = synthetic_products(products_rows(rows))
+    frames = {"raw_products": products}
+    results = {}
+    with tempfile.TemporaryDirectory(prefix="etl_benchmarks_") as directory:
+        if "transform" in stages or "load" in stages:
+            sales_path = f"{directory}/sales.csv"
+            write_sales_csv(sales_path, rows, len(products.index))
+            frames["raw_sales"] = pd.read_csv(sales_path)
+            os.remove(sales_path)
+            transform_results = transform_benchmarks(frames, memory_lean, repeat)
+            if "transform" in stages:
+                results.update(transform_results)
+        if "extract" in stages:
+            results.update(extract_benchmark(directory, rows, products, chunk_rows, repeat))
+        if "load" in stages:
+            results.update(load_benchmarks(directory, frames["enriched"], bulk_load_min_rows, max_rows_per_file,
+                                           repeat))
+
+    return {
+        "rows": rows,
+        "memory_lean": memory_lean,
+        "created": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "environment": {"python": platform.python_version(), "pandas": pd.__version__, "pyarrow": pa.__version__,
+                        "cpus": os.cpu_count(), "machine": platform.machine()},
+        "benchmarks": results,
+    }
+
+
+def regressions(results: dict, baseline: dict, thresholds: dict) -> list:
+    """
+    Benchmarks slower or hungrier than the baseline beyond the thresholds, as messages.
+    Benchmarks faster than min_seconds or using less than min_memory_mb are too noisy to be compared.
+    """
+    if (results["rows"], results["memory_lean"]) != (baseline["rows"], baseline["memory_lean"]):
+        raise ValueError(f"Baseline of {baseline['rows']} rows (memory_lean: {baseline['memory_lean']}) "
+                         f"can't be compared to results of {results['rows']} rows")
+    messages = []
+    for name, measures in results["benchmarks"].items():
+        if name not in baseline["benchmarks"]:
+            continue
+        expected = baseline["benchmarks"][name]
+        limits = {**thresholds["default"], **thresholds.get("benchmarks", {}).get(name, {})}
+
+        if max(measures["seconds"], expected["seconds"]) >= limits["min_seconds"]:
+            minimum_throughput = expected["rows_per_second"] * (1 - limits["max_throughput_drop"])
+            if measures["rows_per_second"] < minimum_throughput:
+                messages.append(f"{name}: {measures['rows_per_second']} rows/s, "
+                                f"baseline {expected['rows_per_second']} rows/s")
+        if max(measures["peak_memory_mb"], expected["peak_memory_mb"]) >= limits["min_memory_mb"]:
+            maximum_memory = expected["peak_memory_mb"] * (1 + limits["max_peak_memory_growth"])
+            if measures["peak_memory_mb"] > maximum_memory:
+                messages.append(f"{name}: {measures['peak_memory_mb']} MB peak memory, "
+                                f"baseline {expected['peak_memory_mb']} MB")
+    return messages
+
+
+def report(results: dict, baseline=None) -> str:
+    lines = [f"{'benchmark':<58}{'seconds':>10}{'rows/s':>14}{'peak MB':>10}{'baseline rows/s':>18}"]
+    for name, measures in results["benchmarks"].items():
+        expected = (baseline or {}).get("benchmarks", {}).get(name, {}).get("rows_per_second", "")
+        lines.append(f"{name:<58}{measures['seconds']:>10}{measures['rows_per_second']:>14}"
+                     f"{measures['peak_memory_mb']:>10}{expected:>18}")
+    return "\n".join(lines)
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmarks the pipeline stages on synthetic data.")
+    parser.add_argument("--rows", default="100k", help="Sales rows, like 10k, 1M or 50M.")
+    parser.add_argument("--stages", nargs="+", default=["transform", "extract", "load"],
+                        choices=["transform", "extract", "load"])
+    parser.add_argument("--repeat", type=int, default=1, help="Runs per benchmark, the best one is kept.")
+    parser.add_argument("--config", default="include/config.yaml",
+                        help="Pipeline configuration, for the memory-lean mode and the validation policy.")
+    parser.add_argument("--output", help="JSON file the results are saved to.")
+    parser.add_argument("--baseline", help="JSON results to compare with, at the same scale.")
+    parser.add_argument("--thresholds", default=os.path.join(os.path.dirname(__file__), "thresholds.yaml"))
+    args = parser.parse_args(argv)
+
+    # The pipeline logs, like the entry validation failures of the dirty synthetic rows, are left out of the measures.
+    logging.disable(logging.ERROR)
+    warnings.simplefilter("ignore")
+    with open(args.config) as config_file:
+        config = yaml.safe_load(config_file)
+    configure_validation(config["validation"])
+
+    results = run_benchmarks(parse_rows(args.rows), memory_lean=config["transform"]["memory_lean"],
+                             stages=args.stages, repeat=args.repeat, chunk_rows=config["s3"]["stream_chunk_rows"],
+                             bulk_load_min_rows=config["snowflake"]["bulk_load_min_rows"],
+                             max_rows_per_file=config["snowflake"]["max_rows_per_file"])
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+    print(report(results, baseline))
+
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, "w") as output_file:
+            json.dump(results, output_file, indent=2)
+    if baseline is None:
+        return 0
+
+    with open(args.thresholds) as thresholds_file:
+        thresholds = yaml.safe_load(thresholds_file)
+    messages = regressions(results, baseline, thresholds)
+    for message in messages:
+        print(f"REGRESSION {message}")
+    return 1 if messages else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,397 @@
+"""
+Local end-to-end run of the etl_pipeline DAG. Every task runs in-process, in dependency order, with the XCom values
+of its upstream tasks, against a moto S3 bucket, a local intermediate storage and a SQLite stand-in of Snowflake
+with one attached database per target schema. The inputs are synthetic files at a scale, or the files of a local
+folder, like a sample of the production bucket, uploaded to the bucket as they are.
+
+    python -m benchmarks.run_pipeline --rows 1M --output local_runs/1M
+    python -m benchmarks.run_pipeline --input-folder samples/2024-06 --output local_runs/june --profile
+
+Every task is timed and its peak RSS sampled. With --profile, every task also runs under cProfile, its pool threads
+included, and tracemalloc, and a hotspot and allocation report is written per task to the profile folder, next to
+the .prof file of the task for pstats or snakeviz. Profiled tasks run several times slower.
+Run it from the project folder, the DAG file reads include/config.yaml.
+"""
+import argparse
+import contextlib
+import cProfile
+import graphlib
+import importlib.util
+import io
+import json
+import logging
+import os
+import pstats
+import re
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import types
+from datetime import datetime, timezone
+from unittest import mock
+
+from benchmarks.run_benchmarks import RSS_SAMPLE_SECONDS, parse_rows
+from benchmarks.synthetic_data import products_rows, synthetic_products, write_products_json, write_sales_csv
+from include.instrumentation import PeakRss
+
+logger = logging.getLogger(__name__)
+
+DAG_FILE = "dags/etl_dag.py"
+
+# Frames of the traceback of every traced allocation, deep enough to reach the pipeline code from pandas.
+TRACEBACK_FRAMES = 16
+
+# Project folders whose lines the allocations are attributed to, besides the line allocating the memory.
+PROJECT_FOLDERS = [os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), folder) + os.sep
+                   for folder in ("include", "dags")]
+
+
+# Threads waiting for each other or sleeping, their time is summed over the threads and isn't spent working.
+WAIT_FUNCTIONS = {"<method 'acquire' of '_thread.lock' objects>", "<method 'acquire' of '_thread.RLock' objects>",
+                  "<built-in method time.sleep>"}
+
+
+def load_dag_module(dag_file: str = DAG_FILE) -> types.ModuleType:
+    """A fresh module of the DAG file, so its config can be changed before the DAG is built again."""
+    spec = importlib.util.spec_from_file_location("etl_dag_local_run", dag_file)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def use_local_stand_ins(module: types.ModuleType, folder: str, bucket: str, bucket_folder: str,
+                        stage_cache: bool) -> None:
+    """
+    Points the config of the DAG module to the local stand-ins. Every frame is inserted, COPY INTO only runs on
+    Snowflake, one table at a time, SQLite has a single writer. The stage cache is off unless asked for, so every
+    task runs and is measured.
+    """
+    config = module.config
+    config["aws_conn_id"] = None
+    config["s3"].update({"bucket": bucket, "folder": bucket_folder})
+    config["intermediate_storage"].update({"backend": "local", "path": os.path.join(folder, "storage")})
+    config["stage_cache"]["enabled"] = stage_cache
+    config["snowflake"].update({"bulk_load_min_rows": sys.maxsize, "max_workers": 1})
+    module.storage_config.update({**config["intermediate_storage"], "bucket": bucket, "aws_conn_id": None})
+
+
+def warehouse_engine(folder: str, schemas: list):
+    """SQLite stand-in of Snowflake, every schema of the targets attached as its own database file."""
+    import sqlalchemy
+
+    engine = sqlalchemy.create_engine(f"sqlite:///{os.path.join(folder, 'warehouse.db')}")
+
+    @sqlalchemy.event.listens_for(engine, "connect")
+    def attach_schemas(dbapi_connection, _):
+        for schema in schemas:
+            dbapi_connection.execute(f"ATTACH DATABASE ? AS \"{schema}\"", (os.path.join(folder, f"{schema}.db"),))
+
+    return engine
+
+
+def synthetic_inputs(folder: str, rows: int) -> str:
+    """Writes the synthetic sales CSV and products JSON files of a scale to the folder."""
+    os.makedirs(folder, exist_ok=True)
+    products = synthetic_products(products_rows(rows))
+    write_sales_csv(os.path.join(folder, "sales.csv"), rows, len(products.index))
+    write_products_json(os.path.join(folder, "products.json"), products)
+    return folder
+
+
+def upload_inputs(client, bucket: str, bucket_folder: str, input_folder: str) -> list:
+    """Uploads every file of the input folder under the bucket folder, keeping their relative paths."""
+    keys = []
+    for directory, _, files in os.walk(input_folder):
+        for file in sorted(files):
+            path = os.path.join(directory, file)
+            keys.append(f"{bucket_folder}/{os.path.relpath(path, input_folder).replace(os.sep, '/')}")
+            client.upload_file(path, bucket, keys[-1])
+    logger.info(f"Uploaded {len(keys)} input files to s3://{bucket}/{bucket_folder}")
+    return keys
+
+
+def resolved(value, results: dict):
+    """The value with its XCom arguments replaced by the results of their tasks, in lists and dicts too."""
+    from airflow.sdk.definitions.xcom_arg import PlainXComArg, XComArg
+
+    if isinstance(value, PlainXComArg):
+        result = results[value.operator.task_id]
+        return result if value.key == "return_value" else result[value.key]
+    if isinstance(value, XComArg):
+        raise ValueError(f"{type(value).__name__} arguments are not supported by the local runner")
+    if isinstance(value, dict):
+        return {key: resolved(item, results) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return type(value)(resolved(item, results) for item in value)
+    return value
+
+
+def task_calls(task, results: dict) -> list:
+    """
+    The map index and arguments of every call of the task: one call, or one per element of its expanded
+    arguments for a mapped task, whose result is then the list of the results of its calls.
+    """
+    if not hasattr(task, "op_kwargs_expand_input"):
+        return [(-1, resolved(task.op_args, results), resolved(task.op_kwargs, results))]
+    partial_kwargs = resolved(task.partial_kwargs.get("op_kwargs", {}), results)
+    expanded = resolved(task.op_kwargs_expand_input.value, results)
+    lengths = {len(values) for values in expanded.values()}
+    if len(lengths) != 1:
+        raise ValueError(f"The expanded arguments of {task.task_id} have different lengths: {sorted(lengths)}")
+    return [(map_index, [], {**partial_kwargs, **{name: values[map_index] for name, values in expanded.items()}})
+            for map_index in range(lengths.pop())]
+
+
+class TaskProfiler:
+    """
+    Profiles a task call with cProfile, in the calling thread and in the threads it starts, and traces its
+    allocations with tracemalloc. The allocations are snapshotted whenever the traced memory grows past the
+    last snapshot, so the report shows the memory held at the peak, not the little left when the task returns.
+    """
+
+    def __init__(self, min_growth: float = 0.1, sample_seconds: float = 0.01):
+        self.min_growth = min_growth
+        self.sample_seconds = sample_seconds
+
+    def _profile_thread(self, *_):
+        # Installed by threading.setprofile: the first event of a new thread starts its own profile. Daemon
+        # threads, like the RSS samplers of the instrumentation, are left out, the pool threads are not daemons.
+        sys.setprofile(None)
+        if threading.current_thread().daemon:
+            return
+        profile = cProfile.Profile()
+        self.thread_profiles.append(profile)
+        profile.enable()
+
+    def _sample(self):
+        while self.running:
+            current, _ = tracemalloc.get_traced_memory()
+            if current > self.snapshot_bytes * (1 + self.min_growth):
+                self.snapshot, self.snapshot_bytes = tracemalloc.take_snapshot(), current
+            time.sleep(self.sample_seconds)
+
+    def __enter__(self):
+        self.thread_profiles, self.snapshot, self.snapshot_bytes = [], None, 0
+        tracemalloc.start(TRACEBACK_FRAMES)
+        self.running = True
+        self.sampler = threading.Thread(target=self._sample, daemon=True)
+        self.sampler.start()
+        threading.setprofile(self._profile_thread)
+        self.profile = cProfile.Profile()
+        self.profile.enable()
+        return self
+
+    def __exit__(self, *exc):
+        self.profile.disable()
+        threading.setprofile(None)
+        self.running = False
+        self.sampler.join()
+        _, self.peak_bytes = tracemalloc.get_traced_memory()
+        self.snapshot = self.snapshot or tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        for profile in self.thread_profiles:
+            profile.disable()
+
+    def stats(self) -> pstats.Stats:
+        stats = pstats.Stats(self.profile)
+        for profile in self.thread_profiles:
+            stats.add(profile)
+        return stats
+
+    def snapshot_statistics(self) -> list:
+        return self.snapshot.filter_traces([tracemalloc.Filter(False, tracemalloc.__file__),
+                                            tracemalloc.Filter(False, __file__)]).statistics("traceback")
+
+
+def hotspots(stats: pstats.Stats, top: int) -> list:
+    """The functions of the most own time, with their calls and cumulative time, besides the waits."""
+    rows = []
+    for (file, line, function), (_, calls, own_seconds, cumulative_seconds, _) in stats.stats.items():
+        if function in WAIT_FUNCTIONS:
+            continue
+        rows.append({"function": f"{file}:{line}({function})", "calls": calls,
+                     "own_seconds": round(own_seconds, 4), "cumulative_seconds": round(cumulative_seconds, 4)})
+    return sorted(rows, key=lambda row: row["own_seconds"], reverse=True)[:top]
+
+
+def allocations(statistics: list, top: int) -> dict:
+    """
+    Memory held at the peak by allocating line, and by the innermost line of the pipeline code leading to the
+    allocation, the line to change when the allocating one is in pandas or pyarrow.
+    """
+    by_line, by_project_line = {}, {}
+    for statistic in statistics:
+        frames = list(reversed(statistic.traceback))
+        line = f"{frames[0].filename}:{frames[0].lineno}"
+        project_line = next((f"{frame.filename}:{frame.lineno}" for frame in frames
+                             if any(frame.filename.startswith(folder) for folder in PROJECT_FOLDERS)), None)
+        for grouped, key in ((by_line, line), (by_project_line, project_line)):
+            if key is not None:
+                grouped[key] = [grouped.get(key, [0, 0])[0] + statistic.size,
+                                grouped.get(key, [0, 0])[1] + statistic.count]
+
+    def largest(grouped):
+        return [{"line": key, "mb": round(size / 2 ** 20, 2), "blocks": count}
+                for key, (size, count) in sorted(grouped.items(), key=lambda item: item[1][0], reverse=True)[:top]]
+    return {"by_line": largest(by_line), "by_pipeline_line": largest(by_project_line)}
+
+
+def write_profile_report(profiler: TaskProfiler, name: str, folder: str, top: int) -> dict:
+    """Writes the .prof file and the text report of a profiled task call, and returns its summary."""
+    os.makedirs(folder, exist_ok=True)
+    file_name = re.sub(r"[^\w.-]", "_", name)
+    stats = profiler.stats()
+    stats.dump_stats(os.path.join(folder, f"{file_name}.prof"))
+    summary = {"peak_traced_mb": round(profiler.peak_bytes / 2 ** 20, 1), "hotspots": hotspots(stats, top),
+               "allocations": allocations(profiler.snapshot_statistics(), top)}
+
+    stats.stream = cumulative = io.StringIO()
+    stats.sort_stats("cumulative").print_stats(top)
+    lines = [f"{name}: {summary['peak_traced_mb']} MB peak traced memory", "",
+             f"{'own s':>10}{'cumul. s':>10}{'calls':>10}  function"]
+    lines += [f"{row['own_seconds']:>10}{row['cumulative_seconds']:>10}{row['calls']:>10}  {row['function']}"
+              for row in summary["hotspots"]]
+    for title, key in (("Memory held at the peak, by pipeline line", "by_pipeline_line"),
+                       ("Memory held at the peak, by allocating line", "by_line")):
+        lines += ["", f"{title}", f"{'MB':>10}{'blocks':>10}  line"]
+        lines += [f"{row['mb']:>10}{row['blocks']:>10}  {row['line']}" for row in summary["allocations"][key]]
+    lines += ["", "By cumulative time", cumulative.getvalue()]
+    with open(os.path.join(folder, f"{file_name}.txt"), "w") as report_file:
+        report_file.write("\n".join(lines))
+    return summary
+
+
+def task_context(dag, run_id: str, logical_date: datetime, params: dict) -> dict:
+    """The part of the Airflow task context the DAG reads, its task instance set for every task call."""
+    return {"run_id": run_id, "logical_date": logical_date, "params": {**dict(dag.params), **params},
+            "dag_run": types.SimpleNamespace(run_id=run_id, run_after=logical_date),
+            "ti": types.SimpleNamespace(task_id=None, map_index=-1, try_number=1)}
+
+
+def run_tasks(dag, context: dict, profile_folder: str = None, top: int = 25) -> list:
+    """
+    Runs every task of the DAG in dependency order and returns a record per task call, with its state, time and
+    peak RSS growth, and its profile summary in profile mode. A task is skipped when it raises
+    AirflowSkipException or an upstream task didn't succeed, like with the all_success trigger rule. A mapped task
+    is skipped when every call is, the results of its other calls are passed to the downstream tasks.
+    An exception of a task stops the run.
+    """
+    from airflow.exceptions import AirflowSkipException
+
+    results, states, records = {}, {}, []
+    graph = {task_id: task.upstream_task_ids for task_id, task in dag.task_dict.items()}
+    for task_id in graphlib.TopologicalSorter(graph).static_order():
+        task = dag.task_dict[task_id]
+        if any(states[upstream_id] != "success" for upstream_id in task.upstream_task_ids):
+            states[task_id] = "skipped"
+            records.append({"task": task_id, "map_index": -1, "state": "upstream_skipped"})
+            continue
+
+        task_results, call_states = [], []
+        for map_index, args, kwargs in task_calls(task, results):
+            context["ti"] = types.SimpleNamespace(task_id=task_id, map_index=map_index, try_number=1)
+            name = task_id + (f"[{map_index}]" if map_index >= 0 else "")
+            record = {"task": task_id, "map_index": map_index, "state": "success"}
+            profiler = TaskProfiler() if profile_folder else None
+            logger.info(f"Running {name}")
+            try:
+                with PeakRss(RSS_SAMPLE_SECONDS) as rss:
+                    started = time.perf_counter()
+                    with profiler or contextlib.nullcontext():
+                        task_results.append(task.python_callable(*args, **kwargs))
+            except AirflowSkipException as skip:
+                record["state"] = "skipped"
+                logger.info(f"Skipped {name}: {skip}")
+            record.update({"seconds": round(time.perf_counter() - started, 3),
+                           "peak_memory_mb": round(rss.growth / 2 ** 20, 1)})
+            if profiler:
+                record["profile"] = write_profile_report(profiler, name, profile_folder, top)
+            records.append(record)
+            call_states.append(record["state"])
+        states[task_id] = "success" if "success" in call_states or not call_states else "skipped"
+        results[task_id] = task_results if hasattr(task, "op_kwargs_expand_input") else (task_results or [None])[0]
+    return records
+
+
+def run_pipeline(folder: str, rows: int = 100_000, input_folder: str = None, profile: bool = False,
+                 stage_cache: bool = False, params: dict = None, top: int = 25) -> dict:
+    """
+    Runs the pipeline on the local stand-ins, with the state of the intermediate storage and the warehouse of the
+    earlier runs in the folder, and returns the run summary. Synthetic inputs are written when no input folder
+    is given.
+    """
+    import boto3
+    import moto
+
+    os.makedirs(folder, exist_ok=True)
+    input_folder = input_folder or synthetic_inputs(os.path.join(folder, "inputs"), rows)
+    module = load_dag_module()
+    use_local_stand_ins(module, folder, bucket="local-run", bucket_folder="raw", stage_cache=stage_cache)
+    schemas = sorted({target["schema"] for target in module.config["snowflake"]["targets"].values()})
+    engine = warehouse_engine(folder, schemas)
+    dag = module.etl_pipeline()
+
+    logical_date = datetime.now(timezone.utc)
+    run_id = f"local__{logical_date.isoformat(timespec='seconds')}"
+    context = task_context(dag, run_id, logical_date, params or {})
+    module.get_current_context = lambda: context
+
+    os.environ.update({"AWS_ACCESS_KEY_ID": "local-run", "AWS_SECRET_ACCESS_KEY": "local-run",
+                       "AWS_DEFAULT_REGION": "us-east-1"})
+    started = time.perf_counter()
+    try:
+        with moto.mock_aws(), mock.patch("include.load.snowflake_engine", lambda *args, **kwargs: engine):
+            client = boto3.client("s3", region_name="us-east-1")
+            client.create_bucket(Bucket="local-run")
+            inputs = upload_inputs(client, "local-run", "raw", input_folder)
+            records = run_tasks(dag, context, os.path.join(folder, "profile") if profile else None, top)
+    finally:
+        engine.dispose()
+
+    summary = {"run_id": run_id, "inputs": inputs, "profile": profile,
+               "seconds": round(time.perf_counter() - started, 3), "tasks": records}
+    with open(os.path.join(folder, "run.json"), "w") as summary_file:
+        json.dump(summary, summary_file, indent=2)
+    return summary
+
+
+def report(summary: dict) -> str:
+    lines = [f"{'task':<62}{'state':>18}{'seconds':>10}{'peak MB':>10}{'traced MB':>11}"]
+    for record in summary["tasks"]:
+        name = record["task"] + (f"[{record['map_index']}]" if record["map_index"] >= 0 else "")
+        traced = record.get("profile", {}).get("peak_traced_mb", "")
+        lines.append(f"{name:<62}{record['state']:>18}{record.get('seconds', ''):>10}"
+                     f"{record.get('peak_memory_mb', ''):>10}{traced:>11}")
+    lines.append(f"{summary['run_id']} ran in {summary['seconds']} seconds")
+    return "\n".join(lines)
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Runs every task of the pipeline locally, optionally profiled.")
+    parser.add_argument("--rows", default="100k", help="Synthetic sales rows, like 10k, 1M or 50M.")
+    parser.add_argument("--input-folder", help="Folder of input files uploaded instead of the synthetic ones.")
+    parser.add_argument("--output", help="Folder of the storage, warehouse and reports, kept between runs. "
+                                         "A new temporary folder by default.")
+    parser.add_argument("--profile", action="store_true", help="Write a hotspot and allocation report per task.")
+    parser.add_argument("--top", type=int, default=25, help="Functions and lines per profile report.")
+    parser.add_argument("--stage-cache", action="store_true", help="Reuse the stage cache of the earlier runs.")
+    parser.add_argument("--full-refresh", action="store_true", help="The full_refresh parameter of the run.")
+    parser.add_argument("--log-level", default="WARNING")
+    args = parser.parse_args(argv)
+
+    # Airflow configures the root logger when it is imported, only its level is set.
+    logging.getLogger().setLevel(args.log_level)
+    folder = args.output or tempfile.mkdtemp(prefix="etl_local_run_")
+    summary = run_pipeline(folder, rows=parse_rows(args.rows), input_folder=args.input_folder,
+                           profile=args.profile, stage_cache=args.stage_cache,
+                           params={"full_refresh": args.full_refresh}, top=args.top)
+    print(report(summary))
+    print(f"Run summary in {os.path.join(folder, 'run.json')}"
+          + (f", profile reports in {os.path.join(folder, 'profile')}" if args.profile else ""))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
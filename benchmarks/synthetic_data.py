@@ -0,0 +1,78 @@
+"""
+Synthetic sales CSV and products JSON files, in the layouts of the files of the S3 bucket.
+The sales keep their messy column names ("sales id", "proDuct Id", "Time stamp") and a share of the rows the
+transform cleans up: untrimmed mixed-case regions, missing regions, null or unpriced quantities, duplicated rows
+and sales of unknown products. Every chunk is generated from the seed and its position, so a scale is reproducible.
+"""
+
+import numpy as np
+import pandas as pd
+
+REGIONS = [" North", "south ", "East", "WEST", "north", "South"]
+ORDER_STATUSES = ["Pending", "Shipped", "Returned", "Delivered"]
+CATEGORIES = ["Electronics", "Toys", "Books", "Garden", "Sports"]
+BRANDS = ["acme", "Globex", "initech", "Umbrella", "Hooli"]
+YEAR_SECONDS = 366 * 24 * 3600
+
+
+def products_rows(sales_rows: int) -> int:
+    """Products dimension size for a sales scale, small next to the sales like in production."""
+    return int(min(max(sales_rows // 1_000, 100), 100_000))
+
+
+def synthetic_products(rows: int, seed: int = 0) -> pd.DataFrame:
+    rng = np.random.default_rng([seed, 1])
+    return pd.DataFrame({
+        "product_id": np.arange(1, rows + 1),
+        "category": rng.choice(CATEGORIES, rows),
+        "brand": rng.choice(BRANDS, rows),
+        "rating": rng.uniform(1, 5, rows).round(1),
+        "in_stock": rng.choice([True, False], rows),
+        "launch_date": (pd.Timestamp("2020-01-01") + pd.to_timedelta(rng.integers(0, 1_500, rows), unit="D"))
+        .strftime("%Y-%m-%d"),
+    })
+
+
+def _timestamp_strings(seconds: np.ndarray) -> np.ndarray:
+    """Seconds in 2024 formatted like the "Time stamp" strings of the CSV files."""
+    timestamps = np.datetime64("2024-01-01") + seconds.astype("timedelta64[s]")
+    return np.char.replace(np.datetime_as_string(timestamps, unit="s"), "T", " ")
+
+
+def synthetic_sales(rows: int, products: int, seed: int = 0, start: int = 0) -> pd.DataFrame:
+    """Sales rows start to start + rows, with about 1% of every kind of dirty row."""
+    rng = np.random.default_rng([seed, 2, start])
+    sales_ids = np.arange(start, start + rows)
+    df = pd.DataFrame({
+        "sales id": sales_ids,
+        # A few product ids past the products dimension are dropped by the join.
+        "proDuct Id": rng.integers(1, int(products * 1.01) + 2, rows),
+        "Region": rng.choice(REGIONS, rows).astype(object),
+        "qty": rng.integers(0, 100, rows) // 10,
+        "Price": rng.uniform(-3, 300, rows).round(2),
+        "Time stamp": _timestamp_strings(sales_ids * 97 % YEAR_SECONDS),
+        "discount": rng.choice([0.0, 2.5, 5.0, 10.0], rows),
+        "order_status": rng.choice(ORDER_STATUSES, rows),
+    })
+    df.loc[rng.random(rows) < 0.01, "Region"] = None
+    duplicated = np.flatnonzero(rng.random(rows) < 0.01)
+    duplicated = duplicated[duplicated > 0]
+    for column in df.columns:
+        values = df[column].to_numpy()
+        values[duplicated] = values[duplicated - 1]
+    return df
+
+
+def iter_sales_chunks(rows: int, products: int, chunk_rows: int = 1_000_000, seed: int = 0):
+    """The sales of a scale chunk by chunk, so scales bigger than the memory can be written to files."""
+    for start in range(0, rows, chunk_rows):
+        yield synthetic_sales(min(chunk_rows, rows - start), products, seed=seed, start=start)
+
+
+def write_sales_csv(path: str, rows: int, products: int, chunk_rows: int = 1_000_000, seed: int = 0) -> None:
+    for number, chunk in enumerate(iter_sales_chunks(rows, products, chunk_rows, seed)):
+        chunk.to_csv(path, mode="w" if number == 0 else "a", header=number == 0, index=False)
+
+
+def write_products_json(path: str, products: pd.DataFrame) -> None:
+    products.to_json(path, orient="records")
@@ -1,124 +1,410 @@
-import pandas as pd
-import yaml
+import functools
+import json
+import re
+
 from airflow.decorators import dag, task, task_group
+from airflow.exceptions import AirflowSkipException
+from airflow.sdk import Param, get_current_context
 from airflow.sdk.bases.operator import AirflowException
 
-from include.extract_s3_data import try_to_extract
-from include.load import data_loading_in_snowflake
-from include.transform import sales_data_transformation, products_data_transformation, \
-    merging_sales_data_with_products_data, merged_data_enriched, quarterly_sales_by_category, \
-    sales_revenue_by_region, sales_seasonality, weekly_order_counts_by_status, average_sales_and_units_by_sales_bucket
+from include.dag_config import load_config
+
+# The scheduler parses this file over and over: only the standard library and Airflow are imported at the top.
+# The pipeline modules, and pandas, pyarrow, pandera and the providers through them, are imported by the tasks.
+config = load_config("include/config.yaml")
+
+storage_config = {**config["intermediate_storage"], "bucket": config["s3"]["bucket"],
+                  "aws_conn_id": config["aws_conn_id"]}
+
+
+@functools.lru_cache(maxsize=None)
+def configure_worker() -> None:
+    """Sets the validation and instrumentation policies of the worker process once, before its first task."""
+    from include.instrumentation import configure_instrumentation
+    from include.validation.validation_policy import configure_validation
+
+    configure_validation(config["validation"])
+    configure_instrumentation(config["instrumentation"])
+
+
+def pipeline_backend() -> dict:
+    """The configured transform backend, imported when a task runs."""
+    from include.transform_backends import transform_backend
+
+    return transform_backend(config["transform"]["backend"])
+
+
+def task_folder() -> str:
+    """Intermediate storage folder of the running task, unique per DAG run and per mapped task instance."""
+    context = get_current_context()
+    run_folder = re.sub(r"[^\w.-]", "_", context["run_id"])
+    map_index = context["ti"].map_index
+    return f"{run_folder}/{context['ti'].task_id}" + (f"/{map_index}" if map_index >= 0 else "")
+
+
+def references(reference_or_references) -> list:
+    """Frames are a single reference, or a list of references in the partitioned transform mode."""
+    return reference_or_references if isinstance(reference_or_references, list) else [reference_or_references]
+
+
+def store_frame(df, name: str, folder: str = None) -> dict:
+    """
+    Writes the frame of the running task to the intermediate storage and returns the reference for XCom.
+    The frame is written to the task folder, or to the folder of its stage cache entry.
+    """
+    from include.intermediate_storage import write_frame
+
+    return write_frame(df, key=f"{folder or task_folder()}/{name}", storage_config=storage_config)
+
+
+# Config sections changing the result of the cached transform and analytics stages.
+CACHED_STAGE_SETTINGS = ["transform", "validation", "sales_buckets", "intermediate_storage"]
+
+
+def cached_stage(inputs, compute, cacheable: bool = True):
+    """
+    Result of compute(folder) from the stage cache, for tasks whose result only depends on their input references.
+    Tasks reading or writing run state, like the deduplication fingerprints, are not cacheable.
+    """
+    from include.stage_cache import cached
+
+    if not cacheable:
+        return compute(None)
+    settings = {section: config[section] for section in CACHED_STAGE_SETTINGS}
+    return cached(get_current_context()["ti"].task_id, inputs, compute, config["stage_cache"], storage_config,
+                  settings=settings)
 
-with open("include/config.yaml") as config_file:
-    config = yaml.safe_load(config_file)
 
+def incremental_run() -> bool:
+    """Incremental extraction is configured and not overridden by the full_refresh parameter of the DAG run."""
+    context = get_current_context()
+    return config["extraction"]["mode"] == "incremental" and not context["params"]["full_refresh"]
 
-@dag()
+
+def task_stage(function):
+    """
+    Records the task as a "task.<task id>" stage: its time, memory and intermediate storage bytes, the rows of the
+    references it returns and the JSON size of its XCom value.
+    """
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        from include.instrumentation import frame_rows, stage
+
+        configure_worker()
+        ti = get_current_context()["ti"]
+        tags = {"map_index": ti.map_index} if ti.map_index >= 0 else {}
+        with stage(f"task.{ti.task_id}", rows_in=frame_rows([*args, *kwargs.values()]), **tags) as record:
+            result = function(*args, **kwargs)
+            record["rows_out"] = frame_rows(result)
+            record["xcom_bytes"] = len(json.dumps(result, default=str))
+            return result
+    return wrapper
+
+
+def deduplicated(frame):
+    """
+    Drops the sales rows loaded by earlier runs, on incremental runs. It returns the frame and the pending key of
+    the new fingerprints, committed to the store by commit_run_state.
+    """
+    from include.deduplication import deduplicate
+
+    pending_key = f"{task_folder()}/fingerprints.bin"
+    frame, _ = deduplicate(frame, config["deduplication"], storage_config, pending_key, drop=incremental_run())
+    return frame, pending_key
+
+
+def sales_bins(frame):
+    """
+    Bins of the sales buckets of the run period. In quantile mode, the sketch of the frame sales is written to a
+    pending key, committed by commit_run_state with the bins, and the key is returned with the bins.
+    """
+    from include.sales_buckets import committed_bins, record_sales_sketch, sales_bucket_bins
+
+    buckets_config = config["sales_buckets"]
+    if buckets_config["mode"] == "fixed":
+        return buckets_config["bins"], None
+    if config["analytics"]["mode"] == "incremental":
+        # The persisted partial aggregates sum the buckets of every run, so the bins stay those committed with the
+        # sketch, until a full refresh rebuilds the partial aggregates.
+        bins = committed_bins(buckets_config, storage_config, refreeze=not incremental_run())
+    else:
+        context = get_current_context()
+        period = (context.get("logical_date") or context["dag_run"].run_after).strftime(
+            buckets_config["period_format"])
+        bins = sales_bucket_bins(buckets_config, storage_config, period)
+    pending_key = f"{task_folder()}/sales_sketch.json"
+    record_sales_sketch(frame, buckets_config, storage_config, pending_key, bins)
+    return bins, pending_key
+
+
+@dag(params={"full_refresh": Param(False, type="boolean",
+                                   description="Extract every object, even if it is in the extraction manifest.")})
 def etl_pipeline():
     @task_group(group_id="extract_group")
     def extract_group():
         """Extracting files from AWS bucket."""
 
-        @task()
-        def extract_json_files(bucket, folder, aws_conn_id, file_ext="json"):
-            return try_to_extract(bucket=bucket, folder=folder, aws_conn_id=aws_conn_id, file_ext=file_ext)
+        @task(multiple_outputs=True)
+        @task_stage
+        def extract_files(bucket, folder, aws_conn_id):
+            from include.extract_s3_data import extract_to_storage
 
-        @task()
-        def extract_csv_files(bucket, folder, aws_conn_id, file_ext="csv"):
-            return try_to_extract(bucket=bucket, folder=folder, aws_conn_id=aws_conn_id, file_ext=file_ext)
+            return extract_to_storage(bucket=bucket, folder=folder, aws_conn_id=aws_conn_id,
+                                      storage_config=storage_config, key_prefix=task_folder(),
+                                      chunksize=config["s3"]["stream_chunk_rows"],
+                                      max_workers=config["s3"]["max_workers"],
+                                      manifest_key=config["extraction"]["manifest_key"],
+                                      incremental=incremental_run(),
+                                      always_extract=config["extraction"]["always_extract"],
+                                      cache_config=config["stage_cache"], reader=config["extraction"]["reader"])
 
         @task()
+        @task_stage
         def get_product_data_file(extracted_files: dict):
-            for key, df in extracted_files.items():
-                if "product" in key:
-                    return df.to_json(orient="split")
-            raise AirflowException("Not found product data file")
+            references = [reference for key, reference in extracted_files.items() if "product" in key]
+            if not references:
+                raise AirflowException("Not found product data file")
+            return references
 
         @task()
+        @task_stage
         def get_sales_data_file(extracted_files: dict):
-            for key, df in extracted_files.items():
-                if "sales" in key:
-                    return df.to_json(orient="split")
-            raise AirflowException("Not found sales data file")
+            references = [reference for key, reference in extracted_files.items() if "sales" in key]
+            if not references and incremental_run():
+                raise AirflowSkipException("No new sales data files since the last run")
+            if not references:
+                raise AirflowException("Not found sales data file")
+            return references
 
-        extracted_json_files = extract_json_files(bucket=config["s3"]["bucket"], folder=config["s3"]["folder"],
-                                                  aws_conn_id=config["aws_conn_id"])
-        extracted_csv_files = extract_csv_files(bucket=config["s3"]["bucket"], folder=config["s3"]["folder"],
-                                                aws_conn_id=config["aws_conn_id"])
-        product_file_in_json = get_product_data_file(extracted_json_files)
-        sales_file_in_json = get_sales_data_file(extracted_csv_files)
+        extracted_files = extract_files(bucket=config["s3"]["bucket"], folder=config["s3"]["folder"],
+                                        aws_conn_id=config["aws_conn_id"])
+        product_file_refs = get_product_data_file(extracted_files["files"])
+        sales_file_refs = get_sales_data_file(extracted_files["files"])
 
-        return {"products_json": product_file_in_json, "sales_json": sales_file_in_json}
+        return {"products_refs": product_file_refs, "sales_refs": sales_file_refs,
+                "manifest": extracted_files["manifest"]}
 
     @task_group(group_id="transform_group")
-    def transform_group(sales_json: str, products_json: str, ):
+    def transform_group(sales_refs: list, products_refs: list, ):
         """Cleaning, transformation and enrichment data."""
+        memory_lean = config["transform"]["memory_lean"]
 
         @task
-        def transform_sales_data(sales_dt_json: str):
-            sales_df = pd.read_json(sales_dt_json, orient="split")
-            cleaned_sales_df = sales_data_transformation(sales_df)
-            return cleaned_sales_df.to_json(orient="split", date_format="iso")
+        @task_stage
+        def transform_sales_data(sales_dt_refs: list):
+            backend = pipeline_backend()
+
+            def transform(folder):
+                sales_df = backend["read"](sales_dt_refs)
+                cleaned_sales_df = backend["sales_data_transformation"](sales_df, memory_lean=memory_lean)
+                return store_frame(cleaned_sales_df, name="cleaned_sales", folder=folder)
+            return cached_stage(sales_dt_refs, transform)
+
+        @task(multiple_outputs=True)
+        @task_stage
+        def deduplicate_sales_data(sales_ref: dict):
+            backend = pipeline_backend()
+            sales_df, pending_key = deduplicated(backend["read"]([sales_ref]))
+            return {"sales": store_frame(sales_df, name="deduplicated_sales"), "fingerprints": [pending_key]}
 
         @task
-        def transform_product_data(products_dt_json: str):
-            products_df = pd.read_json(products_dt_json, orient="split")
-            cleaned_products_df = products_data_transformation(products_df)
-            return cleaned_products_df.to_json(orient="split", date_format="iso")
+        @task_stage
+        def transform_product_data(products_dt_refs: list):
+            backend = pipeline_backend()
 
-        @task
-        def data_merging(sales_json: str, products_json: str):
-            sales_df = pd.read_json(sales_json, orient="split")
-            products_df = pd.read_json(products_json, orient="split")
-            merged_df = merging_sales_data_with_products_data(sales_df, products_df)
-            return merged_df.to_json(orient="split", date_format="iso")
+            def transform(folder):
+                products_df = backend["read"](products_dt_refs)
+                cleaned_products_df = backend["products_data_transformation"](products_df, memory_lean=memory_lean)
+                return store_frame(cleaned_products_df, name="cleaned_products", folder=folder)
+            return cached_stage(products_dt_refs, transform)
 
         @task
-        def data_enrich(merged_json: str):
-            merged_df = pd.read_json(merged_json, orient="split")
-            enriched_df = merged_data_enriched(merged_df)
-            return enriched_df.to_json(orient="split", date_format="iso")
+        @task_stage
+        def data_merging(sales_ref: dict, products_ref: dict):
+            backend = pipeline_backend()
+
+            def merge(folder):
+                sales_df = backend["read"]([sales_ref])
+                products_df = backend["read"]([products_ref])
+                merged_df = backend["merging_sales_data_with_products_data"](sales_df, products_df,
+                                                                             memory_lean=memory_lean)
+                return store_frame(merged_df, name="merged", folder=folder)
+            return cached_stage([sales_ref, products_ref], merge)
+
+        @task(multiple_outputs=True)
+        @task_stage
+        def data_enrich(merged_ref: dict):
+            backend = pipeline_backend()
+
+            def enrich(folder):
+                merged_df = backend["read"]([merged_ref])
+                bins, sketch_key = sales_bins(merged_df)
+                enriched_df = backend["merged_data_enriched"](merged_df, memory_lean=memory_lean, sales_bins=bins)
+                return {"enriched": store_frame(enriched_df, name="enriched", folder=folder),
+                        "sales_sketches": [sketch_key]}
+            # The quantile bins record the sketch of every run.
+            return cached_stage(merged_ref, enrich, cacheable=config["sales_buckets"]["mode"] == "fixed")
 
-        cleaned_sales = transform_sales_data(sales_json)
-        cleaned_products = transform_product_data(products_json)
+        @task
+        @task_stage
+        def transform_sales_partition(sales_ref: dict, products_ref: dict):
+            """Cleans, merges with the broadcast products and enriches one sales file, as one mapped task."""
+            from include.transform_backends import cached_products_lookup
+
+            backend = pipeline_backend()
+
+            def transform(folder):
+                sales_df = backend["read"]([sales_ref])
+                cleaned_sales_df = backend["sales_data_transformation"](sales_df, memory_lean=memory_lean)
+                fingerprints = None
+                if config["deduplication"]["enabled"]:
+                    cleaned_sales_df, fingerprints = deduplicated(cleaned_sales_df)
+                products_lookup = cached_products_lookup(backend, products_ref)
+                merged_df = backend["merging_sales_data_with_products_data"](cleaned_sales_df, products_lookup,
+                                                                             memory_lean=memory_lean)
+                cleaned_sales_ref = store_frame(cleaned_sales_df, name="cleaned_sales", folder=folder)
+                merged_ref = store_frame(merged_df, name="merged", folder=folder)
+                bins, sketch_key = sales_bins(merged_df)
+                enriched_df = backend["merged_data_enriched"](merged_df, memory_lean=memory_lean, sales_bins=bins)
+                return {"sales": cleaned_sales_ref, "merged": merged_ref,
+                        "enriched": store_frame(enriched_df, name="enriched", folder=folder),
+                        "fingerprints": fingerprints, "sales_sketches": sketch_key}
+            cacheable = not config["deduplication"]["enabled"] and config["sales_buckets"]["mode"] == "fixed"
+            return cached_stage([sales_ref, products_ref], transform, cacheable=cacheable)
+
+        @task(multiple_outputs=True)
+        @task_stage
+        def combine_partitions(partitions: list):
+            """The partition frames are not concatenated, downstream tasks get the lists of their references."""
+            return {name: [partition[name] for partition in partitions]
+                    for name in ("sales", "merged", "enriched", "fingerprints", "sales_sketches")}
+
+        cleaned_products = transform_product_data(products_refs)
+
+        if config["transform"]["partitioned"]:
+            partitions = transform_sales_partition.partial(products_ref=cleaned_products).expand(sales_ref=sales_refs)
+            combined = combine_partitions(partitions)
+            return {"sales": combined["sales"], "products": cleaned_products, "merged": combined["merged"],
+                    "enriched": combined["enriched"], "fingerprints": combined["fingerprints"],
+                    "sales_sketches": combined["sales_sketches"]}
+
+        cleaned_sales = transform_sales_data(sales_refs)
+        fingerprints = None
+        if config["deduplication"]["enabled"]:
+            deduplicated_sales = deduplicate_sales_data(cleaned_sales)
+            cleaned_sales, fingerprints = deduplicated_sales["sales"], deduplicated_sales["fingerprints"]
         merged_data = data_merging(cleaned_sales, cleaned_products)
         enriched_data = data_enrich(merged_data)
 
-        return enriched_data
+        return {"sales": cleaned_sales, "products": cleaned_products, "merged": merged_data,
+                "enriched": enriched_data["enriched"], "fingerprints": fingerprints,
+                "sales_sketches": enriched_data["sales_sketches"]}
 
     @task_group(group_id="analytical_group")
-    def analytical_group(enriched_data: str):
+    def analytical_group(enriched_data: dict):
         """Get cleaned and enriched data and perform analytical task to get some insights needed for business decision."""
+        aggregated_columns = ["Time_stamp", "Region", "category", "month", "order_status", "sales_bucket",
+                              "total_sales", "qty"]
+
+        @task(multiple_outputs=True)
+        @task_stage
+        def get_presentation_aggregates(enriched_ref: dict):
+            def aggregate(folder):
+                backend = pipeline_backend()
+                df = backend["scan"](references(enriched_ref), columns=aggregated_columns)
+                aggregates = backend["presentation_aggregates"](df, workers=config["analytics"]["workers"])
+                return {name: store_frame(aggregate_df, name=name, folder=folder)
+                        for name, aggregate_df in aggregates.items()}
+            return cached_stage(enriched_ref, aggregate)
+
+        @task(multiple_outputs=True)
+        @task_stage
+        def refresh_presentation_aggregates(enriched_ref: dict):
+            from include.intermediate_storage import read_frame, read_frames, read_json, write_json
+            from include.transform import finalize_partial_aggregates, merge_partial_aggregates, partial_aggregates
+
+            df = read_frames(references(enriched_ref), columns=aggregated_columns)
+            partials = partial_aggregates(df, workers=config["analytics"]["workers"])
+            previous_refs = None
+            if incremental_run():
+                previous_refs = read_json(config["analytics"]["partials_key"], storage_config)
+            if previous_refs:
+                previous = {name: read_frame(reference) for name, reference in previous_refs.items()}
+                partials = merge_partial_aggregates(previous, partials)
+
+            pending_partials_key = f"{task_folder()}/partial_aggregates.json"
+            partial_refs = {name: store_frame(partial_df, name=f"partials/{name}")
+                            for name, partial_df in partials.items()}
+            write_json(partial_refs, pending_partials_key, storage_config)
+
+            aggregates = finalize_partial_aggregates(partials)
+            return {**{name: store_frame(aggregate_df, name=name) for name, aggregate_df in aggregates.items()},
+                    "partials": pending_partials_key}
+
+        if config["analytics"]["mode"] == "fused":
+            return get_presentation_aggregates(enriched_data)
+        if config["analytics"]["mode"] == "incremental":
+            return refresh_presentation_aggregates(enriched_data)
 
         @task
-        def get_quarterly_sales_trend(json_file: str):
-            df = pd.read_json(json_file, orient="split")
-            trend_df = quarterly_sales_by_category(df)
-            return trend_df.to_json(orient="split", date_format="iso")
+        @task_stage
+        def get_quarterly_sales_trend(enriched_ref: dict):
+            from include.intermediate_storage import read_frames
+            from include.transform import quarterly_sales_by_category
+
+            def analyze(folder):
+                df = read_frames(references(enriched_ref), columns=["Time_stamp", "category", "total_sales"])
+                trend_df = quarterly_sales_by_category(df)
+                return store_frame(trend_df, name="sales_trends", folder=folder)
+            return cached_stage(enriched_ref, analyze)
 
         @task
-        def get_sales_ranking_and_performance(json_file: str):
-            df = pd.read_json(json_file, orient="split")
-            ranking_df = sales_revenue_by_region(df)
-            return ranking_df.to_json(orient="split", date_format="iso")
+        @task_stage
+        def get_sales_ranking_and_performance(enriched_ref: dict):
+            from include.intermediate_storage import read_frames
+            from include.transform import sales_revenue_by_region
+
+            def analyze(folder):
+                df = read_frames(references(enriched_ref), columns=["Region", "total_sales"])
+                ranking_df = sales_revenue_by_region(df)
+                return store_frame(ranking_df, name="sales_ranking", folder=folder)
+            return cached_stage(enriched_ref, analyze)
 
         @task
-        def get_sales_seasonality_by_category(json_file: str):
-            df = pd.read_json(json_file, orient="split")
-            seasonality_df = sales_seasonality(df)
-            return seasonality_df.to_json(orient="split", date_format="iso")
+        @task_stage
+        def get_sales_seasonality_by_category(enriched_ref: dict):
+            from include.intermediate_storage import read_frames
+            from include.transform import sales_seasonality
+
+            def analyze(folder):
+                df = read_frames(references(enriched_ref), columns=["month", "category", "total_sales", "qty"])
+                seasonality_df = sales_seasonality(df)
+                return store_frame(seasonality_df, name="sales_seasonality", folder=folder)
+            return cached_stage(enriched_ref, analyze)
 
         @task
-        def get_weekly_orders_counts_by_status(json_file: str):
-            df = pd.read_json(json_file, orient="split")
-            weekly_counts_df = weekly_order_counts_by_status(df)
-            return weekly_counts_df.to_json(orient="split", date_format="iso")
+        @task_stage
+        def get_weekly_orders_counts_by_status(enriched_ref: dict):
+            from include.intermediate_storage import read_frames
+            from include.transform import weekly_order_counts_by_status
+
+            def analyze(folder):
+                df = read_frames(references(enriched_ref), columns=["Time_stamp", "order_status"])
+                weekly_counts_df = weekly_order_counts_by_status(df)
+                return store_frame(weekly_counts_df, name="sales_status", folder=folder)
+            return cached_stage(enriched_ref, analyze)
 
         @task
-        def get_average_sales_and_units_by_sales_bucket(json_file: str):
-            df = pd.read_json(json_file, orient="split")
-            average_values_df = average_sales_and_units_by_sales_bucket(df)
-            return average_values_df.to_json(orient="split", date_format="iso")
+        @task_stage
+        def get_average_sales_and_units_by_sales_bucket(enriched_ref: dict):
+            from include.intermediate_storage import read_frames
+            from include.transform import average_sales_and_units_by_sales_bucket
+
+            def analyze(folder):
+                df = read_frames(references(enriched_ref), columns=["sales_bucket", "total_sales", "qty"])
+                average_values_df = average_sales_and_units_by_sales_bucket(df)
+                return store_frame(average_values_df, name="average_sales_and_units", folder=folder)
+            return cached_stage(enriched_ref, analyze)
 
         quarterly_sales_trend = get_quarterly_sales_trend(enriched_data)
         sales_revenue_regional = get_sales_ranking_and_performance(enriched_data)
@@ -133,54 +419,65 @@ def etl_pipeline():
                 "average_sales_and_units_sales_bucket": average_sales_and_units_sales_bucket}
 
     @task_group(group_id="loading_group")
-    def loading_group(final_json: str, sales_trends: str, sales_ranking: str, sales_seasonality: str,
-                      sales_status: str, average_sales_and_units_sales_bucket: str):
+    def loading_group(frames: dict):
         """Loading data in Snowflake after analytical tasks"""
 
         @task
-        def snowflake_loading(final_json, database: str, schema: str, table_name: str, snowflake_conn_id: str):
-            final_df = pd.read_json(final_json, orient="split")
-            data_loading_in_snowflake(final_df, database, schema, table_name)
-
-        connection_id = config["snowflake"]["conn_id"]
-        dbase = config["snowflake"]["database"]
-        targets = config["snowflake"]["targets"]
-
-        snowflake_loading(final_json=final_json, database=dbase, schema=targets["sales"]["schema"],
-                          table_name=targets["sales"]["table"], snowflake_conn_id=connection_id)
-        snowflake_loading(final_json=final_json, database=dbase, schema=targets["products"]["schema"],
-                          table_name=targets["products"]["table"], snowflake_conn_id=connection_id)
-        snowflake_loading(final_json=final_json, database=dbase, schema=targets["merged"]["schema"],
-                          table_name=targets["merged"]["table"], snowflake_conn_id=connection_id)
-        snowflake_loading(final_json=final_json, database=dbase, schema=targets["enriched"]["schema"],
-                          table_name=targets["enriched"]["table"], snowflake_conn_id=connection_id)
-
-        snowflake_loading(final_json=sales_trends, database=dbase, schema=targets["trends"]["schema"],
-                          table_name=targets["trends"]["table"], snowflake_conn_id=connection_id)
-
-        snowflake_loading(final_json=sales_ranking, database=dbase, schema=targets["ranking"]["schema"],
-                          table_name=targets["ranking"]["table"], snowflake_conn_id=connection_id)
-
-        snowflake_loading(final_json=sales_seasonality, database=dbase, schema=targets["seasonality"]["schema"],
-                          table_name=targets["seasonality"]["table"], snowflake_conn_id=connection_id)
+        @task_stage
+        def snowflake_batch_loading(frames: dict, snowflake_conn_id: str):
+            from include.load import load_targets, snowflake_engine
 
-        snowflake_loading(final_json=sales_status, database=dbase, schema=targets["status"]["schema"],
-                          table_name=targets["status"]["table"], snowflake_conn_id=connection_id)
+            snowflake_config = config["snowflake"]
+            targets = [{**target, "reference": frames[name]} for name, target in snowflake_config["targets"].items()]
+            engine = snowflake_engine(snowflake_conn_id, pool_size=snowflake_config["max_workers"])
+            return load_targets(targets, engine, max_workers=snowflake_config["max_workers"],
+                                all_or_nothing=snowflake_config["all_or_nothing"],
+                                bulk_load_min_rows=snowflake_config["bulk_load_min_rows"],
+                                max_rows_per_file=snowflake_config["max_rows_per_file"])
 
-        snowflake_loading(final_json=average_sales_and_units_sales_bucket, database=dbase,
-                          schema=targets["average"]["schema"],
-                          table_name=targets["average"]["table"], snowflake_conn_id=connection_id)
+        return snowflake_batch_loading(frames, snowflake_conn_id=config["snowflake"]["conn_id"])
 
     extracted = extract_group()
-    enriched_json = transform_group(extracted["sales_json"], extracted["products_json"])
-    analyzed = analytical_group(enriched_json)
-    loading_group(final_json=enriched_json,
-                  sales_trends=analyzed["sales_trends"],
-                  sales_ranking=analyzed["sales_ranking"],
-                  sales_seasonality=analyzed["sales_seasonality"],
-                  sales_status=analyzed["sales_status"],
-                  average_sales_and_units_sales_bucket=analyzed["average_sales_and_units_sales_bucket"]
-                  )
+    transformed = transform_group(extracted["sales_refs"], extracted["products_refs"])
+    analyzed = analytical_group(transformed["enriched"])
+
+    @task
+    @task_stage
+    def commit_run_state(pending_keys: dict, fingerprint_keys: list = None, sketch_keys: list = None):
+        """
+        The processed objects, the partial aggregates, the fingerprints of the loaded rows and the sketch of their
+        sales are recorded only after the data is loaded, so a failed run extracts, aggregates and loads them again.
+        """
+        from include.deduplication import commit_fingerprints
+        from include.intermediate_storage import promote
+        from include.sales_buckets import commit_sales_sketches
+        from include.stage_cache import evict
+
+        for key, pending_key in pending_keys.items():
+            promote(pending_key, key, storage_config)
+        if config["deduplication"]["enabled"]:
+            commit_fingerprints(fingerprint_keys, config["deduplication"], storage_config)
+        if config["sales_buckets"]["mode"] == "quantile":
+            # Full runs extract every sale again, their sketch replaces the committed one.
+            commit_sales_sketches(sketch_keys, config["sales_buckets"], storage_config, replace=not incremental_run())
+        if config["stage_cache"]["enabled"]:
+            evict(config["stage_cache"], storage_config)
+
+    loaded = loading_group({
+        "sales": transformed["sales"],
+        "products": transformed["products"],
+        "merged": transformed["merged"],
+        "enriched": transformed["enriched"],
+        "trends": analyzed["sales_trends"],
+        "ranking": analyzed["sales_ranking"],
+        "seasonality": analyzed["sales_seasonality"],
+        "status": analyzed["sales_status"],
+        "average": analyzed["average_sales_and_units_sales_bucket"],
+    })
+    run_state = {config["extraction"]["manifest_key"]: extracted["manifest"]}
+    if config["analytics"]["mode"] == "incremental":
+        run_state[config["analytics"]["partials_key"]] = analyzed["partials"]
+    loaded >> commit_run_state(run_state, transformed["fingerprints"], transformed["sales_sketches"])
 
 
 etl_pipeline()
@@ -0,0 +1,271 @@
+"""
+Arrow-native version of the transform chain of include/transform.py, over pyarrow tables.
+Filters, joins and groupbys run in the multi-threaded Arrow compute engine. The presentation aggregates are
+computed batch by batch, so enriched data bigger than the worker memory can be scanned from the intermediate storage.
+The pandas functions stay the reference implementation, both backends return the same data.
+"""
+
+import calendar
+import functools
+import logging
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from include.instrumentation import instrumented, rows_dropped
+from include.transform import SALES_BUCKET_BINS, SALES_BUCKET_LABELS, finalize_partial_aggregates, \
+    merge_partial_aggregates
+from include.validation.enriched_data_validation_schema import merged_data_outgoing_lean_schema, \
+    merged_data_outgoing_schema
+from include.validation.products_validation_schema import product_outgoing_lean_schema, product_outgoing_schema, \
+    products_entry_schema
+from include.validation.sales_validation_schema import sales_entry_schema, sales_outgoing_lean_schema, \
+    sales_outgoing_schema
+from include.validation.validation_policy import validate_table
+
+logger = logging.getLogger(__name__)
+
+# Low-cardinality string columns dictionary-encoded in memory-lean mode, like the pandas categoricals.
+LEAN_DICTIONARY_COLUMNS = ["Region", "order_status", "category", "brand", "launch_date"]
+
+MONTH_NAMES = pa.array(calendar.month_name[1:])
+DAY_NAMES = pa.array(list(calendar.day_name))
+SALES_BUCKETS = pa.array(SALES_BUCKET_LABELS)
+
+# Columns read by the presentation aggregates, the schema of a scan without any batch.
+AGGREGATED_SCHEMA = pa.schema([("Time_stamp", pa.timestamp("ns")), ("Region", pa.string()),
+                               ("category", pa.string()), ("month", pa.string()), ("order_status", pa.string()),
+                               ("sales_bucket", pa.dictionary(pa.int8(), pa.string(), ordered=True)),
+                               ("total_sales", pa.float64()), ("qty", pa.int64())])
+
+
+def _sorted_dictionary(values: pa.ChunkedArray) -> pa.ChunkedArray:
+    """Dictionary-encodes the values with a sorted dictionary, so they convert to the same categoricals as pandas."""
+    dictionary = pc.unique(values).drop_null()
+    dictionary = dictionary.take(pc.array_sort_indices(dictionary))
+    indices = pc.index_in(values, value_set=dictionary)
+    return pa.chunked_array([pa.DictionaryArray.from_arrays(chunk, dictionary) for chunk in indices.chunks],
+                            type=pa.dictionary(pa.int32(), dictionary.type))
+
+
+def _dictionary_encoded(table: pa.Table, memory_lean: bool) -> pa.Table:
+    if not memory_lean:
+        return table
+    for column in LEAN_DICTIONARY_COLUMNS:
+        if column in table.column_names:
+            table = table.set_column(table.column_names.index(column), column, _sorted_dictionary(table[column]))
+    return table
+
+
+def _set_column(table: pa.Table, name: str, values) -> pa.Table:
+    if name in table.column_names:
+        return table.set_column(table.column_names.index(name), name, values)
+    return table.append_column(name, values)
+
+
+def _drop_duplicates(table: pa.Table) -> pa.Table:
+    """Keeps the first occurrence of every duplicated row, in the original row order, like drop_duplicates."""
+    indexed = table.append_column("__row", pa.array(np.arange(table.num_rows)))
+    first_rows = indexed.group_by(table.column_names).aggregate([("__row", "min")])["__row_min"]
+    return table.take(np.sort(first_rows.to_numpy()))
+
+
+def _all_valid(table: pa.Table, columns: list):
+    return functools.reduce(pc.and_, [pc.is_valid(table[column]) for column in columns])
+
+
+def _parsed_timestamps(values):
+    """
+    Timestamp strings parsed in C++. When a value doesn't parse, the column is parsed again like the pandas backend,
+    with pd.to_datetime(errors="coerce"), so malformed timestamps become null instead of failing the task.
+    """
+    if pa.types.is_timestamp(values.type):
+        return values.cast(pa.timestamp("ns"))
+    try:
+        return pc.cast(values, pa.timestamp("ns"))
+    except pa.ArrowInvalid:
+        logger.warning(f"Unparsable timestamps, parsing them like pandas and setting them to null")
+        parsed = pd.to_datetime(values.to_pandas(), errors="coerce")
+        return pa.chunked_array([pa.array(parsed, type=pa.timestamp("ns"), from_pandas=True)])
+
+
+@instrumented
+def sales_data_transformation(sales_table: pa.Table, memory_lean: bool = False) -> pa.Table:
+    """Sales data cleaning and transformation"""
+    logger.info(f"Initiating Arrow transformation of sales data")
+    validate_table(sales_entry_schema, sales_table, raise_errors=False)
+    sales_table = sales_table.rename_columns([name.replace(" ", "_") for name in sales_table.column_names])
+    sales_table = _set_column(sales_table, "Region", pc.utf8_trim_whitespace(pc.utf8_lower(sales_table["Region"])))
+    rows = sales_table.num_rows
+    sales_table = sales_table.filter(_all_valid(sales_table, ["Region", "Time_stamp", "proDuct_Id"]))
+    rows = rows_dropped("missing_values", rows, sales_table)
+    sales_table = _drop_duplicates(sales_table)
+    rows = rows_dropped("duplicates", rows, sales_table)
+    sales_table = sales_table.filter(pc.and_(pc.greater(sales_table["Price"], 0), pc.greater(sales_table["qty"], 0)))
+    rows_dropped("unpriced", rows, sales_table)
+    sales_table = _set_column(sales_table, "Time_stamp", _parsed_timestamps(sales_table["Time_stamp"]))
+    discounted_price = pc.multiply(sales_table["Price"],
+                                   pc.subtract(1, pc.divide(sales_table["discount"], 100)))
+    sales_table = _set_column(sales_table, "total_sales",
+                              pc.multiply(discounted_price, pc.cast(sales_table["qty"], pa.float64())))
+    sales_table = sales_table.rename_columns(["product_id" if name == "proDuct_Id" else name
+                                              for name in sales_table.column_names])
+    sales_table = _dictionary_encoded(sales_table, memory_lean)
+    logger.info(f"Done Arrow transformation of sales data")
+    return validate_table(sales_outgoing_lean_schema if memory_lean else sales_outgoing_schema, sales_table)
+
+
+@instrumented
+def products_data_transformation(products_table: pa.Table, memory_lean: bool = False) -> pa.Table:
+    """Products data cleaning and transformation"""
+    logger.info(f"Initiating Arrow transformation of products data")
+    validate_table(products_entry_schema, products_table)
+    products_table = _set_column(products_table, "brand", pc.utf8_upper(products_table["brand"]))
+    products_table = _set_column(products_table, "category", pc.utf8_lower(products_table["category"]))
+    rows = products_table.num_rows
+    products_table = products_table.filter(_all_valid(products_table, ["product_id", "rating"]))
+    rows = rows_dropped("missing_values", rows, products_table)
+    products_table = _drop_duplicates(products_table)
+    rows_dropped("duplicates", rows, products_table)
+    products_table = _dictionary_encoded(products_table, memory_lean)
+    logger.info(f"Done Arrow transformation of products data")
+    return validate_table(product_outgoing_lean_schema if memory_lean else product_outgoing_schema, products_table)
+
+
+def products_lookup(products_table: pa.Table) -> dict:
+    """Arrow version of transform.products_lookup, the product ids are the value set of the lookup."""
+    keys = products_table["product_id"].combine_chunks()
+    return {"keys": keys, "unique": len(pc.unique(keys)) == len(keys), "products": products_table,
+            "columns": products_table.drop_columns(["product_id"])}
+
+
+def _hash_join(sales_table: pa.Table, products_table: pa.Table) -> pa.Table:
+    """
+    Inner hash join of the sales with the products, on the Arrow thread pool.
+    The rows are put back in the pandas merge order: grouped by product in order of first appearance in the sales,
+    then in the order of the sales.
+    """
+    sales_keys = pa.table({"product_id": sales_table["product_id"], "__row": np.arange(sales_table.num_rows)})
+    first_rows = sales_keys.group_by("product_id").aggregate([("__row", "min")])
+    # Only the keys and row numbers are joined and sorted, the sales columns are gathered once at the end.
+    joined = sales_keys.join(products_table, keys="product_id", join_type="inner")
+    joined = joined.join(first_rows, keys="product_id", join_type="inner")
+    joined = joined.take(pc.sort_indices(joined, [("__row_min", "ascending"), ("__row", "ascending")]))
+
+    merged_table = sales_table.take(joined["__row"])
+    for name in products_table.column_names:
+        if name != "product_id":
+            merged_table = merged_table.append_column(name, joined[name])
+    return merged_table
+
+
+def lookup_join(sales_table: pa.Table, lookup: dict):
+    """
+    Arrow version of transform.lookup_join: the product positions are looked up with index_in and the product
+    columns gathered with take. It returns the joined table and the number of orphan sales rows dropped.
+    """
+    if not lookup["unique"]:
+        logger.warning(f"Duplicated product_id in the products lookup, falling back to a hash join")
+        orphan_rows = pc.sum(pc.invert(pc.is_in(sales_table["product_id"], value_set=lookup["keys"]))).as_py()
+        return _hash_join(sales_table, lookup["products"]), orphan_rows or 0
+
+    positions = pc.index_in(sales_table["product_id"], value_set=lookup["keys"])
+    orphan_rows = positions.null_count
+    if orphan_rows:
+        matched = pc.is_valid(positions)
+        sales_table, positions = sales_table.filter(matched), positions.filter(matched)
+    product_columns = lookup["columns"].take(positions)
+    for name in product_columns.column_names:
+        sales_table = sales_table.append_column(name, product_columns[name])
+    return sales_table, orphan_rows
+
+
+@instrumented
+def merging_sales_data_with_products_data(sales_table: pa.Table, products_table,
+                                          memory_lean: bool = False) -> pa.Table:
+    """Joins the sales with the products table, or with its products_lookup, keeping the sales order."""
+    logger.info(f"Start Arrow join of sales with products")
+    lookup = products_table if isinstance(products_table, dict) else products_lookup(products_table)
+    merged_table, orphan_rows = lookup_join(sales_table, lookup)
+    rows_dropped("orphans", sales_table.num_rows, sales_table.num_rows - orphan_rows)
+    if orphan_rows:
+        logger.warning(f"Dropped {orphan_rows} of {sales_table.num_rows} sales rows without a matching product")
+    return merged_table
+
+
+def _sales_buckets(total_sales: pa.ChunkedArray, sales_bins: list) -> pa.ChunkedArray:
+    """Same buckets as pd.cut(bins=sales_bins, labels=SALES_BUCKET_LABELS), as an ordered dictionary."""
+    bucket = functools.reduce(pc.add, [pc.cast(pc.greater(total_sales, edge), pa.int8()) for edge in sales_bins[1:-1]])
+    in_bins = pc.and_(pc.greater(total_sales, sales_bins[0]), pc.less_equal(total_sales, sales_bins[-1]))
+    indices = pc.if_else(in_bins, bucket, pa.scalar(None, pa.int8()))
+    return pa.chunked_array([pa.DictionaryArray.from_arrays(chunk, SALES_BUCKETS, ordered=True)
+                             for chunk in indices.chunks],
+                            type=pa.dictionary(pa.int8(), pa.string(), ordered=True))
+
+
+@instrumented
+def merged_data_enriched(merged_table: pa.Table, memory_lean: bool = False,
+                         sales_bins: list = SALES_BUCKET_BINS) -> pa.Table:
+    """Enrichment after merging, month and weekday names are looked up from their numbers."""
+    logger.info(f"Arrow merged data enrich process")
+    timestamps = merged_table["Time_stamp"]
+    month = MONTH_NAMES.take(pc.subtract(pc.month(timestamps), 1))
+    weekday = DAY_NAMES.take(pc.day_of_week(timestamps))
+    if memory_lean:
+        month, weekday = _sorted_dictionary(month), _sorted_dictionary(weekday)
+    merged_table = merged_table.append_column("month", month)
+    merged_table = merged_table.append_column("weekday", weekday)
+    merged_table = merged_table.append_column("hour", pc.hour(timestamps))
+    merged_table = merged_table.append_column("sales_bucket", _sales_buckets(merged_table["total_sales"], sales_bins))
+    return validate_table(merged_data_outgoing_lean_schema if memory_lean else merged_data_outgoing_schema,
+                          merged_table)
+
+
+def _grouped(table: pa.Table, keys: list, aggregations: list, names: list):
+    """Sums and counts per group in the Arrow engine, rows with a missing key are dropped like in groupby."""
+    grouped = table.filter(_all_valid(table, keys)).group_by(keys).aggregate(aggregations)
+    aggregated_columns = [f"{column}_{function}" for column, function, _ in aggregations]
+    grouped_df = grouped.select(keys + aggregated_columns).rename_columns(keys + names).to_pandas()
+    return grouped_df.sort_values(keys, ignore_index=True)
+
+
+@instrumented
+def partial_aggregates(table: pa.Table) -> dict:
+    """Arrow version of transform.partial_aggregates, it returns the same small pandas frames."""
+    timestamps = table["Time_stamp"]
+    quarter = pc.binary_join_element_wise(pc.cast(pc.year(timestamps), pa.string()),
+                                          pc.cast(pc.quarter(timestamps), pa.string()), "Q")
+    table = table.append_column("quarter", quarter).append_column("week", pc.iso_week(timestamps))
+    total_sales_sum = ("total_sales", "sum", pc.ScalarAggregateOptions(min_count=0))
+    qty_sum = ("qty", "sum", pc.ScalarAggregateOptions(min_count=0))
+    row_count = ("qty", "count", pc.CountOptions(mode="all"))
+
+    return {
+        "quarter_category": _grouped(table, ["quarter", "category"], [total_sales_sum], ["total_sales"]),
+        "region": _grouped(table, ["Region"], [total_sales_sum], ["total_sales"]),
+        "month_category": _grouped(table, ["month", "category"], [total_sales_sum, qty_sum],
+                                   ["monthly_total_sales", "monthly_total_quantity"]),
+        "week_status": _grouped(table, ["week", "order_status"], [row_count], ["order_counts"]),
+        "sales_bucket": _grouped(table, ["sales_bucket"], [total_sales_sum, qty_sum, row_count],
+                                 ["total_sales", "total_quantity", "rows"]),
+    }
+
+
+@instrumented
+def presentation_aggregates(batches, workers: int = 1) -> dict:
+    """
+    Computes the five presentation frames from a table, or from record batches scanned one at a time.
+    Only the partial aggregates of the batches seen so far are kept in memory, no batch gives empty frames.
+    workers is accepted for the pandas signature, Arrow group_by already runs on every core of its thread pool.
+    """
+    if isinstance(batches, pa.Table):
+        batches = [batches]
+    partials = None
+    for batch in batches:
+        table = batch if isinstance(batch, pa.Table) else pa.Table.from_batches([batch])
+        partials = merge_partial_aggregates(partials, partial_aggregates(table))
+    if partials is None:
+        partials = partial_aggregates(AGGREGATED_SCHEMA.empty_table())
+    return finalize_partial_aggregates(partials)
@@ -0,0 +1,67 @@
+import logging
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+
+def _quarter(hours: pd.Series) -> pd.Series:
+    return hours.dt.to_period("Q").astype(str)
+
+
+def _week(hours: pd.Series) -> pd.Series:
+    return hours.dt.isocalendar().week.astype("int64")
+
+
+# Calendar attributes, computed once per distinct hour.
+CALENDAR_ATTRIBUTES = {
+    "year": lambda hours: hours.dt.year.astype("int64"),
+    "quarter": _quarter,
+    "month": lambda hours: hours.dt.month_name(),
+    "week": _week,
+    "weekday": lambda hours: hours.dt.day_name(),
+    "hour": lambda hours: hours.dt.hour.astype("int64"),
+}
+
+
+def calendar_dimension(timestamps: pd.Series, attributes=CALENDAR_ATTRIBUTES.keys()):
+    """
+    Parses the timestamps once and builds a calendar dimension with one row per distinct hour present.
+    Millions of rows usually fall in a few thousand hours, so the datetime work runs on the dimension only.
+    It returns the dimension row code of every timestamp (-1 for missing ones) and the dimension.
+    """
+    hours = pd.to_datetime(timestamps).dt.floor("h")
+    codes, distinct_hours = pd.factorize(hours)
+    distinct_hours = pd.Series(distinct_hours)
+    dimension = pd.DataFrame({attribute: CALENDAR_ATTRIBUTES[attribute](distinct_hours) for attribute in attributes})
+    logger.info(f"Calendar dimension of {len(dimension.index)} hours for {len(codes)} timestamps")
+    return codes, dimension
+
+
+def factorized_attribute(codes: np.ndarray, attribute: pd.Series):
+    """
+    Sorted integer codes and labels of a dimension attribute for every row, like pd.factorize(sort=True),
+    but factorizing only the dimension values.
+    """
+    attribute_codes, uniques = pd.factorize(attribute, sort=True)
+    return np.where(codes >= 0, attribute_codes[codes], -1), uniques
+
+
+def calendar_attributes(timestamps: pd.Series, attributes, categorical: bool = False) -> pd.DataFrame:
+    """
+    Calendar attributes of every timestamp, mapped back from the calendar dimension with an indexed lookup.
+    With categorical, string attributes are returned as categoricals and integers in their smallest width.
+    """
+    codes, dimension = calendar_dimension(timestamps, attributes)
+    columns = {}
+    for attribute in attributes:
+        if categorical and dimension[attribute].dtype == object:
+            attribute_codes, uniques = factorized_attribute(codes, dimension[attribute])
+            columns[attribute] = pd.Categorical.from_codes(attribute_codes, categories=uniques)
+        else:
+            values = dimension[attribute].to_numpy()
+            if categorical:
+                values = pd.to_numeric(values, downcast="integer")
+            columns[attribute] = pd.api.extensions.take(values, codes, allow_fill=True)
+    return pd.DataFrame(columns, index=timestamps.index)
@@ -0,0 +1,91 @@
+"""
+Parsed config.yaml for the DAG file, which the scheduler parses every few seconds. The parsed config is kept per
+process and in a JSON snapshot in the temporary directory, for the fresh processes parsing the DAG, and it is parsed
+again only when the modification time or the size of config.yaml changed. Only the standard library is imported,
+yaml only when the file changed.
+"""
+
+import copy
+import json
+import os
+import tempfile
+
+SNAPSHOT_FOLDER = os.path.join(tempfile.gettempdir(), "etl_config_cache")
+
+_parsed_configs = {}
+
+# Targets loaded with the rows of the run, the presentation targets are rebuilt from every run by the analytics.
+RUN_ROWS_TARGETS = ["sales", "products", "merged", "enriched"]
+
+
+def _file_version(path: str) -> list:
+    stat = os.stat(path)
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+def _snapshot_path(path: str) -> str:
+    return os.path.join(SNAPSHOT_FOLDER, path.strip(os.sep).replace(os.sep, "__") + ".json")
+
+
+def _read_snapshot(path: str, version: list):
+    try:
+        with open(_snapshot_path(path)) as snapshot_file:
+            snapshot = json.load(snapshot_file)
+    except (OSError, ValueError):
+        return None
+    return snapshot["config"] if snapshot.get("version") == version else None
+
+
+def _write_snapshot(path: str, version: list, config: dict) -> None:
+    """Written to a temporary file and renamed, so a concurrent parse never reads half a snapshot."""
+    try:
+        snapshot = json.dumps({"version": version, "config": config})
+        os.makedirs(SNAPSHOT_FOLDER, exist_ok=True)
+        with tempfile.NamedTemporaryFile("w", dir=SNAPSHOT_FOLDER, suffix=".tmp", delete=False) as snapshot_file:
+            snapshot_file.write(snapshot)
+        os.replace(snapshot_file.name, _snapshot_path(path))
+    except (OSError, TypeError, ValueError):
+        # The snapshot only saves parsing time: with a read-only temporary directory, or values JSON can't store
+        # like dates, every process parses the file.
+        pass
+
+
+def validate_config(config: dict) -> None:
+    """
+    Rejects the settings losing the history on incremental extraction runs, which only get the new objects. The
+    presentation frames must then be refreshed from the persisted partial aggregates, the incremental analytics
+    mode, and the targets of the run rows merged into the loaded ones with the upsert load_mode, not replaced.
+    """
+    if config.get("extraction", {}).get("mode") != "incremental":
+        return
+    if config["analytics"]["mode"] != "incremental":
+        raise ValueError(f"Incremental extraction needs the incremental analytics mode, the "
+                         f"{config['analytics']['mode']} mode would replace the presentation tables with the "
+                         f"aggregates of the new objects only")
+    targets = config["snowflake"]["targets"]
+    replaced = [name for name in RUN_ROWS_TARGETS
+                if name in targets and targets[name].get("load_mode", "replace") != "upsert"]
+    if replaced:
+        raise ValueError(f"Incremental extraction needs the upsert load_mode for the {', '.join(replaced)} targets, "
+                         f"replacing them would keep the rows of the new objects only")
+
+
+def load_config(path: str) -> dict:
+    """
+    Parsed and validated YAML config file, reloaded only when the file changed. A copy is returned, callers may
+    modify it.
+    """
+    path = os.path.abspath(path)
+    version = _file_version(path)
+    cached = _parsed_configs.get(path)
+    if cached is None or cached["version"] != version:
+        config = _read_snapshot(path, version)
+        if config is None:
+            import yaml
+
+            with open(path) as config_file:
+                config = yaml.safe_load(config_file)
+            validate_config(config)
+            _write_snapshot(path, version, config)
+        cached = _parsed_configs[path] = {"version": version, "config": config}
+    return copy.deepcopy(cached["config"])
@@ -0,0 +1,167 @@
+"""
+Deduplication of rows across DAG runs, against a persisted store of 64-bit row fingerprints.
+The store is a list of sorted fingerprint segments, one per committed run, merged together when there are more than
+max_segments, and a Bloom filter of every fingerprint stored. Only the fingerprints the Bloom filter may contain are
+searched in the segments, so checking a batch doesn't read the whole history, and the memory used is the Bloom
+filter plus the batch. The store index is written last on commit, so a failed commit leaves the previous store.
+"""
+
+import logging
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+from include.instrumentation import instrumented, rows_dropped
+from include.intermediate_storage import delete, read_array, read_bytes, read_json, write_bytes, write_json
+
+logger = logging.getLogger(__name__)
+
+
+def row_fingerprints(frame, key_columns=None) -> np.ndarray:
+    """64-bit fingerprint of every row of a data frame or Arrow table, hashed from the key columns or the whole row."""
+    if isinstance(frame, pa.Table):
+        frame = frame.select(key_columns or frame.column_names).to_pandas()
+    return pd.util.hash_pandas_object(frame[key_columns or list(frame.columns)], index=False).to_numpy()
+
+
+def _bloom_positions(fingerprints: np.ndarray, bloom_bits: int, bloom_hashes: int):
+    """Bit positions of the fingerprints for every hash, by double hashing of their two 32-bit halves."""
+    low, high = fingerprints & np.uint64(0xFFFFFFFF), (fingerprints >> np.uint64(32)) | np.uint64(1)
+    for step in range(bloom_hashes):
+        yield (low + np.uint64(step) * high) % np.uint64(bloom_bits)
+
+
+def bloom_add(bloom: np.ndarray, fingerprints: np.ndarray, bloom_hashes: int) -> None:
+    for positions in _bloom_positions(fingerprints, len(bloom) * 8, bloom_hashes):
+        np.bitwise_or.at(bloom, (positions >> np.uint64(3)).astype(np.intp),
+                         np.left_shift(1, positions & np.uint64(7)).astype(np.uint8))
+
+
+def bloom_contains(bloom: np.ndarray, fingerprints: np.ndarray, bloom_hashes: int) -> np.ndarray:
+    """False for fingerprints surely not added to the Bloom filter, True for the ones it may contain."""
+    contained = np.ones(len(fingerprints), dtype=bool)
+    for positions in _bloom_positions(fingerprints, len(bloom) * 8, bloom_hashes):
+        bytes_ = bloom[(positions >> np.uint64(3)).astype(np.intp)]
+        contained &= (bytes_ >> (positions & np.uint64(7)).astype(np.uint8)) & 1 == 1
+    return contained
+
+
+def _index_key(dedup_config: dict) -> str:
+    return f"{dedup_config['store_key']}/index.json"
+
+
+def load_store(dedup_config: dict, storage_config: dict) -> dict:
+    """Index of the committed segments and the Bloom filter. An empty store is returned before the first commit."""
+    index = read_json(_index_key(dedup_config), storage_config,
+                      default={"segments": [], "bloom": None, "bloom_hashes": 0, "version": 0})
+    bloom = None
+    if index["bloom"]:
+        bloom = np.frombuffer(read_bytes(index["bloom"], storage_config), dtype=np.uint8)
+    return {"index": index, "bloom": bloom}
+
+
+def seen_fingerprints(fingerprints: np.ndarray, store: dict, storage_config: dict) -> np.ndarray:
+    """Whether every fingerprint is in the store. The Bloom filter candidates are searched in every segment."""
+    seen = np.zeros(len(fingerprints), dtype=bool)
+    if not store["index"]["segments"]:
+        return seen
+    if store["bloom"] is not None:
+        candidates = np.flatnonzero(bloom_contains(store["bloom"], fingerprints, store["index"]["bloom_hashes"]))
+    else:
+        candidates = np.arange(len(fingerprints))
+    # Sorted, the candidates are searched in the segment pages in order.
+    candidates = candidates[np.argsort(fingerprints[candidates], kind="stable")]
+    for segment in store["index"]["segments"]:
+        if not len(candidates):
+            break
+        values = read_array(segment["key"], storage_config, np.uint64)
+        positions = np.minimum(np.searchsorted(values, fingerprints[candidates]), len(values) - 1)
+        found = values[positions] == fingerprints[candidates]
+        seen[candidates[found]] = True
+        candidates = candidates[~found]
+    return seen
+
+
+@instrumented
+def deduplicate(frame, dedup_config: dict, storage_config: dict, pending_key: str, drop: bool = True):
+    """
+    Drops the rows of a data frame or Arrow table already loaded by an earlier run, or repeated in the frame.
+    The fingerprints of the new rows are written to pending_key, for commit_fingerprints once the run succeeded.
+    Without drop, the rows are only fingerprinted, like on full refresh runs loading every row again.
+    It returns the frame and the number of rows dropped.
+    """
+    fingerprints = row_fingerprints(frame, dedup_config["key_columns"])
+    unique_fingerprints, first_rows = np.unique(fingerprints, return_index=True)
+    new = ~seen_fingerprints(unique_fingerprints, load_store(dedup_config, storage_config), storage_config)
+    write_bytes(unique_fingerprints[new].tobytes(), pending_key, storage_config)
+
+    new_rows = np.zeros(len(fingerprints), dtype=bool)
+    new_rows[first_rows[new]] = True
+    dropped_rows = int(len(fingerprints) - np.count_nonzero(new_rows))
+    logger.info(f"{dropped_rows} of {len(fingerprints)} rows already loaded or repeated, drop: {drop}")
+    if not drop:
+        return frame, 0
+    frame = frame.filter(pa.array(new_rows)) if isinstance(frame, pa.Table) else frame[new_rows]
+    rows_dropped("already_loaded", len(fingerprints), frame)
+    return frame, dropped_rows
+
+
+def _compacted(segments: list, version: int, dedup_config: dict, storage_config: dict) -> list:
+    """Merges the smallest segments into one when there are more than max_segments, like a log-structured store."""
+    max_segments = dedup_config["max_segments"]
+    if len(segments) <= max_segments:
+        return segments
+    segments = sorted(segments, key=lambda segment: segment["rows"])
+    merged_segments = segments[:len(segments) - max_segments // 2 + 1]
+    # Segments hold distinct fingerprints, merging is a sort of their concatenation.
+    merged = np.sort(np.concatenate([read_array(segment["key"], storage_config, np.uint64)
+                                     for segment in merged_segments]))
+    key = f"{dedup_config['store_key']}/segment-{version}-merged.bin"
+    write_bytes(merged.tobytes(), key, storage_config)
+    logger.info(f"Merged {len(merged_segments)} fingerprint segments into {key}")
+    return [{"key": key, "rows": len(merged)}, *segments[len(merged_segments):]]
+
+
+def commit_fingerprints(pending_keys: list, dedup_config: dict, storage_config: dict) -> None:
+    """
+    Adds the pending fingerprints of a successful run to the store, as a new segment and in the Bloom filter.
+    The Bloom filter is rebuilt from the segments when its configured size changed.
+    """
+    store = load_store(dedup_config, storage_config)
+    index = store["index"]
+    version = index["version"] + 1
+    pending = np.unique(np.concatenate([np.frombuffer(read_bytes(key, storage_config) or b"", dtype=np.uint64)
+                                        for key in pending_keys] or [np.empty(0, dtype=np.uint64)]))
+    # Mapped partitions may have fingerprinted the same rows, and a retried commit may have stored them already.
+    pending = pending[~seen_fingerprints(pending, store, storage_config)]
+
+    segments = list(index["segments"])
+    if len(pending):
+        key = f"{dedup_config['store_key']}/segment-{version}.bin"
+        write_bytes(pending.tobytes(), key, storage_config)
+        segments.append({"key": key, "rows": len(pending)})
+    segments = _compacted(segments, version, dedup_config, storage_config)
+
+    bloom_key, bloom_bits, bloom_hashes = None, dedup_config["bloom_bits"], dedup_config["bloom_hashes"]
+    if bloom_bits:
+        bloom_key = f"{dedup_config['store_key']}/bloom-{version}.bin"
+        if store["bloom"] is not None and len(store["bloom"]) == bloom_bits // 8 \
+                and index["bloom_hashes"] == bloom_hashes:
+            bloom = store["bloom"].copy()
+            bloom_add(bloom, pending, bloom_hashes)
+        else:
+            bloom = np.zeros(bloom_bits // 8, dtype=np.uint8)
+            for segment in segments:
+                bloom_add(bloom, np.asarray(read_array(segment["key"], storage_config, np.uint64)), bloom_hashes)
+        write_bytes(bloom.tobytes(), bloom_key, storage_config)
+
+    write_json({"segments": segments, "bloom": bloom_key, "bloom_hashes": bloom_hashes, "version": version},
+               _index_key(dedup_config), storage_config)
+    logger.info(f"Committed {len(pending)} fingerprints, {sum(s['rows'] for s in segments)} stored "
+                f"in {len(segments)} segments")
+
+    current_keys = {segment["key"] for segment in segments} | {bloom_key}
+    for replaced_key in [segment["key"] for segment in index["segments"]] + [index["bloom"]]:
+        if replaced_key and replaced_key not in current_keys:
+            delete(replaced_key, storage_config)
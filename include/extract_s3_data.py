@@ -1,50 +1,433 @@
-import io
 import logging
+import os
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
 from airflow.providers.amazon.aws.hooks.s3 import S3Hook
 from airflow.sdk.bases.operator import AirflowException
+from botocore.config import Config
+
+from include.instrumentation import in_stage_context, instrumented, rows_dropped, stage
+from include.intermediate_storage import read_json, write_frame_chunks, write_json
+from include.stage_cache import cached
+from include.validation.products_validation_schema import products_entry_schema
+from include.validation.sales_validation_schema import sales_entry_schema
 
 logger = logging.getLogger(__name__)
 
 
-def try_to_extract(bucket, folder, aws_conn_id, file_ext):
+def _read_csv(body, chunksize):
+    return pd.read_csv(body, chunksize=chunksize)
+
+
+def _read_json_lines(body, chunksize):
+    return pd.read_json(body, lines=True, chunksize=chunksize)
+
+
+def _read_json(body, chunksize):
+    # A JSON document can't be split in chunks, it is parsed at once.
+    df = pd.read_json(body)
+    return df if chunksize is None else iter([df])
+
+
+def _spooled(body):
+    """
+    Copies the stream to a temporary file, for the formats read from the end of the file. A Parquet reader starts
+    with the footer, and S3 bodies and decompressed streams can't seek.
+    """
+    spool = tempfile.TemporaryFile()
+    shutil.copyfileobj(body, spool, 2 ** 20)
+    spool.seek(0)
+    return spool
+
+
+def _read_parquet(body, chunksize):
+    """Arrow tables of the row groups, in batches of at most chunksize rows, without any text parsing."""
+    parquet_file = pq.ParquetFile(_spooled(body))
+    if chunksize is None:
+        return parquet_file.read()
+    return (pa.Table.from_batches([batch]) for batch in parquet_file.iter_batches(batch_size=chunksize))
+
+
+# Files are dispatched to a reader by their extension.
+READERS = {
+    "csv": _read_csv,
+    "jsonl": _read_json_lines,
+    "ndjson": _read_json_lines,
+    "json": _read_json,
+    "parquet": _read_parquet,
+}
+
+# Arrow codecs of the compression suffixes, like sales.csv.gz. Compressed files are decompressed while they stream
+# from S3 into the reader of the extension before the suffix.
+COMPRESSIONS = {
+    "gz": "gzip",
+    "zst": "zstd",
+}
+
+
+# Projected reads, the projected reader mode: only the columns of the entry schema of a file are parsed, with the
+# schema types instead of inferred ones, and the rows the transformation drops for missing values or a quantity or
+# price not above zero are filtered while reading, chunk by chunk. Files are matched by a part of their key, like the
+# DAG tells the sales from the products files, and the files of no projection are read in full.
+PROJECTIONS = {
+    "sales": {"schema": sales_entry_schema, "not_null": ["Region", "Time stamp", "proDuct Id"],
+              "positive": ["Price", "qty"]},
+    "product": {"schema": products_entry_schema, "not_null": ["product_id", "rating"], "positive": []},
+}
+
+# Arrow types of the pandera column types of the entry schemas.
+ARROW_TYPES = {"int64": pa.int64(), "float64": pa.float64(), "str": pa.string(), "bool": pa.bool_()}
+
+
+def _suffix(path: str) -> str:
+    return os.path.splitext(path)[1].lstrip(".").lower()
+
+
+def file_compression(key: str):
+    """Arrow codec of the compression suffix of the key, or None."""
+    return COMPRESSIONS.get(_suffix(key))
+
+
+def file_extension(key: str) -> str:
+    """Extension of the file format, before the compression suffix if any: csv for sales.csv.gz."""
+    return _suffix(os.path.splitext(key)[0] if file_compression(key) else key)
+
+
+def file_projection(key: str):
+    """Projection of the file, by the first PROJECTIONS part in its name, or None."""
+    name = os.path.basename(key).lower()
+    return next((projection for part, projection in PROJECTIONS.items() if part in name), None)
+
+
+def _column_types(projection: dict) -> dict:
+    return {name: str(column.dtype) for name, column in projection["schema"].columns.items()}
+
+
+def _kept_rows(table, projection: dict):
+    """
+    Mask of the rows kept by the projection filters, of an Arrow table or batch. The dropped rows are recorded in the
+    running stage, under the filter names of the transformation.
+    """
+    rows = table.num_rows
+    mask = pa.array([True] * rows, pa.bool_())
+    for name in projection["not_null"]:
+        mask = pc.and_(mask, pc.is_valid(table.column(name)))
+    kept = rows_dropped("missing_values", rows, pc.sum(mask).as_py() or 0)
+    for name in projection["positive"]:
+        mask = pc.and_(mask, pc.fill_null(pc.greater(table.column(name), 0), False))
+    rows_dropped("unpriced", kept, pc.sum(mask).as_py() or 0)
+    return mask
+
+
+def _arrow_schema(projection: dict) -> pa.Schema:
+    return pa.schema([(name, ARROW_TYPES[dtype]) for name, dtype in _column_types(projection).items()])
+
+
+def _kept_tables(batches, chunksize, schema: pa.Schema, projection: dict):
+    """
+    Filters the Arrow batches or tables of a file one by one and yields Arrow tables of chunksize kept rows, or of
+    every kept row without chunksize. Rejected rows never reach a chunk.
+    """
+    kept_batches, rows, chunks = [], 0, 0
+    for batch in batches:
+        batch = batch.filter(_kept_rows(batch, projection))
+        kept_batches += batch.to_batches() if isinstance(batch, pa.Table) else [batch]
+        rows += batch.num_rows
+        while chunksize is not None and rows >= chunksize:
+            table = pa.Table.from_batches(kept_batches, schema=schema)
+            yield table.slice(0, chunksize)
+            chunks += 1
+            kept_batches, rows = table.slice(chunksize).to_batches(), rows - chunksize
+    if rows or not chunks:
+        yield pa.Table.from_batches(kept_batches, schema=schema)
+
+
+def _read_csv_projected(body, chunksize, projection):
+    """Parses the projected columns of a CSV file with the Arrow CSV reader, block by block."""
+    schema = _arrow_schema(projection)
+    reader = pa_csv.open_csv(body, convert_options=pa_csv.ConvertOptions(
+        include_columns=schema.names, column_types=schema, strings_can_be_null=True))
+    tables = _kept_tables(reader, chunksize, schema, projection)
+    return tables if chunksize is not None else next(tables)
+
+
+def _read_parquet_projected(body, chunksize, projection):
+    """Reads only the projected columns of the Parquet file, cast to the schema types."""
+    schema = _arrow_schema(projection)
+    parquet_file = pq.ParquetFile(_spooled(body))
+    batches = (pa.Table.from_batches([batch]).select(schema.names).cast(schema)
+               for batch in parquet_file.iter_batches(batch_size=chunksize or 2 ** 16, columns=schema.names))
+    tables = _kept_tables(batches, chunksize, schema, projection)
+    return tables if chunksize is not None else next(tables)
+
+
+def _projected_frame(df: pd.DataFrame, projection: dict) -> pd.DataFrame:
+    """The projected columns and kept rows of a frame parsed by pandas, integer columns without nulls as int64."""
+    column_types = _column_types(projection)
+    df = df[list(column_types)]
+    rows = len(df.index)
+    mask = df[projection["not_null"]].notna().all(axis=1)
+    kept = rows_dropped("missing_values", rows, int(mask.sum()))
+    for name in projection["positive"]:
+        mask &= df[name] > 0
+    rows_dropped("unpriced", kept, int(mask.sum()))
+    df = df[mask]
+    integers = [name for name, dtype in column_types.items() if dtype == "int64" and not df[name].isna().any()]
+    return df.astype({name: "int64" for name in integers})
+
+
+def _read_json_lines_projected(body, chunksize, projection):
+    chunks = pd.read_json(body, lines=True, chunksize=chunksize or None, dtype=_column_types(projection))
+    if chunksize is None:
+        return _projected_frame(chunks, projection)
+    return (_projected_frame(chunk, projection) for chunk in chunks)
+
+
+def _read_json_projected(body, chunksize, projection):
+    # A JSON document is parsed at once, only the projected columns and kept rows are returned.
+    df = _projected_frame(pd.read_json(body, dtype=_column_types(projection)), projection)
+    return df if chunksize is None else iter([df])
+
+
+# Readers of the projected reader mode by file extension, the Arrow readers wherever they can parse the file.
+PROJECTED_READERS = {
+    "csv": _read_csv_projected,
+    "jsonl": _read_json_lines_projected,
+    "ndjson": _read_json_lines_projected,
+    "json": _read_json_projected,
+    "parquet": _read_parquet_projected,
+}
+
+
+def _decompressed(body, compression):
+    """The stream of the decompressed body, decompressed block by block as the reader consumes it."""
+    if compression is None:
+        return body
+    return pa.CompressedInputStream(pa.PythonFile(body, mode="r"), compression)
+
+
+def _read_body(body, file_ext, chunksize=None, projection=None, compression=None):
+    """
+    Feeds the S3 body stream straight into the parser, without reading and decoding the whole file first.
+    With chunksize, it returns an iterator of partial frames instead of a single frame.
+    With a projection, the projected reader returns the projected columns and kept rows, as frames or Arrow tables.
+    Readers get the decompressed stream of compressed files.
+    """
+    if file_ext not in READERS:
+        logger.error(f"{file_ext} file extension is not supported")
+        raise AirflowException(f" The {file_ext} file extension is not supported")
+    body = _decompressed(body, compression)
+    if projection is not None:
+        return PROJECTED_READERS[file_ext](body, chunksize, projection)
+    return READERS[file_ext](body, chunksize)
+
+
+def _s3_hook(aws_conn_id, max_workers=1):
+    return S3Hook(aws_conn_id=aws_conn_id, config=Config(max_pool_connections=max(max_workers, 10)))
+
+
+@instrumented
+def list_s3_objects(s3_hook, bucket, folder):
+    """
+    Lists the folder once, page by page, so very large folders don't need a single huge response.
+    It returns the key, ETag, size and last modification time of every object.
+    """
+    paginator = s3_hook.get_conn().get_paginator("list_objects_v2")
+    objects = []
+    for page in paginator.paginate(Bucket=bucket, Prefix=folder, PaginationConfig={"PageSize": 1000}):
+        for s3_object in page.get("Contents", []):
+            objects.append({
+                "key": s3_object["Key"],
+                "etag": s3_object["ETag"].strip('"'),
+                "size": s3_object["Size"],
+                "last_modified": s3_object["LastModified"].isoformat(),
+            })
+
+    if not objects:
+        raise ValueError("Files not found!")
+
+    logger.info(f"Listed {len(objects)} objects from {folder} folder in {bucket} bucket")
+    return objects
+
+
+def load_manifest(manifest_key, storage_config):
+    """
+    Loads the manifest of already processed objects (key, ETag, size, LastModified) and the LastModified watermark.
+    An empty manifest is returned on the first run.
+    """
+    return read_json(manifest_key, storage_config, default={"watermark": None, "objects": {}})
+
+
+def select_new_objects(objects, manifest, always_extract=()):
+    """
+    Keeps only the objects that are new or changed since the manifest was written.
+    Objects modified after the watermark are new without a lookup, older ones are compared by ETag and size.
+    Keys containing one of the always_extract parts, like the products dimension, are selected on every run.
+    """
+    watermark = manifest["watermark"]
+    processed = manifest["objects"]
+
+    def is_new(s3_object):
+        if any(part in s3_object["key"] for part in always_extract):
+            return True
+        if watermark is None or s3_object["last_modified"] > watermark:
+            return True
+        previous = processed.get(s3_object["key"])
+        return previous is None or (previous["etag"], previous["size"]) != (s3_object["etag"], s3_object["size"])
+
+    return [s3_object for s3_object in objects if is_new(s3_object)]
+
+
+def updated_manifest(objects, selected_objects, manifest):
+    """
+    Builds the manifest after the selected objects are processed.
+    Objects deleted from the bucket are dropped, so the manifest doesn't grow beyond the current listing.
+    """
+    selected_keys = {s3_object["key"] for s3_object in selected_objects}
+    processed = {}
+    for s3_object in objects:
+        if s3_object["key"] in selected_keys:
+            processed[s3_object["key"]] = {field: s3_object[field] for field in ("etag", "size", "last_modified")}
+        elif s3_object["key"] in manifest["objects"]:
+            processed[s3_object["key"]] = manifest["objects"][s3_object["key"]]
+
+    watermark = max([entry["last_modified"] for entry in processed.values()], default=manifest["watermark"])
+    return {"watermark": watermark, "objects": processed}
+
+
+def _matching_keys(objects, file_exts):
+    return [s3_object["key"] for s3_object in objects if file_extension(s3_object["key"]) in file_exts]
+
+
+def _file_projection(key, reader):
+    if reader not in ("inferred", "projected"):
+        raise ValueError(f"{reader} reader mode is not supported")
+    return file_projection(key) if reader == "projected" else None
+
+
+def _iter_file_chunks(s3_client, bucket, key, chunksize, reader="inferred"):
+    """Chunks of a file, data frames or, from the Arrow readers of Parquet and projected CSV files, Arrow tables."""
+    file_ext = file_extension(key)
+    projection = _file_projection(key, reader)
+
+    try:
+        body = s3_client.get_object(Bucket=bucket, Key=key)["Body"]
+        compression = file_compression(key)
+        if chunksize is None:
+            yield _read_body(body, file_ext, projection=projection, compression=compression)
+        else:
+            yield from _read_body(body, file_ext, chunksize=chunksize, projection=projection, compression=compression)
+    except Exception:
+        logger.exception(f"Can't load file {key} with file extension {file_ext}")
+        raise AirflowException(f"Can't load file {key} with file extension {file_ext}")
+
+    logger.info(f"Successfully loaded file {key} with {file_ext} from {bucket} bucket")
+
+
+def _as_frame(chunk) -> pd.DataFrame:
+    return chunk.to_pandas() if isinstance(chunk, pa.Table) else chunk
+
+
+def _read_file(s3_client, bucket, key, reader="inferred"):
+    [df] = _iter_file_chunks(s3_client, bucket, key, chunksize=None, reader=reader)
+    return _as_frame(df)
+
+
+def _run_concurrently(function, keys, max_workers):
+    """Downloads and parses the objects on a bounded thread pool. It returns the results keyed by object key."""
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="s3_extract") as executor:
+        return dict(zip(keys, executor.map(in_stage_context(function), keys)))
+
+
+def extract_files(bucket, folder, aws_conn_id, file_exts=None, max_workers=8, reader="inferred"):
+    """
+    A function that extracts and reads all files with the given extensions from Amazon S3 buckets.
+    It returns a dictionary with the file name as the key and
+     the data frame as the value for subsequent processing.
+    The projected reader parses only the entry schema columns and kept rows of the files, see PROJECTIONS.
+    """
+    s3_hook = _s3_hook(aws_conn_id, max_workers)
+    s3_client = s3_hook.get_conn()
+    keys = _matching_keys(list_s3_objects(s3_hook, bucket, folder), file_exts or READERS.keys())
+
+    dfs = _run_concurrently(lambda key: _read_file(s3_client, bucket, key, reader), keys, max_workers)
+    logger.info(f"Successfully loaded {len(dfs)} file/s from {folder} folder in {bucket} bucket")
+    return dfs
+
+
+def try_to_extract(bucket, folder, aws_conn_id, file_ext, reader="inferred"):
     """
     A function that extracts and reads files from Amazon S3 buckets.
-    It allows extension to other file formats.
     It returns a dictionary with the file name as the key and
      the data frame as the value for subsequent processing.
     """
-    s3_hook = S3Hook(aws_conn_id=aws_conn_id)
+    return extract_files(bucket=bucket, folder=folder, aws_conn_id=aws_conn_id, file_exts=[file_ext], reader=reader)
 
-    keys = s3_hook.list_keys(bucket_name=bucket, prefix=folder)
 
-    if not keys:
-        raise ValueError("Files not found!")
+def iter_extract_chunks(bucket, folder, aws_conn_id, file_ext, chunksize, reader="inferred"):
+    """
+    Streaming version of try_to_extract for files bigger than the worker memory.
+    It yields (file name, partial data frame) pairs of at most chunksize rows, so peak memory is about one chunk.
+    """
+    s3_hook = _s3_hook(aws_conn_id)
+    s3_client = s3_hook.get_conn()
+
+    for key in _matching_keys(list_s3_objects(s3_hook, bucket, folder), [file_ext]):
+        for chunk in _iter_file_chunks(s3_client, bucket, key, chunksize, reader):
+            yield key, _as_frame(chunk)
+
+
+@instrumented
+def extract_to_storage(bucket, folder, aws_conn_id, storage_config, key_prefix, file_exts=None, chunksize=None,
+                       max_workers=8, manifest_key="state/extraction_manifest.json", incremental=False,
+                       always_extract=(), cache_config=None, reader="inferred"):
+    """
+    Extracts the files and writes them to the intermediate storage chunk by chunk, several files at a time.
+    Without chunksize, every file is parsed at once and written as a single chunk.
+    In incremental mode only objects missing from the manifest, or changed since, are extracted.
+    It returns the intermediate storage references keyed by file name and the key of the updated manifest.
+    The updated manifest is pending until promoted at the end of a successful DAG run.
+    With an enabled cache_config, objects already extracted with the same ETag are not downloaded again.
+    The projected reader writes only the entry schema columns and the rows the transformation keeps.
+    """
+    s3_hook = _s3_hook(aws_conn_id, max_workers)
+    s3_client = s3_hook.get_conn()
+    objects = list_s3_objects(s3_hook, bucket, folder)
+
+    manifest = load_manifest(manifest_key, storage_config)
+    selected_objects = select_new_objects(objects, manifest, always_extract) if incremental else objects
+    keys = _matching_keys(selected_objects, file_exts or READERS.keys())
+    logger.info(f"Selected {len(keys)} of {len(objects)} objects, incremental mode: {incremental}")
 
-    dfs = {}
+    objects_by_key = {s3_object["key"]: s3_object for s3_object in selected_objects}
 
-    for key in keys:
-        """ If number of file formats expand, if/else statement can be replaced with dictionary(enums)"""
+    def extract_file(key):
+        with stage("extract_s3_data.extract_file", key=key) as record:
+            def write_chunks(folder):
+                chunks = _iter_file_chunks(s3_client, bucket, key, chunksize, reader)
+                return write_frame_chunks(chunks, f"{folder or key_prefix}/{key}", storage_config)
 
-        if not key.lower().endswith(f"{file_ext}"):
-            continue
+            s3_object = objects_by_key[key]
+            reference = cached("extract", {"bucket": bucket, "key": key, "etag": s3_object["etag"],
+                                           "size": s3_object["size"], "chunksize": chunksize,
+                                           "reader": reader},
+                               write_chunks, cache_config or {"enabled": False}, storage_config,
+                               settings={name: storage_config.get(name) for name in ("format", "compression")})
+            record["rows_out"] = reference["rows"]
+            return reference
 
-        s3_file = s3_hook.get_key(key=key, bucket_name=bucket)
-        file_content = s3_file.get()["Body"].read().decode("utf-8")
+    references = _run_concurrently(extract_file, keys, max_workers)
+    logger.info(f"Successfully extracted {len(references)} file/s from {folder} folder in {bucket} bucket")
 
-        try:
-            if file_ext == "csv":
-                df = pd.read_csv(io.StringIO(file_content))
-            elif file_ext == "json":
-                df = pd.read_json(io.StringIO(file_content))
-            else:
-                logger.error(f"{file_ext} file extension is not supported")
-                raise AirflowException(f" The {file_ext} file extension is not supported")
-        except Exception:
-            logger.exception(f"Can't load file {key} with file extension {file_ext}")
-            raise AirflowException(f"Can't load file {key} with file extension {file_ext}")
+    pending_manifest_key = f"{key_prefix}/{os.path.basename(manifest_key)}"
+    new_manifest = updated_manifest(objects, [o for o in selected_objects if o["key"] in references], manifest)
+    write_json(new_manifest, pending_manifest_key, storage_config)
 
-        dfs[key] = df
-        logger.info(f"Successfully loaded {len(dfs)} file/s with {file_ext} from {folder} folder in {bucket} bucket")
-        return dfs
+    return {"files": references, "manifest": pending_manifest_key}
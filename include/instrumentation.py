@@ -0,0 +1,250 @@
+"""
+Runtime metrics of the pipeline stages: wall and CPU time, rows in and out, rows dropped per filter, bytes read from
+and written to the intermediate storage, and peak RSS. Stages are named "<module>.<function>" for the wrapped
+functions (transform.sales_data_transformation, load.load_targets), "validate.<schema name>" for validations and
+"task.<task id>" for the Airflow tasks. Stages can be nested, bytes are counted in every enclosing stage.
+Metrics are emitted to the sinks configured in the instrumentation section of config.yaml.
+"""
+
+import contextlib
+import contextvars
+import functools
+import json
+import logging
+import socket
+import threading
+import time
+
+import pandas as pd
+import psutil
+import pyarrow as pa
+
+logger = logging.getLogger(__name__)
+
+# Instrumentation settings, set once per process with configure_instrumentation.
+instrumentation_policy = {
+    "enabled": True,
+    "sinks": ["log"],
+    "rss_sample_seconds": 0.01,
+    "statsd": {"host": "localhost", "port": 8125, "prefix": "etl"},
+}
+
+# Rows and bytes of a stage. xcom_bytes, the JSON size of a task return value, is only set for the tasks.
+COUNTED_METRICS = ["rows_in", "rows_out", "bytes_read", "bytes_written", "xcom_bytes"]
+
+_active_stages = contextvars.ContextVar("active_stages", default=())
+_bytes_lock = threading.Lock()
+
+
+def configure_instrumentation(policy: dict) -> None:
+    instrumentation_policy.update(policy)
+
+
+def _log_sink(record: dict) -> None:
+    logger.info(f"stage_metrics {json.dumps(record)}")
+
+
+def _statsd_sink(record: dict) -> None:
+    """Plain StatsD lines over UDP: timers in milliseconds, counters for rows and bytes, a gauge for the RSS."""
+    settings = instrumentation_policy["statsd"]
+    prefix = f"{settings['prefix']}.{record['stage']}"
+    lines = [f"{prefix}.wall_time:{record['wall_seconds'] * 1000:.1f}|ms",
+             f"{prefix}.cpu_time:{record['cpu_seconds'] * 1000:.1f}|ms",
+             f"{prefix}.peak_rss_mb:{record['peak_rss_mb']}|g"]
+    for metric in COUNTED_METRICS:
+        if record.get(metric) is not None:
+            lines.append(f"{prefix}.{metric}:{record[metric]}|c")
+    lines += [f"{prefix}.rows_dropped.{name}:{rows}|c" for name, rows in record["rows_dropped"].items()]
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as statsd_socket:
+        statsd_socket.sendto("\n".join(lines).encode("utf-8"), (settings["host"], settings["port"]))
+
+
+@functools.lru_cache(maxsize=None)
+def _otel_instrument(name: str):
+    from opentelemetry import metrics
+
+    return metrics.get_meter("etl_pipeline").create_histogram(f"etl.stage.{name}")
+
+
+def _opentelemetry_sink(record: dict) -> None:
+    """Histograms of the OpenTelemetry meter provider set up by the process, the stage is an attribute."""
+    attributes = {"stage": record["stage"], "status": record["status"], **record["tags"]}
+    for metric in ("wall_seconds", "cpu_seconds", "peak_rss_mb", *COUNTED_METRICS):
+        if record.get(metric) is not None:
+            _otel_instrument(metric).record(record[metric], attributes=attributes)
+    for name, rows in record["rows_dropped"].items():
+        _otel_instrument("rows_dropped").record(rows, attributes={**attributes, "filter": name})
+
+
+# Metric sinks by name, functions receiving the stage record.
+METRIC_SINKS = {
+    "log": _log_sink,
+    "statsd": _statsd_sink,
+    "opentelemetry": _opentelemetry_sink,
+}
+
+
+def _emit(record: dict) -> None:
+    for sink in instrumentation_policy["sinks"]:
+        if sink not in METRIC_SINKS:
+            raise ValueError(f"{sink} metric sink is not supported")
+        try:
+            METRIC_SINKS[sink](record)
+        except Exception:
+            # Metrics never fail a stage, like an unreachable StatsD agent, nor hide the error of a failed one.
+            logger.exception(f"Can't emit the metrics of {record['stage']} to the {sink} sink")
+
+
+def frame_rows(value):
+    """Rows of a data frame, Arrow table, intermediate storage reference, or of a list or dict of them."""
+    if isinstance(value, pd.DataFrame):
+        return len(value.index)
+    if isinstance(value, pa.Table):
+        return value.num_rows
+    if isinstance(value, dict) and "path" in value and "rows" in value:
+        return value["rows"]
+    values = value.values() if isinstance(value, dict) else value if isinstance(value, list) else []
+    rows = [frame_rows(item) for item in values]
+    rows = [row for row in rows if row is not None]
+    return sum(rows) if rows else None
+
+
+class PeakRss:
+    """
+    Samples the process RSS in a background thread and keeps the peak above the starting value, and the peak of
+    every window opened while it runs.
+    """
+
+    def __init__(self, sample_seconds=None):
+        self.sample_seconds = sample_seconds
+        self.process = psutil.Process()
+        self.windows = []
+        self.lock = threading.Lock()
+
+    def _rss(self):
+        return self.process.memory_info().rss
+
+    def _update(self, rss):
+        with self.lock:
+            self.peak = max(self.peak, rss)
+            for window in self.windows:
+                window["peak"] = max(window["peak"], rss)
+
+    def _sample(self):
+        while not self.running.wait(self.sample_seconds or instrumentation_policy["rss_sample_seconds"]):
+            self._update(self._rss())
+
+    def __enter__(self):
+        self.start = self.peak = self._rss()
+        self.running = threading.Event()
+        self.thread = threading.Thread(target=self._sample, daemon=True, name="rss_sampler")
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.running.set()
+        self.thread.join()
+        self._update(self._rss())
+
+    @property
+    def growth(self):
+        return self.peak - self.start
+
+    @contextlib.contextmanager
+    def window(self):
+        """The peak RSS of the code it wraps, sampled by the running thread."""
+        window = {"peak": self._rss()}
+        with self.lock:
+            self.windows.append(window)
+        try:
+            yield window
+        finally:
+            with self.lock:
+                self.windows = [opened for opened in self.windows if opened is not window]
+            window["peak"] = max(window["peak"], self._rss())
+
+
+_rss_sampler = contextvars.ContextVar("rss_sampler", default=None)
+
+
+@contextlib.contextmanager
+def _rss_window():
+    """Peak RSS window of a stage. The outermost stage of a task starts the sampler, nested stages share it."""
+    sampler = _rss_sampler.get()
+    if sampler is not None:
+        with sampler.window() as window:
+            yield window
+        return
+    with PeakRss() as sampler:
+        token = _rss_sampler.set(sampler)
+        try:
+            with sampler.window() as window:
+                yield window
+        finally:
+            _rss_sampler.reset(token)
+
+
+@contextlib.contextmanager
+def stage(name: str, rows_in=None, **tags):
+    """
+    Records the metrics of the code it wraps as a stage, and emits them when it ends, failed or not.
+    It yields the stage record, so rows_out can be set by the caller.
+    """
+    if not instrumentation_policy["enabled"]:
+        yield {"rows_dropped": {}, "tags": {}}
+        return
+
+    record = {"stage": name, "status": "ok", "rows_in": rows_in, "rows_out": None, "rows_dropped": {},
+              "bytes_read": 0, "bytes_written": 0, "tags": tags}
+    token = _active_stages.set(_active_stages.get() + (record,))
+    started, cpu_started = time.perf_counter(), time.process_time()
+    try:
+        with _rss_window() as rss:
+            yield record
+    except BaseException:
+        record["status"] = "error"
+        raise
+    finally:
+        _active_stages.reset(token)
+        record.update({"wall_seconds": round(time.perf_counter() - started, 4),
+                       "cpu_seconds": round(time.process_time() - cpu_started, 4),
+                       "peak_rss_mb": round(rss["peak"] / 2 ** 20, 1)})
+        _emit(record)
+
+
+def instrumented(function):
+    """Wraps a function in a stage named after its module and name, with the rows of its first argument and result."""
+    module = function.__module__.rsplit(".", 1)[-1]
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if not instrumentation_policy["enabled"]:
+            return function(*args, **kwargs)
+        with stage(f"{module}.{function.__name__}", rows_in=frame_rows(args[0]) if args else None) as record:
+            result = function(*args, **kwargs)
+            record["rows_out"] = frame_rows(result[0] if isinstance(result, tuple) else result)
+            return result
+    return wrapper
+
+
+def rows_dropped(filter_name: str, rows_before: int, frame) -> int:
+    """Records the rows a filter dropped in the running stage and returns the rows left, of the frame or given."""
+    rows_after = frame if isinstance(frame, int) else frame_rows(frame)
+    active_stages = _active_stages.get()
+    if active_stages:
+        dropped = active_stages[-1]["rows_dropped"]
+        dropped[filter_name] = dropped.get(filter_name, 0) + rows_before - rows_after
+    return rows_after
+
+
+def count_bytes(metric: str, size: int) -> None:
+    """Adds bytes read from or written to the intermediate storage to every running stage."""
+    with _bytes_lock:
+        for record in _active_stages.get():
+            record[metric] += size
+
+
+def in_stage_context(function):
+    """The function run within the stages of the caller, for functions submitted to a thread pool."""
+    context = contextvars.copy_context()
+    return lambda *args: context.copy().run(function, *args)
@@ -0,0 +1,280 @@
+import itertools
+import json
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.feather as feather
+import pyarrow.parquet as pq
+from pyarrow import fs
+
+from include.instrumentation import count_bytes
+
+logger = logging.getLogger(__name__)
+
+
+def _local_filesystem(storage_config):
+    return fs.LocalFileSystem()
+
+
+def _local_root(storage_config):
+    return storage_config["path"].rstrip("/")
+
+
+def _s3_filesystem(storage_config):
+    """S3 filesystem built from the Airflow AWS connection, so Parquet footers and columns are read with range requests."""
+    from airflow.providers.amazon.aws.hooks.s3 import S3Hook
+
+    s3_hook = S3Hook(aws_conn_id=storage_config["aws_conn_id"])
+    credentials = s3_hook.get_credentials()
+    return fs.S3FileSystem(
+        access_key=credentials.access_key,
+        secret_key=credentials.secret_key,
+        session_token=credentials.token,
+        region=s3_hook.conn_region_name,
+        endpoint_override=s3_hook.conn_config.endpoint_url,
+    )
+
+
+def _s3_root(storage_config):
+    return f"{storage_config['bucket']}/{storage_config['s3_prefix'].strip('/')}"
+
+
+# Intermediate storage backends by name: the pyarrow filesystem and the root path of the configured location.
+STORAGE_BACKENDS = {
+    "local": (_local_filesystem, _local_root),
+    "s3": (_s3_filesystem, _s3_root),
+}
+
+
+def _backend(storage_config):
+    backend = storage_config["backend"]
+    if backend not in STORAGE_BACKENDS:
+        raise ValueError(f"{backend} intermediate storage backend is not supported")
+    return STORAGE_BACKENDS[backend]
+
+
+def _storage_path(storage_config, key):
+    filesystem_factory, root_path = _backend(storage_config)
+    return filesystem_factory(storage_config), f"{root_path(storage_config)}/{key}"
+
+
+def write_bytes(data: bytes, key: str, storage_config: dict) -> None:
+    """Writes small state objects, like manifests, next to the intermediate frames."""
+    filesystem, path = _storage_path(storage_config, key)
+    filesystem.create_dir(os.path.dirname(path), recursive=True)
+    with filesystem.open_output_stream(path) as sink:
+        sink.write(data)
+    count_bytes("bytes_written", len(data))
+
+
+def read_bytes(key: str, storage_config: dict):
+    """Reads a state object written by write_bytes. It returns None when the object doesn't exist yet."""
+    filesystem, path = _storage_path(storage_config, key)
+    if filesystem.get_file_info(path).type == fs.FileType.NotFound:
+        return None
+    with filesystem.open_input_stream(path) as source:
+        data = source.read()
+    count_bytes("bytes_read", len(data))
+    return data
+
+
+def write_json(data, key: str, storage_config: dict) -> None:
+    """Writes a JSON state object, like the extraction manifest."""
+    write_bytes(json.dumps(data).encode("utf-8"), key, storage_config)
+
+
+def read_json(key: str, storage_config: dict, default=None):
+    """Reads a JSON state object. It returns default when the object doesn't exist yet."""
+    data = read_bytes(key, storage_config)
+    return default if data is None else json.loads(data)
+
+
+def read_array(key: str, storage_config: dict, dtype) -> np.ndarray:
+    """
+    Reads a flat array written with write_bytes. Local arrays are memory-mapped read-only,
+    so searching them only reads the pages touched.
+    """
+    filesystem, path = _storage_path(storage_config, key)
+    if storage_config["backend"] == "local":
+        return np.memmap(path, dtype=dtype, mode="r")
+    return np.frombuffer(read_bytes(key, storage_config), dtype=dtype)
+
+
+def delete(key: str, storage_config: dict) -> None:
+    """Deletes a state object replaced by a newer one, if it still exists."""
+    filesystem, path = _storage_path(storage_config, key)
+    if filesystem.get_file_info(path).type != fs.FileType.NotFound:
+        filesystem.delete_file(path)
+
+
+def list_files(prefix: str, storage_config: dict) -> list:
+    """Files under a prefix, with their key relative to the prefix, size and modification time in seconds."""
+    filesystem, path = _storage_path(storage_config, prefix)
+    selector = fs.FileSelector(path, recursive=True, allow_not_found=True)
+    return [{"key": os.path.relpath(info.path, path), "bytes": info.size, "modified": info.mtime.timestamp()}
+            for info in filesystem.get_file_info(selector) if info.type == fs.FileType.File]
+
+
+def delete_folder(prefix: str, storage_config: dict) -> None:
+    filesystem, path = _storage_path(storage_config, prefix)
+    if filesystem.get_file_info(path).type != fs.FileType.NotFound:
+        filesystem.delete_dir(path)
+
+
+def promote(pending_key: str, key: str, storage_config: dict) -> None:
+    """Replaces a state object with the pending version written during the DAG run, once the run succeeded."""
+    filesystem, pending_path = _storage_path(storage_config, pending_key)
+    _, path = _storage_path(storage_config, key)
+    filesystem.create_dir(os.path.dirname(path), recursive=True)
+    filesystem.copy_file(pending_path, path)
+    logger.info(f"Promoted {pending_path} to {path}")
+
+
+def _write_parquet(schema, tables, path, filesystem, compression):
+    with pq.ParquetWriter(path, schema, filesystem=filesystem, compression=compression) as writer:
+        for table in tables:
+            writer.write_table(table)
+
+
+def _read_parquet(path, filesystem, columns):
+    return pq.read_table(path, filesystem=filesystem, columns=columns)
+
+
+def _write_arrow(schema, tables, path, filesystem, compression):
+    options = pa.ipc.IpcWriteOptions(compression=compression)
+    with filesystem.open_output_stream(path) as sink, pa.ipc.new_file(sink, schema, options=options) as writer:
+        for table in tables:
+            writer.write_table(table)
+
+
+def _read_arrow(path, filesystem, columns):
+    with filesystem.open_input_file(path) as source:
+        return feather.read_table(source, columns=columns, memory_map=False)
+
+
+FRAME_FORMATS = {
+    "parquet": (_write_parquet, _read_parquet),
+    "arrow": (_write_arrow, _read_arrow),
+}
+
+
+def _chunk_schema(schema: pa.Schema, table: pa.Table, key: str) -> pa.Schema:
+    """The column types of the chunks so far widened to hold the table, like int64 to double or null to string."""
+    try:
+        return pa.unify_schemas([schema, table.schema], promote_options="permissive")
+    except (pa.ArrowInvalid, pa.ArrowTypeError) as e:
+        raise ValueError(f"Chunk of {key} doesn't match the column types of the earlier chunks: {e}")
+
+
+def write_frame_chunks(chunks, key: str, storage_config: dict) -> dict:
+    """
+    Writes data frame (or Arrow table) chunks one after another into a single file of the intermediate storage.
+    Only one chunk is held in memory at a time. The column types are those of the first chunk, widened when a
+    later chunk needs it, like whole numbers followed by decimals or a column only null in the first chunk: the
+    chunks already written are then copied, batch by batch, into a file of the wider types.
+    It returns a small reference, that is passed through XCom instead of the data itself.
+    """
+    file_format = storage_config.get("format", "parquet")
+    if file_format not in FRAME_FORMATS:
+        raise ValueError(f"{file_format} intermediate file format is not supported")
+
+    tables = (chunk if isinstance(chunk, pa.Table) else pa.Table.from_pandas(chunk, preserve_index=False)
+              for chunk in chunks)
+    first_table = next(tables, None)
+    if first_table is None:
+        raise ValueError(f"No data to store for {key}")
+    schema = first_table.schema
+    rows = 0
+    widening_table = None
+
+    def cast_tables(source):
+        nonlocal rows, widening_table
+        for table in source:
+            if not table.schema.equals(schema):
+                if not _chunk_schema(schema, table, key).equals(schema):
+                    widening_table = table
+                    return
+                try:
+                    table = table.cast(schema)
+                except (pa.ArrowInvalid, pa.ArrowNotImplementedError) as e:
+                    raise ValueError(f"Chunk of {key} doesn't match the column types of the earlier chunks: {e}")
+            rows += table.num_rows
+            yield table
+
+    filesystem, target_path = _storage_path(storage_config, f"{key}.{file_format}")
+    filesystem.create_dir(os.path.dirname(target_path), recursive=True)
+    writer, _ = FRAME_FORMATS[file_format]
+    compression = storage_config.get("compression", "zstd")
+
+    path, widenings = target_path, 0
+    writer(schema, cast_tables(itertools.chain([first_table], tables)), path, filesystem, compression)
+    while widening_table is not None:
+        schema, widenings = _chunk_schema(schema, widening_table, key), widenings + 1
+        logger.info(f"Widening the column types of {key} to {schema}")
+        written_path, path = path, f"{target_path}.widened{widenings}"
+        written = ds.dataset(written_path, filesystem=filesystem,
+                             format="ipc" if file_format == "arrow" else file_format)
+        copied = (pa.Table.from_batches([batch]).cast(schema) for batch in written.to_batches())
+        widening_table, remaining = None, itertools.chain([widening_table], tables)
+        writer(schema, itertools.chain(copied, cast_tables(remaining)), path, filesystem, compression)
+        filesystem.delete_file(written_path)
+    if path != target_path:
+        filesystem.move(path, target_path)
+        path = target_path
+
+    size = filesystem.get_file_info(path).size
+    count_bytes("bytes_written", size)
+    logger.info(f"Stored {rows} rows in {path}")
+    reference = {
+        "backend": storage_config["backend"],
+        "path": path,
+        "format": file_format,
+        "rows": rows,
+        "columns": schema.names,
+        "bytes": size,
+    }
+    if storage_config["backend"] == "s3":
+        reference["aws_conn_id"] = storage_config["aws_conn_id"]
+    return reference
+
+
+def write_frame(df: pd.DataFrame, key: str, storage_config: dict) -> dict:
+    """Writes a data frame to the intermediate storage in a columnar format and returns its reference."""
+    return write_frame_chunks([df], key, storage_config)
+
+
+def read_table(reference: dict, columns=None) -> pa.Table:
+    """Reads back a frame written by write_frame as an Arrow table, for the Arrow transform backend."""
+    filesystem_factory, _ = _backend(reference)
+    filesystem = filesystem_factory(reference)
+    _, reader = FRAME_FORMATS[reference["format"]]
+    # The size of the whole file, the bytes of a subset of columns are not known up front.
+    count_bytes("bytes_read", reference.get("bytes", 0))
+    return reader(reference["path"], filesystem, columns)
+
+
+def read_tables(references: list, columns=None) -> pa.Table:
+    return pa.concat_tables([read_table(reference, columns=columns) for reference in references])
+
+
+def iter_batches(reference: dict, columns=None, batch_rows: int = 1_000_000):
+    """Scans a stored frame record batch by record batch, so it never has to fit in memory at once."""
+    filesystem_factory, _ = _backend(reference)
+    dataset = ds.dataset(reference["path"], filesystem=filesystem_factory(reference),
+                         format="ipc" if reference["format"] == "arrow" else reference["format"])
+    count_bytes("bytes_read", reference.get("bytes", 0))
+    yield from dataset.to_batches(columns=columns, batch_size=batch_rows)
+
+
+def read_frame(reference: dict, columns=None) -> pd.DataFrame:
+    """Reads back a data frame written by write_frame, optionally only with the columns needed by the caller."""
+    return read_table(reference, columns=columns).to_pandas()
+
+
+def read_frames(references: list, columns=None) -> pd.DataFrame:
+    """Reads back and concatenates several frames, e.g. all the sales files extracted from the bucket."""
+    return pd.concat([read_frame(reference, columns=columns) for reference in references], ignore_index=True)
@@ -1,23 +1,283 @@
+import functools
+import logging
+import os
+import tempfile
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import sqlalchemy
 
 from airflow.providers.snowflake.hooks.snowflake import SnowflakeHook
 
+from include.instrumentation import in_stage_context, instrumented, rows_dropped, stage
+from include.intermediate_storage import read_frames
 
-def data_loading_in_snowflake(df: pd.DataFrame, database: str, schema: str, table: str) -> None:
-    """After completing the analytical tasks, we load the obtained data into Snowflake."""
+logger = logging.getLogger(__name__)
 
-    if len(df.index) == 0:
-        raise ValueError("This Data Frame is empty")
+# Bind parameters per multi-row INSERT statement, under the driver limits (32766 for SQLite).
+INSERT_PARAMETERS = 16_000
+
+
+def write_parquet_files(df: pd.DataFrame, directory: str, max_rows_per_file: int) -> list:
+    """
+    Splits the data frame into compressed Parquet files of at most max_rows_per_file rows.
+    Snowflake loads several mid-sized files in parallel, much faster than one big file.
+    """
+    paths = []
+    for part, start in enumerate(range(0, len(df.index), max_rows_per_file)):
+        table = pa.Table.from_pandas(df.iloc[start:start + max_rows_per_file], preserve_index=False)
+        path = os.path.join(directory, f"part_{part:05d}.parquet")
+        pq.write_table(table, path, compression="snappy", coerce_timestamps="us", allow_truncated_timestamps=True)
+        paths.append(path)
+    return paths
+
+
+def stage_and_copy(cursor, paths: list, schema: str, table: str) -> None:
+    """Uploads the Parquet files to the table stage with PUT and ingests them with a single COPY INTO."""
+    stage = f"@{schema}.%{table}/load_{uuid.uuid4().hex}"
+
+    for path in paths:
+        cursor.execute(f"PUT 'file://{path}' '{stage}' AUTO_COMPRESS = FALSE PARALLEL = 4")
+
+    cursor.execute(
+        f"COPY INTO {schema}.{table} FROM '{stage}' "
+        f"FILE_FORMAT = (TYPE = PARQUET USE_LOGICAL_TYPE = TRUE) "
+        f"MATCH_BY_COLUMN_NAME = CASE_INSENSITIVE PURGE = TRUE"
+    )
+
+
+@instrumented
+def bulk_load(df: pd.DataFrame, connection, schema: str, table: str, max_rows_per_file: int) -> None:
+    """Replaces the table with the frame content through the stage, instead of INSERT ... VALUES statements."""
+    df.head(0).to_sql(name=table, con=connection, schema=schema, index=False, if_exists="replace")
 
-    snowflake_hook = SnowflakeHook(snowflake_conn_id="my_snowflake_conn")
-    engine = snowflake_hook.get_sqlalchemy_engine()
+    with tempfile.TemporaryDirectory(prefix=f"{table}_") as directory:
+        paths = write_parquet_files(df, directory, max_rows_per_file)
+        logger.info(f"Bulk loading {len(df.index)} rows in {len(paths)} file/s into {schema}.{table}")
+        stage_and_copy(connection.connection.cursor(), paths, schema, table)
 
-    # with engine.begin() as conn:
+
+@instrumented
+def insert_load(df: pd.DataFrame, connection, schema: str, table: str) -> None:
+    """Replaces the table with the frame content with batched INSERT statements, fast enough for small frames."""
+    logger.info(f"Inserting {len(df.index)} rows into {schema}.{table}")
     df.to_sql(
         name=table,
-        con=engine,
+        con=connection,
         schema=schema,
         index=False,
         if_exists="replace",
-        method="multi"
+        method="multi",
+        chunksize=max(INSERT_PARAMETERS // max(len(df.columns), 1), 1),
     )
+
+
+@functools.lru_cache(maxsize=None)
+def snowflake_engine(snowflake_conn_id: str, pool_size: int = 5):
+    """
+    One pooled engine per worker process and connection id.
+    All the loads of the process reuse its connections, instead of a new handshake and warehouse resume per table.
+    """
+    snowflake_hook = SnowflakeHook(snowflake_conn_id=snowflake_conn_id)
+    return snowflake_hook.get_sqlalchemy_engine(engine_kwargs={"pool_size": pool_size, "pool_pre_ping": True})
+
+
+def _load_frame(df: pd.DataFrame, connection, schema: str, table: str, bulk_load_min_rows: int,
+                max_rows_per_file: int) -> None:
+    if len(df.index) == 0:
+        raise ValueError("This Data Frame is empty")
+
+    if len(df.index) >= bulk_load_min_rows:
+        bulk_load(df, connection, schema, table, max_rows_per_file)
+    else:
+        insert_load(df, connection, schema, table)
+
+
+def data_loading_in_snowflake(df: pd.DataFrame, database: str, schema: str, table: str,
+                              snowflake_conn_id: str = "my_snowflake_conn", bulk_load_min_rows: int = 100_000,
+                              max_rows_per_file: int = 1_000_000) -> None:
+    """
+    After completing the analytical tasks, we load the obtained data into Snowflake.
+    Frames with at least bulk_load_min_rows rows are staged as Parquet files and copied, smaller ones are inserted.
+    """
+    with snowflake_engine(snowflake_conn_id).begin() as connection:
+        _load_frame(df, connection, schema, table, bulk_load_min_rows, max_rows_per_file)
+
+
+def prepare_statements(dialect, schema: str, table: str, staging_table: str, keys: list = None) -> list:
+    """Statements creating the target table like its staging table when it doesn't exist yet."""
+    quote = dialect.identifier_preparer.quote
+    target, staging = f"{quote(schema)}.{quote(table)}", f"{quote(schema)}.{quote(staging_table)}"
+    if dialect.name == "snowflake":
+        return [f"CREATE TABLE IF NOT EXISTS {target} LIKE {staging}"]
+    statements = [f"CREATE TABLE IF NOT EXISTS {target} AS SELECT * FROM {staging} WHERE 0"]
+    if keys:
+        # The conflict target of INSERT ... ON CONFLICT, Snowflake's MERGE needs none.
+        key_list = ", ".join(quote(key) for key in keys)
+        statements.append(f"CREATE UNIQUE INDEX IF NOT EXISTS {quote(schema)}.{quote(f'ux_{table}')} "
+                          f"ON {quote(table)} ({key_list})")
+    return statements
+
+
+def replace_statements(dialect, schema: str, table: str, staging_table: str, columns: list) -> list:
+    """Statements replacing the rows of the target table with those of its fully loaded staging table."""
+    quote = dialect.identifier_preparer.quote
+    target, staging = f"{quote(schema)}.{quote(table)}", f"{quote(schema)}.{quote(staging_table)}"
+    column_list = ", ".join(quote(column) for column in columns)
+    return [f"DELETE FROM {target}",
+            f"INSERT INTO {target} ({column_list}) SELECT {column_list} FROM {staging}"]
+
+
+def merge_statements(dialect, schema: str, table: str, staging_table: str, columns: list, keys: list) -> list:
+    """
+    Statements merging the staged batch into the target table on the business keys.
+    Matched rows are updated, new rows are inserted and the rest of the target stays untouched.
+    Snowflake gets a MERGE INTO, other databases (SQLite in tests) an INSERT ... ON CONFLICT DO UPDATE.
+    """
+    quote = dialect.identifier_preparer.quote
+    target, staging = f"{quote(schema)}.{quote(table)}", f"{quote(schema)}.{quote(staging_table)}"
+    column_list = ", ".join(quote(column) for column in columns)
+    updated_columns = [column for column in columns if column not in keys]
+
+    if dialect.name == "snowflake":
+        on = " AND ".join(f"target.{quote(key)} = source.{quote(key)}" for key in keys)
+        update = ", ".join(f"target.{quote(column)} = source.{quote(column)}" for column in updated_columns)
+        values = ", ".join(f"source.{quote(column)}" for column in columns)
+        when_matched = f"WHEN MATCHED THEN UPDATE SET {update} " if updated_columns else ""
+        return [f"MERGE INTO {target} AS target USING {staging} AS source ON {on} "
+                f"{when_matched}WHEN NOT MATCHED THEN INSERT ({column_list}) VALUES ({values})"]
+
+    key_list = ", ".join(quote(key) for key in keys)
+    update = ", ".join(f"{quote(column)} = excluded.{quote(column)}" for column in updated_columns)
+    on_conflict = f"DO UPDATE SET {update}" if updated_columns else "DO NOTHING"
+    return [f"INSERT INTO {target} ({column_list}) SELECT {column_list} FROM {staging} WHERE true "
+            f"ON CONFLICT ({key_list}) {on_conflict}"]
+
+
+def swap_statements(dialect, schema: str, table: str, staging_table: str) -> list:
+    """Statements replacing the target table with its fully loaded staging table, columns and types included."""
+    quote = dialect.identifier_preparer.quote
+    target, staging = f"{quote(schema)}.{quote(table)}", f"{quote(schema)}.{quote(staging_table)}"
+    if dialect.name == "snowflake":
+        # The staging table, holding the previous target after the swap, is dropped with the others.
+        return [f"ALTER TABLE {target} SWAP WITH {staging}"]
+    return [f"DROP TABLE {target}", f"ALTER TABLE {staging} RENAME TO {quote(table)}"]
+
+
+def _layout(connection, schema: str, table: str) -> list:
+    return [(column["name"], str(column["type"]))
+            for column in sqlalchemy.inspect(connection).get_columns(table, schema=schema)]
+
+
+def _publish(engine, targets: list, columns: dict) -> None:
+    """
+    Publishes the loaded staging tables of the targets into them in four steps: the missing targets are created,
+    then the rows of every target are replaced or merged in a single transaction, the replaced targets whose
+    columns or types changed, like the status columns of sales_status, are swapped with their staging table, and
+    the staging tables are dropped. Snowflake commits every DDL statement on its own, so the transaction holds DML
+    statements only: the targets keeping their layout are all published or, on a failure, all left as they were.
+    The swaps follow once they are published, a failure there leaves the swapped targets published only.
+    """
+    def upsert(target):
+        return target.get("load_mode", "replace") == "upsert"
+
+    with engine.begin() as connection:
+        inspector = sqlalchemy.inspect(connection)
+        swapped = [target for target in targets
+                   if not upsert(target) and inspector.has_table(target["table"], schema=target["schema"])
+                   and _layout(connection, target["schema"], target["table"])
+                   != _layout(connection, target["schema"], f"{target['table']}__staging")]
+        for target in targets:
+            for statement in prepare_statements(connection.dialect, target["schema"], target["table"],
+                                                f"{target['table']}__staging",
+                                                target["merge_keys"] if upsert(target) else None):
+                connection.exec_driver_sql(statement)
+
+    with engine.begin() as connection:
+        for target in targets:
+            if target in swapped:
+                continue
+            staging_table = f"{target['table']}__staging"
+            if upsert(target):
+                statements = merge_statements(connection.dialect, target["schema"], target["table"], staging_table,
+                                              columns[target["table"]], target["merge_keys"])
+            else:
+                statements = replace_statements(connection.dialect, target["schema"], target["table"],
+                                                staging_table, columns[target["table"]])
+            with stage("load.publish", table=target["table"]):
+                for statement in statements:
+                    connection.exec_driver_sql(statement)
+
+    for target in swapped:
+        logger.info(f"Columns of {target['schema']}.{target['table']} changed, swapping it with its staging table")
+        with engine.begin() as connection, stage("load.publish", table=target["table"]):
+            for statement in swap_statements(connection.dialect, target["schema"], target["table"],
+                                             f"{target['table']}__staging"):
+                connection.exec_driver_sql(statement)
+
+    with engine.begin() as connection:
+        quote = connection.dialect.identifier_preparer.quote
+        for target in targets:
+            connection.exec_driver_sql(
+                f"DROP TABLE IF EXISTS {quote(target['schema'])}.{quote(target['table'] + '__staging')}")
+
+
+@instrumented
+def load_targets(targets: list, engine, max_workers: int = 4, all_or_nothing: bool = False,
+                 bulk_load_min_rows: int = 100_000, max_rows_per_file: int = 1_000_000) -> list:
+    """
+    Loads a batch of targets, each a dict with the frame reference (or list of references), schema and table.
+    Targets with load_mode "upsert" are merged on their merge_keys, the others are replaced.
+    The targets are loaded concurrently over the pooled connections of the engine.
+    With all_or_nothing, every frame is loaded into a staging table first and the targets are replaced or merged
+    in a single transaction only after all of them loaded, so a failure, loading or publishing, leaves the
+    published tables untouched.
+    An upsert target without rows is left as it is, empty frames of the other targets fail the load.
+    It returns the loaded rows and seconds per table.
+    """
+    columns, unchanged = {}, set()
+
+    def load_target(target):
+        with stage("load.load_target", table=target["table"]) as record:
+            started = time.perf_counter()
+            references = target["reference"] if isinstance(target["reference"], list) else [target["reference"]]
+            df = read_frames(references)
+            record["rows_in"] = len(df.index)
+            upsert = target.get("load_mode", "replace") == "upsert"
+            if upsert:
+                # A batch with repeated keys would match a target row several times.
+                df = df.drop_duplicates(subset=target["merge_keys"], keep="last")
+                rows_dropped("duplicate_keys", record["rows_in"], df)
+            columns[target["table"]] = list(df.columns)
+
+            if upsert and df.empty:
+                # Nothing to merge, like the sales of an incremental run whose rows were all loaded by earlier runs.
+                unchanged.add(target["table"])
+            else:
+                staged = all_or_nothing or upsert
+                table = f"{target['table']}__staging" if staged else target["table"]
+                with engine.begin() as connection:
+                    _load_frame(df, connection, target["schema"], table, bulk_load_min_rows, max_rows_per_file)
+                if upsert and not all_or_nothing:
+                    _publish(engine, [target], columns)
+
+            record["rows_out"] = len(df.index)
+            report = {"schema": target["schema"], "table": target["table"], "rows": len(df.index),
+                      "seconds": round(time.perf_counter() - started, 3)}
+            logger.info(f"Loaded {report['rows']} rows into {report['schema']}.{report['table']} "
+                        f"in {report['seconds']} seconds")
+            return report
+
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="snowflake_load") as executor:
+        reports = list(executor.map(in_stage_context(load_target), targets))
+
+    if all_or_nothing:
+        published = [target for target in targets if target["table"] not in unchanged]
+        _publish(engine, published, columns)
+        logger.info(f"Published {len(published)} tables")
+
+    return reports
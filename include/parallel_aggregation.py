@@ -0,0 +1,131 @@
+"""
+Groupbys over factorized keys on a process pool, for the partial aggregates of the fused and incremental analytics.
+The key codes and the aggregated columns are copied once into a shared memory block, and the workers get only its
+name and layout, no column is pickled. Every worker aggregates the groups of its hash partition, the groups whose
+combined key code modulo the number of workers is its index. A group is aggregated by a single worker over its rows
+in the frame order, so the results are identical to the serial groupby, the partitions are only concatenated and
+sorted. Workers are forked by a fork server, preloaded with this module, where the platform allows it, so they start
+without importing pandas again and without the locks held by the threads of the task process.
+"""
+
+import itertools
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+# Rows a worker must get at least to pay for its start, smaller frames are aggregated by fewer workers.
+MIN_ROWS_PER_WORKER = 250_000
+
+
+def grouped_codes(codes: dict, values: dict, aggregations: dict) -> pd.DataFrame:
+    """
+    Groups the values by factorized key codes with named aggregations. Like groupby, rows with a missing key
+    (code -1) are dropped and the groups are sorted by key.
+    """
+    codes_df = pd.DataFrame(codes | values)
+    codes_df = codes_df[(codes_df[list(codes)] >= 0).all(axis=1)]
+    return codes_df.groupby(list(codes), sort=True).agg(**aggregations).reset_index()
+
+
+def _shared_arrays(arrays: dict):
+    """Copies the arrays into one shared memory block. It returns the block and the dtype and offset of every array."""
+    layout, offset = {}, 0
+    for name, array in arrays.items():
+        layout[name] = {"dtype": array.dtype.str, "offset": offset, "length": len(array)}
+        # Offsets aligned on 8 bytes, for the widest numeric types.
+        offset += -(-array.nbytes // 8) * 8
+    block = shared_memory.SharedMemory(create=True, size=max(offset, 1))
+    for name, array in arrays.items():
+        _view(block, layout[name])[:] = array
+    return block, layout
+
+
+def _view(block, array_layout: dict) -> np.ndarray:
+    return np.ndarray(array_layout["length"], dtype=np.dtype(array_layout["dtype"]), buffer=block.buf,
+                      offset=array_layout["offset"])
+
+
+def _in_partition(arrays: dict, keys: list, key_sizes: dict, partition: int, workers: int) -> np.ndarray:
+    """
+    Mask of the rows of the partition, by the code of their group in the product of the key codes. Groups are
+    dense codes, so a lookup of the partition of every group replaces a modulo per row. Rows with a missing key
+    wrap to any partition, grouped_codes drops them.
+    """
+    combined = arrays[keys[0]].astype("int64")
+    for key in keys[1:]:
+        combined *= key_sizes[key]
+        combined += arrays[key]
+    groups = int(np.prod([key_sizes[key] for key in keys]))
+    return (np.arange(groups) % workers == partition).take(combined, mode="wrap")
+
+
+def _aggregate_partition(block_name: str, layout: dict, key_sizes: dict, aggregations: dict, partition: int,
+                         workers: int) -> dict:
+    """Worker: the grouped codes of every aggregation, for the groups of its partition."""
+    block = shared_memory.SharedMemory(name=block_name)
+    arrays = {name: _view(block, array_layout) for name, array_layout in layout.items()}
+    try:
+        results = {}
+        for name, (keys, named_aggregations) in aggregations.items():
+            # Positions taken from every column, instead of a boolean mask scanned once per column.
+            rows = np.flatnonzero(_in_partition(arrays, keys, key_sizes, partition, workers))
+            columns = dict.fromkeys(column for column, _ in named_aggregations.values())
+            results[name] = grouped_codes({key: arrays[key].take(rows) for key in keys},
+                                          {column: arrays[column].take(rows) for column in columns},
+                                          named_aggregations)
+        return results
+    finally:
+        # The views must be released before the block is closed, the results are copies.
+        arrays.clear()
+        block.close()
+
+
+def _concatenated(frames: list, keys: list) -> pd.DataFrame:
+    # Partitions without a group may get other column types, the groups of the others are enough.
+    frames = [frame for frame in frames if len(frame.index)] or frames[:1]
+    return pd.concat(frames, ignore_index=True).sort_values(keys, ignore_index=True)
+
+
+def effective_workers(rows: int, workers: int) -> int:
+    return max(min(workers, rows // MIN_ROWS_PER_WORKER), 1)
+
+
+def _pool_context():
+    """
+    Workers are never forked from the task process: a lock held by one of its threads, like the RSS sampler of the
+    instrumentation, would stay locked in the child forever. The fork server is a fresh process, started once.
+    """
+    if "forkserver" not in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("spawn")
+    context = multiprocessing.get_context("forkserver")
+    context.set_forkserver_preload([__name__])
+    return context
+
+
+def parallel_grouped_codes(codes: dict, key_sizes: dict, values: dict, aggregations: dict, workers: int) -> dict:
+    """
+    grouped_codes of several aggregations, {name: (keys, named aggregations)}, over the same rows on a pool of
+    worker processes. key_sizes holds the number of distinct values of every key. It returns the grouped codes
+    keyed by aggregation name, identical to grouped_codes.
+    """
+    # Codes in the smallest width holding them, the block is a copy of every key and aggregated column.
+    codes = {name: key_codes.astype(np.promote_types(np.min_scalar_type(-key_sizes[name]), np.int8))
+             for name, key_codes in codes.items()}
+    block, layout = _shared_arrays({**codes, **values})
+    try:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=_pool_context()) as pool:
+            partitions = list(pool.map(_aggregate_partition, itertools.repeat(block.name), itertools.repeat(layout),
+                                       itertools.repeat(key_sizes), itertools.repeat(aggregations), range(workers),
+                                       itertools.repeat(workers)))
+    finally:
+        block.close()
+        block.unlink()
+    logger.info(f"Aggregated {len(aggregations)} groupbys in {workers} partitions")
+    return {name: _concatenated([partition[name] for partition in partitions], keys)
+            for name, (keys, _) in aggregations.items()}
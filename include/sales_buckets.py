@@ -0,0 +1,221 @@
+"""
+Data-driven sales_bucket boundaries. The total_sales of every loaded batch are summarized in a mergeable quantile
+sketch (KLL): levels of sorted values, where a value of level h stands for 2 ** h sales. A full level is compacted by
+promoting every other value to the level above, so the sketch keeps a few hundred values whatever the history size,
+and the rank error of its quantiles is about 1% with the default size of 200.
+The boundaries of a period are computed once from the committed sketch, then frozen, so reruns bucket the same way.
+For the incremental analytics they are frozen with the sketch instead, across periods, and only computed again by
+full refresh runs. Batch sketches are pending until the run is committed, like the deduplication fingerprints.
+"""
+
+import logging
+
+import numpy as np
+
+from include.intermediate_storage import read_json, write_json
+
+logger = logging.getLogger(__name__)
+
+# Capacity of a level relative to the level above, the top level holds sketch_size values.
+LEVEL_CAPACITY_RATIO = 2 / 3
+MIN_LEVEL_CAPACITY = 8
+
+
+def new_sketch(size: int) -> dict:
+    return {"size": size, "count": 0, "min": None, "max": None, "levels": [], "compactions": []}
+
+
+def _level_capacity(sketch: dict, level: int) -> int:
+    depth = len(sketch["levels"]) - 1 - level
+    return max(int(np.ceil(sketch["size"] * LEVEL_CAPACITY_RATIO ** depth)), MIN_LEVEL_CAPACITY)
+
+
+def _compact(sketch: dict) -> dict:
+    """
+    Compacts the levels over their capacity, from the bottom. Levels are kept sorted, so a compaction is a strided
+    slice and merging the promoted values into the level above a merge of two sorted runs.
+    The slice offset alternates per level, which keeps the sketch deterministic and its rank errors balanced.
+    """
+    levels, compactions = sketch["levels"], sketch["compactions"]
+    level = 0
+    while level < len(levels):
+        values = levels[level]
+        if len(values) <= _level_capacity(sketch, level):
+            level += 1
+        else:
+            new_level = level + 1 == len(levels)
+            if new_level:
+                levels.append(np.empty(0))
+                compactions.append(0)
+            offset = compactions[level] % 2
+            # An odd value stays at its level, so the total weight is unchanged.
+            if len(values) % 2:
+                kept, values = (values[:1], values[1:]) if offset else (values[-1:], values[:-1])
+            else:
+                kept = values[:0]
+            levels[level] = kept
+            levels[level + 1] = np.sort(np.concatenate([levels[level + 1], values[offset::2]]), kind="stable")
+            compactions[level] += 1
+            # A new top level lowers the capacities of the levels below.
+            level = 0 if new_level else level + 1
+    return sketch
+
+
+def sketch_update(sketch: dict, values) -> dict:
+    """Adds a batch of positive sales values to the sketch, the batch is sorted once."""
+    values = np.asarray(values, dtype="float64")
+    values = values[np.isfinite(values) & (values > 0)]
+    if not len(values):
+        return sketch
+    values = np.sort(values)
+    if not sketch["levels"]:
+        sketch["levels"], sketch["compactions"] = [np.empty(0)], [0]
+    sketch["levels"][0] = np.sort(np.concatenate([sketch["levels"][0], values]), kind="stable")
+    sketch["count"] += len(values)
+    sketch["min"] = float(values[0]) if sketch["min"] is None else min(sketch["min"], float(values[0]))
+    sketch["max"] = float(values[-1]) if sketch["max"] is None else max(sketch["max"], float(values[-1]))
+    return _compact(sketch)
+
+
+def sketch_merge(sketch: dict, other: dict) -> dict:
+    """Merges two sketches, like the sketches of two batches, into the first one."""
+    if not other["count"]:
+        return sketch
+    if not sketch["count"]:
+        return _compact({**other, "size": sketch["size"]})
+    depth = max(len(sketch["levels"]), len(other["levels"]))
+    levels = [np.sort(np.concatenate([levels[level] for levels in (sketch["levels"], other["levels"])
+                                      if level < len(levels)]), kind="stable") for level in range(depth)]
+    compactions = [sum(counts[level] for counts in (sketch["compactions"], other["compactions"])
+                       if level < len(counts)) for level in range(depth)]
+    return _compact({"size": sketch["size"], "count": sketch["count"] + other["count"],
+                     "min": min(sketch["min"], other["min"]), "max": max(sketch["max"], other["max"]),
+                     "levels": levels, "compactions": compactions})
+
+
+def sketch_quantiles(sketch: dict, quantiles: list) -> list:
+    """Approximate quantiles of the values added to the sketch, 0 and 1 are the exact minimum and maximum."""
+    values = np.concatenate(sketch["levels"])
+    weights = np.concatenate([np.full(len(level_values), 2 ** level, dtype="int64")
+                              for level, level_values in enumerate(sketch["levels"])])
+    order = np.argsort(values, kind="stable")
+    ranks = np.cumsum(weights[order])
+    results = []
+    for quantile in quantiles:
+        if quantile <= 0:
+            results.append(sketch["min"])
+        elif quantile >= 1:
+            results.append(sketch["max"])
+        else:
+            position = min(np.searchsorted(ranks, quantile * ranks[-1], side="left"), len(order) - 1)
+            results.append(float(values[order[position]]))
+    return results
+
+
+def sketch_to_json(sketch: dict) -> dict:
+    return {**sketch, "levels": [level_values.tolist() for level_values in sketch["levels"]]}
+
+
+def sketch_from_json(data: dict) -> dict:
+    return {**data, "levels": [np.asarray(level_values, dtype="float64") for level_values in data["levels"]]}
+
+
+def _sketch_key(buckets_config: dict) -> str:
+    return f"{buckets_config['store_key']}/sketch.json"
+
+
+def load_sketch(buckets_config: dict, storage_config: dict) -> dict:
+    """Committed sketch of every loaded batch. An empty sketch is returned before the first commit."""
+    state = read_json(_sketch_key(buckets_config), storage_config)
+    if state is None:
+        return new_sketch(buckets_config["sketch_size"])
+    return sketch_from_json(state["sketch"])
+
+
+def quantile_bins(sketch: dict, buckets_config: dict) -> list:
+    """pd.cut bins from the configured quantiles: (0, q1], (q1, q2], ... (qn, inf)."""
+    quantiles = buckets_config["quantiles"]
+    if len(quantiles) != len(buckets_config["bins"]) - 2:
+        raise ValueError(f"{len(quantiles)} quantiles don't make the {len(buckets_config['bins']) - 1} sales buckets")
+    return [0, *sketch_quantiles(sketch, quantiles), float("inf")]
+
+
+def sales_bucket_bins(buckets_config: dict, storage_config: dict, period: str) -> list:
+    """
+    Bins of the sales buckets of a period. In quantile mode they are computed from the sketch committed before the
+    first run of the period and frozen. The configured bins are used while the sketch is empty, or when the
+    quantiles are too close to make distinct boundaries.
+    """
+    if buckets_config["mode"] == "fixed":
+        return buckets_config["bins"]
+    if buckets_config["mode"] != "quantile":
+        raise ValueError(f"{buckets_config['mode']} sales buckets mode is not supported")
+
+    frozen_key = f"{buckets_config['store_key']}/boundaries/{period}.json"
+    bins = read_json(frozen_key, storage_config)
+    if bins is None:
+        bins = _sketch_bins(load_sketch(buckets_config, storage_config), buckets_config)
+        write_json(bins, frozen_key, storage_config)
+        logger.info(f"Froze the sales bucket bins of {period}: {bins}")
+    return bins
+
+
+def committed_bins(buckets_config: dict, storage_config: dict, refreeze: bool = False) -> list:
+    """
+    Bins of the sales buckets frozen with the committed sketch, for the incremental analytics: their persisted
+    partial aggregates sum the buckets of every run, so every run buckets with the bins of the runs before it.
+    With refreeze, on the full refresh runs rebuilding the partial aggregates, they are computed from the sketch
+    again, and committed with the sketch of the run.
+    """
+    if buckets_config["mode"] == "fixed":
+        return buckets_config["bins"]
+    if buckets_config["mode"] != "quantile":
+        raise ValueError(f"{buckets_config['mode']} sales buckets mode is not supported")
+
+    state = read_json(_sketch_key(buckets_config), storage_config)
+    if state is not None and state.get("bins") and not refreeze:
+        return state["bins"]
+    bins = _sketch_bins(load_sketch(buckets_config, storage_config), buckets_config)
+    logger.info(f"Computed the sales bucket bins {bins}, frozen when the run is committed")
+    return bins
+
+
+def _sketch_bins(sketch: dict, buckets_config: dict) -> list:
+    bins = quantile_bins(sketch, buckets_config) if sketch["count"] else buckets_config["bins"]
+    if not all(lower < upper for lower, upper in zip(bins, bins[1:])):
+        logger.warning(f"Sales quantiles {bins} are not distinct, using the configured bins")
+        bins = buckets_config["bins"]
+    return bins
+
+
+def record_sales_sketch(frame, buckets_config: dict, storage_config: dict, pending_key: str,
+                        bins: list = None) -> None:
+    """
+    Writes the sketch of the total_sales of a data frame or Arrow table to pending_key, for the commit, with the
+    bins the frame was bucketed with.
+    """
+    sketch = sketch_update(new_sketch(buckets_config["sketch_size"]), frame["total_sales"].to_numpy())
+    write_json({"sketch": sketch_to_json(sketch), "bins": bins}, pending_key, storage_config)
+
+
+def commit_sales_sketches(pending_keys: list, buckets_config: dict, storage_config: dict,
+                          replace: bool = False) -> None:
+    """
+    Merges the pending batch sketches of a successful run into the committed sketch, and commits the bins the run
+    bucketed with. The keys of the last commit are kept, so a retried commit doesn't count the run twice.
+    With replace, for the runs extracting the whole history, they replace the committed sketch instead, which
+    would count the sales of the earlier runs again.
+    """
+    state = read_json(_sketch_key(buckets_config), storage_config)
+    if state is not None and state["pending_keys"] == pending_keys:
+        logger.info(f"Sales sketches of {pending_keys} already committed")
+        return
+    sketch = new_sketch(buckets_config["sketch_size"]) if replace else load_sketch(buckets_config, storage_config)
+    bins = state.get("bins") if state is not None else None
+    for key in pending_keys:
+        pending = read_json(key, storage_config)
+        sketch = sketch_merge(sketch, sketch_from_json(pending["sketch"]))
+        bins = pending["bins"] or bins
+    write_json({"sketch": sketch_to_json(sketch), "pending_keys": pending_keys, "bins": bins},
+               _sketch_key(buckets_config), storage_config)
+    logger.info(f"Committed {len(pending_keys)} sales sketches, {sketch['count']} sales summarized")
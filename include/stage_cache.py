@@ -0,0 +1,105 @@
+"""
+Content-addressed cache of stage results in the intermediate storage, so reruns and retries skip unchanged stages.
+An entry is the folder <prefix>/<key>/ with the output frames of the stage, and entry.json with the stage result,
+the references passed through XCom. entry.json is written last, so an interrupted stage is never a hit.
+The key hashes the stage name, the code of the include package and of the stage function, the settings and the
+inputs of the stage. Inputs are references, and the outputs of a cached stage are stored under its key, so the key
+of a stage changes only when an upstream result changed. Extracted objects are keyed by their S3 ETag.
+Entries are evicted by age and, least recently used first, by total size.
+"""
+
+import functools
+import hashlib
+import json
+import logging
+import pathlib
+import time
+
+from include.intermediate_storage import delete_folder, list_files, read_json, write_json
+
+logger = logging.getLogger(__name__)
+
+INCLUDE_PACKAGE = pathlib.Path(__file__).parent
+
+
+@functools.lru_cache(maxsize=None)
+def code_version() -> str:
+    """Hash of the sources of the include package, any change of the transform, validation or load code."""
+    digest = hashlib.sha256()
+    for path in sorted(INCLUDE_PACKAGE.rglob("*.py")):
+        digest.update(str(path.relative_to(INCLUDE_PACKAGE)).encode("utf-8"))
+        digest.update(path.read_bytes())
+    return digest.hexdigest()
+
+
+def _code_fingerprint(code) -> list:
+    """Bytecode, names and constants of a function, like the columns a stage reads, nested functions included."""
+    constants = [_code_fingerprint(constant) if hasattr(constant, "co_code") else repr(constant)
+                 for constant in code.co_consts]
+    return [code.co_code.hex(), list(code.co_names), constants]
+
+
+def cache_key(stage: str, inputs, settings=None, function=None) -> str:
+    fingerprint = {
+        "stage": stage,
+        "code": code_version(),
+        "function": _code_fingerprint(function.__code__) if function is not None else None,
+        "settings": settings,
+        "inputs": inputs,
+    }
+    return hashlib.sha256(json.dumps(fingerprint, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+def cached(stage: str, inputs, compute, cache_config: dict, storage_config: dict, settings=None):
+    """
+    Result of compute(folder) for the stage inputs. compute writes its outputs under folder and returns a JSON
+    result, like references. On a hit the stored result is returned without running compute. Without the cache,
+    compute gets a None folder and writes its outputs where it usually does.
+    """
+    if not cache_config["enabled"]:
+        return compute(None)
+
+    key = cache_key(stage, inputs, settings, compute)
+    entry_key = f"{cache_config['prefix']}/{key}/entry.json"
+    entry = read_json(entry_key, storage_config)
+    if entry is not None:
+        # Rewritten on every hit, its modification time orders the least recently used entries.
+        write_json({**entry, "accessed": time.time()}, entry_key, storage_config)
+        logger.info(f"Cache hit of {stage}, entry {key}")
+        return entry["result"]
+
+    result = compute(f"{cache_config['prefix']}/{key}")
+    write_json({"stage": stage, "result": result, "created": time.time(), "accessed": time.time()}, entry_key,
+               storage_config)
+    logger.info(f"Cached {stage} as entry {key}")
+    return result
+
+
+def evict(cache_config: dict, storage_config: dict) -> list:
+    """
+    Deletes the entries not used for max_age_hours, then the least recently used ones until the cache is smaller than
+    max_bytes. Entries without entry.json are evicted by age only, they may be written by a running stage.
+    It returns the evicted keys.
+    """
+    entries = {}
+    for file in list_files(cache_config["prefix"], storage_config):
+        key, _, name = file["key"].partition("/")
+        entry = entries.setdefault(key, {"bytes": 0, "accessed": 0, "complete": False})
+        entry["bytes"] += file["bytes"]
+        entry["accessed"] = max(entry["accessed"], file["modified"])
+        entry["complete"] |= name == "entry.json"
+
+    oldest_accessed = time.time() - cache_config["max_age_hours"] * 3600
+    evicted = [key for key, entry in entries.items() if entry["accessed"] < oldest_accessed]
+    cache_bytes = sum(entry["bytes"] for key, entry in entries.items() if key not in evicted)
+    for key, entry in sorted(entries.items(), key=lambda item: item[1]["accessed"]):
+        if cache_bytes <= cache_config["max_bytes"]:
+            break
+        if key not in evicted and entry["complete"]:
+            evicted.append(key)
+            cache_bytes -= entry["bytes"]
+
+    for key in evicted:
+        delete_folder(f"{cache_config['prefix']}/{key}", storage_config)
+    logger.info(f"Evicted {len(evicted)} of {len(entries)} cache entries, {cache_bytes} bytes cached")
+    return evicted
@@ -1,22 +1,58 @@
 import logging
 
+import numpy as np
 import pandas as pd
 
+from include.calendar_dimension import calendar_attributes, calendar_dimension, factorized_attribute
+from include.instrumentation import instrumented, rows_dropped
+from include.parallel_aggregation import effective_workers, grouped_codes, parallel_grouped_codes
 from include.validation.average_sales_and_units_by_sales_bucket_validation import \
-    validate_average_sales_and_units_by_sales_bucket
+    average_sales_and_units_by_sales_bucket_schema, validate_average_sales_and_units_by_sales_bucket
 from include.validation.enriched_data_validation_schema import validate_enriched_data_outgoing_schema
 from include.validation.products_validation_schema import products_entry_schema, validate_product_outgoing_schema
-from include.validation.quarterly_sales_validation_schema import validate_quarterly_sales_outgoing_schema
-from include.validation.sales_revenue_by_region_outgoing_schema import \
+from include.validation.quarterly_sales_validation_schema import quarterly_sales_outgoing_schema, \
+    validate_quarterly_sales_outgoing_schema
+from include.validation.sales_revenue_by_region_outgoing_schema import sales_revenue_by_region_outgoing_schema, \
     validate_sales_revenue_by_region_outgoing_schema
 from include.validation.sales_validation_schema import validate_sales_entry_schema, validate_sales_outgoing_schema
-from include.validation.validate_sales_seasonality_outgoing_schema import validate_sales_seasonality_outgoing_schema
-from include.validation.weekly_order_counts_by_status_validation_schema import validate_weekly_order_counts_by_status
+from include.validation.validate_sales_seasonality_outgoing_schema import sales_seasonality_outgoing_schema, \
+    validate_sales_seasonality_outgoing_schema
+from include.validation.validation_policy import validate
+from include.validation.weekly_order_counts_by_status_validation_schema import \
+    validate_weekly_order_counts_by_status, weekly_order_counts_by_status_schema
 
 logger = logging.getLogger(__name__)
 
 
-def sales_data_transformation(sales_df: pd.DataFrame):
+# Integer columns downcast to the smallest width fitting their values in memory-lean mode.
+LEAN_INTEGER_COLUMNS = ["sales_id", "product_id", "qty", "hour"]
+
+# Default bins of the sales buckets of total_sales: (0, 100], (100, 500] and above.
+SALES_BUCKET_BINS = [0, 100, 500, float("inf")]
+SALES_BUCKET_LABELS = ["Low", "Mid", "High"]
+
+
+def _normalized_category(series: pd.Series, normalize) -> pd.Series:
+    """
+    Converts a low-cardinality string column to a categorical and normalizes only its unique values,
+    instead of every row. Values equal after normalization, like " North" and "north", share a category.
+    """
+    categorical = series.astype("category")
+    categories = normalize(categorical.cat.categories.to_series())
+    new_codes, new_categories = pd.factorize(categories, sort=True)
+    codes = categorical.cat.codes.to_numpy()
+    remapped_codes = np.where(codes >= 0, new_codes[codes], -1)
+    return pd.Series(pd.Categorical.from_codes(remapped_codes, categories=new_categories), index=series.index)
+
+
+def _downcast_integers(df: pd.DataFrame, columns: list = LEAN_INTEGER_COLUMNS) -> pd.DataFrame:
+    """A new frame with the integer columns downcast, the other columns are not copied."""
+    dtypes = {column: pd.to_numeric(df[column], downcast="integer").dtype for column in columns if column in df.columns}
+    return df.astype(dtypes, copy=False)
+
+
+@instrumented
+def sales_data_transformation(sales_df: pd.DataFrame, memory_lean: bool = False):
     """ It is good practice to standardize all columns.
         In this case, we follow the exam requirements."""
 
@@ -25,68 +61,135 @@ def sales_data_transformation(sales_df: pd.DataFrame):
     logger.info(f"Initiating transformation of sales data")
     sales_df = validate_sales_entry_schema(sales_df)
     sales_df.columns = sales_df.columns.str.replace(" ", "_")
-    sales_df["Region"] = sales_df["Region"].str.lower().str.strip()
+    if memory_lean:
+        sales_df["Region"] = _normalized_category(sales_df["Region"], lambda r: r.str.lower().str.strip())
+        sales_df["order_status"] = sales_df["order_status"].astype("category")
+    else:
+        sales_df["Region"] = sales_df["Region"].str.lower().str.strip()
+    rows = len(sales_df.index)
     sales_df.dropna(subset=['Region', 'Time_stamp', 'proDuct_Id'], inplace=True)
+    rows = rows_dropped("missing_values", rows, sales_df)
     sales_df.drop_duplicates(inplace=True)
-    sales_df = sales_df[(sales_df["Price"] > 0) & (sales_df["qty"] > 0)]
+    rows = rows_dropped("duplicates", rows, sales_df)
+    # The filtered frame is already a copy, the shallow one only drops its link to the unfiltered frame, so the
+    # columns set below don't raise SettingWithCopyWarning.
+    sales_df = sales_df[(sales_df["Price"] > 0) & (sales_df["qty"] > 0)].copy(deep=False)
+    rows_dropped("unpriced", rows, sales_df)
     sales_df["Time_stamp"] = pd.to_datetime(sales_df["Time_stamp"], errors="coerce")
     sales_df["total_sales"] = (sales_df["Price"] * (1 - sales_df["discount"] / 100)) * sales_df["qty"]
+    if memory_lean:
+        sales_df = _downcast_integers(sales_df, ["sales_id", "proDuct_Id", "qty"])
     sales_df.rename(columns={'proDuct_Id': 'product_id'}, inplace=True)   # Rename column name is not in project requrements,
     logger.info(f"Done transformation of sales data")                     # but it throw key error when merging,
-    return validate_sales_outgoing_schema(sales_df)                       # table joints need equality in columns names
+    return validate_sales_outgoing_schema(sales_df, memory_lean=memory_lean)  # table joints need equality in columns names
 
 
-def products_data_transformation(products_df: pd.DataFrame):
+@instrumented
+def products_data_transformation(products_df: pd.DataFrame, memory_lean: bool = False):
     """Products data cleaning and transformation"""
     logger.info(f"Initiating transformation of products data")
-    products_df = products_entry_schema(products_df)
+    products_df = validate(products_entry_schema, products_df)
     # None of the required four columns from the product_data file need a snake_case transformation.
-    products_df['brand'] = products_df['brand'].str.upper()
-    products_df["category"] = products_df["category"].str.lower()
+    if memory_lean:
+        products_df['brand'] = _normalized_category(products_df['brand'], lambda b: b.str.upper())
+        products_df["category"] = _normalized_category(products_df["category"], lambda c: c.str.lower())
+        # Repeated on every sales row after the merge.
+        products_df["launch_date"] = products_df["launch_date"].astype("category")
+    else:
+        products_df['brand'] = products_df['brand'].str.upper()
+        products_df["category"] = products_df["category"].str.lower()
+    rows = len(products_df.index)
     products_df.dropna(subset=['product_id', 'rating'],inplace=True)
+    rows = rows_dropped("missing_values", rows, products_df)
     products_df.drop_duplicates(inplace=True)
+    rows_dropped("duplicates", rows, products_df)
+    if memory_lean:
+        products_df = _downcast_integers(products_df)
     logger.info(f"Done transformation of products data")
-    return validate_product_outgoing_schema(products_df)
+    return validate_product_outgoing_schema(products_df, memory_lean=memory_lean)
+
+
+def products_lookup(products_df: pd.DataFrame) -> dict:
+    """
+    Products dimension indexed by product_id, built once and reused for every sales frame joined to it,
+    like the sales partitions of a run.
+    """
+    products_df = products_df.reset_index(drop=True)
+    index = pd.Index(products_df["product_id"])
+    return {"index": index, "unique": index.is_unique, "products": products_df,
+            "columns": products_df.drop(columns="product_id")}
+
 
+def lookup_join(sales_df: pd.DataFrame, lookup: dict):
+    """
+    Inner join of the sales with the products lookup. Every sales row looks up the position of its product in the
+    index and the product columns are gathered with a positional take, instead of building a hash table per merge.
+    The rows keep the sales order. It returns the joined frame and the number of orphan sales rows dropped.
+    """
+    if not lookup["unique"]:
+        # Duplicated product ids repeat sales rows, which only a real merge does.
+        logger.warning(f"Duplicated product_id in the products lookup, falling back to a merge")
+        orphan_rows = int((~sales_df["product_id"].isin(lookup["index"])).sum())
+        return sales_df.merge(lookup["products"], on="product_id", how="inner"), orphan_rows
 
-def merging_sales_data_with_products_data(sales_df: pd.DataFrame, products_df: pd.DataFrame):
-    """Merging sales data and products data files after cleaning and transformation"""
+    positions = lookup["index"].get_indexer(sales_df["product_id"])
+    matched = positions >= 0
+    orphan_rows = int(len(positions) - np.count_nonzero(matched))
+    if orphan_rows:
+        sales_df, positions = sales_df[matched], positions[matched]
+    # The frame is assembled from the column arrays, so every column is copied once, in the consolidation.
+    columns = {name: sales_df[name].array for name in sales_df.columns}
+    columns.update({name: values.array.take(positions) for name, values in lookup["columns"].items()})
+    return pd.DataFrame(columns, copy=False), orphan_rows
+
+
+@instrumented
+def merging_sales_data_with_products_data(sales_df: pd.DataFrame, products_df, memory_lean: bool = False):
+    """
+    Merging sales data and products data files after cleaning and transformation.
+    products_df is the products frame, or its products_lookup when several sales frames are joined to it.
+    """
     logger.info(f"Start merging sales_df with products_df")
-    merged_df = sales_df.merge(products_df, on="product_id", how="inner")
+    lookup = products_df if isinstance(products_df, dict) else products_lookup(products_df)
+    merged_df, orphan_rows = lookup_join(sales_df, lookup)
+    rows_dropped("orphans", len(sales_df.index), len(sales_df.index) - orphan_rows)
+    if orphan_rows:
+        logger.warning(f"Dropped {orphan_rows} of {len(sales_df.index)} sales rows without a matching product")
+    if memory_lean:
+        # Sales and products IDs may have been downcast to different widths.
+        merged_df = _downcast_integers(merged_df)
     return merged_df
 
 
-def merged_data_enriched(merged_df: pd.DataFrame):
-    """Enrichment after merging, to perform upcoming analytical tasks"""
+@instrumented
+def merged_data_enriched(merged_df: pd.DataFrame, memory_lean: bool = False, sales_bins: list = SALES_BUCKET_BINS):
+    """
+    Enrichment after merging, to perform upcoming analytical tasks.
+    sales_bins are the bins of the sales buckets, fixed or the frozen quantiles of include/sales_buckets.py.
+    """
     logger.info(f"Merged data enrich process")
-    merged_df["month"] = pd.to_datetime(merged_df["Time_stamp"]).dt.month_name()
-    merged_df["weekday"] = pd.to_datetime(merged_df["Time_stamp"]).dt.day_name()
-    merged_df["hour"] = pd.to_datetime(merged_df["Time_stamp"]).dt.hour.astype("int64")
-    merged_df["sales_bucket"] = pd.cut(
-        merged_df["total_sales"],
-        bins=[0, 100, 500, float("inf")],  # make sense to explore total_sales value and bins to be based on this?
-        labels=["Low", "Mid", "High"],
-                                           # TODO: get max value of total_sales with merged_df["total_sales"].max,
-                                           # TODO: and create bins dynamically with np.linspace
-    )
+    calendar_df = calendar_attributes(merged_df["Time_stamp"], ["month", "weekday", "hour"], categorical=memory_lean)
+    merged_df[calendar_df.columns] = calendar_df
+    merged_df["sales_bucket"] = pd.cut(merged_df["total_sales"], bins=sales_bins, labels=SALES_BUCKET_LABELS)
 
-    return validate_enriched_data_outgoing_schema(merged_df)
+    return validate_enriched_data_outgoing_schema(merged_df, memory_lean=memory_lean)
 
 
+@instrumented
 def quarterly_sales_by_category(df: pd.DataFrame) -> pd.DataFrame:
     """Identifying quarterly sales trend by category"""
     logger.info(f"Identifying quarterly sales trend by category")
-    df['Time_stamp'] = pd.to_datetime(df['Time_stamp'])
-    df['quarter'] = df['Time_stamp'].dt.to_period('Q').astype(str)
-    quarterly_sales = df.groupby(['quarter', 'category'])['total_sales'].sum().reset_index()
+    df['quarter'] = calendar_attributes(df['Time_stamp'], ["quarter"])["quarter"]
+    quarterly_sales = df.groupby(['quarter', 'category'], observed=True)['total_sales'].sum().reset_index()
 
     return validate_quarterly_sales_outgoing_schema(quarterly_sales)
 
 
+@instrumented
 def sales_revenue_by_region(df: pd.DataFrame) -> pd.DataFrame:
     """ Calculate product sales revenue by region"""
     logger.info(f"Product sales revenue by region")
-    region_sales = df.groupby('Region')['total_sales'].sum().reset_index()
+    region_sales = df.groupby('Region', observed=True)['total_sales'].sum().reset_index()
     total_sales = region_sales['total_sales'].sum()
     region_sales["revenue_share"] = region_sales["total_sales"] / total_sales * 100
     region_sales['cumulative_revenue_share'] = region_sales['revenue_share'].cumsum()
@@ -94,10 +197,11 @@ def sales_revenue_by_region(df: pd.DataFrame) -> pd.DataFrame:
     return validate_sales_revenue_by_region_outgoing_schema(region_sales)
 
 
+@instrumented
 def sales_seasonality(df: pd.DataFrame):
     """Finding fluctuation on sales over different months"""
     logger.info(f"Get Product sales seasonality by month and category")
-    seasonality_df = df.groupby(['month', 'category']).agg(
+    seasonality_df = df.groupby(['month', 'category'], observed=True).agg(
         monthly_total_sales=('total_sales', 'sum'),
         monthly_total_quantity=('qty', 'sum')
     ).reset_index()
@@ -105,23 +209,166 @@ def sales_seasonality(df: pd.DataFrame):
     return validate_sales_seasonality_outgoing_schema(seasonality_df)
 
 
+@instrumented
 def weekly_order_counts_by_status(df: pd.DataFrame):
     """Tracking order status on a weekly basis."""
     logger.info(f"Calculate weekly orders by their status")
-    df["Time_stamp"] = pd.to_datetime(df["Time_stamp"])
-    df["week"] = df["Time_stamp"].dt.isocalendar().week.astype("int64")
-    order_counts = df.groupby(["week", "order_status"]).size().reset_index(name="order_counts")
+    df["week"] = calendar_attributes(df["Time_stamp"], ["week"])["week"]
+    order_counts = df.groupby(["week", "order_status"], observed=True).size().reset_index(name="order_counts")
     pivoted_df = order_counts.pivot_table(index="week", columns="order_status", values="order_counts",
                                           fill_value=0).reset_index()
     return validate_weekly_order_counts_by_status(pivoted_df)
 
 
+@instrumented
 def average_sales_and_units_by_sales_bucket(df: pd.DataFrame):
     """ Resume average sales and units by sales bucket. """
     logger.info(f"Resume average sales and units by sales bucket")
-    average_df = df.groupby("sales_bucket").agg(
+    average_df = df.groupby("sales_bucket", observed=True).agg(
         average_sales=('total_sales', 'mean'),
         average_quantity=('qty', 'mean')
     ).reset_index()
 
     return validate_average_sales_and_units_by_sales_bucket(average_df)
+
+
+def _factorized(series: pd.Series):
+    """Sorted integer codes of a group key, so groupbys run on ints instead of hashing strings every time."""
+    return pd.factorize(series, sort=True)
+
+
+def _labelled(grouped: pd.DataFrame, keys: dict) -> pd.DataFrame:
+    """Maps the key codes of grouped codes back to their labels."""
+    for name in grouped.columns.intersection(list(keys)):
+        grouped[name] = keys[name][1].take(grouped[name].to_numpy())
+    return grouped
+
+
+def _grouped_by_codes(keys: dict, values: dict, aggregations: dict) -> pd.DataFrame:
+    """
+    Groups the values by already factorized keys and maps the codes back to their labels.
+    Like groupby, rows with a missing key are dropped and the groups are sorted by key.
+    """
+    return _labelled(grouped_codes({name: codes for name, (codes, _) in keys.items()}, values, aggregations), keys)
+
+
+# Group keys of the mergeable partial aggregates behind every presentation frame.
+PARTIAL_AGGREGATE_KEYS = {
+    "quarter_category": ["quarter", "category"],
+    "region": ["Region"],
+    "month_category": ["month", "category"],
+    "week_status": ["week", "order_status"],
+    "sales_bucket": ["sales_bucket"],
+}
+
+# Named aggregations of the partial aggregates, sums of the enriched columns and of "rows", a count per group.
+PARTIAL_AGGREGATIONS = {
+    "quarter_category": {"total_sales": ("total_sales", "sum")},
+    "region": {"total_sales": ("total_sales", "sum")},
+    "month_category": {"monthly_total_sales": ("total_sales", "sum"), "monthly_total_quantity": ("qty", "sum")},
+    "week_status": {"order_counts": ("rows", "sum")},
+    "sales_bucket": {"total_sales": ("total_sales", "sum"), "total_quantity": ("qty", "sum"),
+                     "rows": ("rows", "sum")},
+}
+
+
+@instrumented
+def partial_aggregates(df: pd.DataFrame, workers: int = 1) -> dict:
+    """
+    Computes mergeable partial aggregates of the enriched data in a single pass: sums and counts per group,
+    instead of the final means and shares. Quarter and week come from the calendar dimension and the group keys
+    are factorized once, then shared by all the aggregates.
+    With several workers, big frames are grouped on a process pool, with identical results.
+    """
+    logger.info(f"Computing partial aggregates in one pass")
+    calendar_codes, calendar_df = calendar_dimension(df["Time_stamp"], ["quarter", "week"])
+    keys = {
+        "quarter": factorized_attribute(calendar_codes, calendar_df["quarter"]),
+        "week": factorized_attribute(calendar_codes, calendar_df["week"]),
+        **{name: _factorized(df[name]) for name in ["category", "Region", "month", "order_status", "sales_bucket"]},
+    }
+    values = {"total_sales": df["total_sales"].to_numpy(), "qty": df["qty"].to_numpy(),
+              "rows": np.ones(len(df.index), dtype="int64")}
+
+    workers = effective_workers(len(df.index), workers)
+    if workers > 1:
+        aggregations = {name: (PARTIAL_AGGREGATE_KEYS[name], PARTIAL_AGGREGATIONS[name])
+                        for name in PARTIAL_AGGREGATE_KEYS}
+        grouped = parallel_grouped_codes({name: codes for name, (codes, _) in keys.items()},
+                                         {name: len(uniques) for name, (_, uniques) in keys.items()},
+                                         values, aggregations, workers)
+        return {name: _labelled(grouped_df, keys) for name, grouped_df in grouped.items()}
+
+    return {name: _grouped_by_codes({key: keys[key] for key in group_keys},
+                                    {column: values[column] for column, _ in PARTIAL_AGGREGATIONS[name].values()},
+                                    PARTIAL_AGGREGATIONS[name])
+            for name, group_keys in PARTIAL_AGGREGATE_KEYS.items()}
+
+
+def merge_partial_aggregates(previous: dict, batch: dict) -> dict:
+    """
+    Adds the partial aggregates of a new batch to the persisted ones.
+    Only the groups present in the batch change, the cost follows the number of groups, not the history size.
+    """
+    if previous is None:
+        return batch
+
+    merged = {}
+    for name, keys in PARTIAL_AGGREGATE_KEYS.items():
+        # A batch without rows, like a rerun whose rows were all deduplicated, adds no group.
+        combined = pd.concat([df for df in (previous[name], batch[name]) if not df.empty] or [previous[name]],
+                             ignore_index=True)
+        merged[name] = combined.groupby(keys, sort=True, observed=True).sum().reset_index()
+    return merged
+
+
+def _schema_typed(df: pd.DataFrame, schema) -> pd.DataFrame:
+    """
+    Casts the numeric columns to the dtypes of the outgoing schema, a missing one counting 0.
+    Sums over no rows keep the memory-lean widths and the weekly pivot has no column for a status without orders.
+    """
+    dtypes = {name: column.dtype.type for name, column in schema.columns.items()
+              if pd.api.types.is_numeric_dtype(column.dtype.type)}
+    return df.assign(**{name: 0 for name in dtypes if name not in df.columns}).astype(dtypes)
+
+
+def finalize_partial_aggregates(partials: dict) -> dict:
+    """
+    Derives the presentation frames (means, revenue shares and the weekly pivot) from the partial aggregates.
+    It returns the validated frames keyed by their target name.
+    """
+    region_sales = partials["region"].copy()
+    region_sales["revenue_share"] = region_sales["total_sales"] / region_sales["total_sales"].sum() * 100
+    region_sales['cumulative_revenue_share'] = region_sales['revenue_share'].cumsum()
+
+    weekly_counts_df = partials["week_status"].pivot_table(index="week", columns="order_status",
+                                                           values="order_counts", fill_value=0).reset_index()
+
+    buckets = partials["sales_bucket"]
+    average_df = pd.DataFrame({
+        "sales_bucket": buckets["sales_bucket"],
+        "average_sales": buckets["total_sales"] / buckets["rows"],
+        "average_quantity": buckets["total_quantity"] / buckets["rows"],
+    })
+
+    return {
+        "sales_trends": validate_quarterly_sales_outgoing_schema(
+            _schema_typed(partials["quarter_category"], quarterly_sales_outgoing_schema)),
+        "sales_ranking": validate_sales_revenue_by_region_outgoing_schema(
+            _schema_typed(region_sales, sales_revenue_by_region_outgoing_schema)),
+        "sales_seasonality": validate_sales_seasonality_outgoing_schema(
+            _schema_typed(partials["month_category"], sales_seasonality_outgoing_schema)),
+        "sales_status": validate_weekly_order_counts_by_status(
+            _schema_typed(weekly_counts_df, weekly_order_counts_by_status_schema)),
+        "average_sales_and_units_sales_bucket": validate_average_sales_and_units_by_sales_bucket(
+            _schema_typed(average_df, average_sales_and_units_by_sales_bucket_schema)),
+    }
+
+
+@instrumented
+def presentation_aggregates(df: pd.DataFrame, workers: int = 1) -> dict:
+    """
+    Fused analytics: computes the five presentation frames in a single pass over the enriched data.
+    It returns the same validated frames as the five analytical functions, keyed by their target name.
+    """
+    return finalize_partial_aggregates(partial_aggregates(df, workers=workers))
@@ -0,0 +1,42 @@
+from include import arrow_transform, transform
+from include.intermediate_storage import iter_batches, read_frames, read_tables
+
+
+def _scan_batches(references: list, columns=None):
+    for reference in references:
+        yield from iter_batches(reference, columns=columns)
+
+
+TRANSFORM_FUNCTIONS = ["sales_data_transformation", "products_data_transformation", "products_lookup",
+                       "merging_sales_data_with_products_data", "merged_data_enriched", "presentation_aggregates"]
+
+# Engines running the transform chain and the fused analytics. A backend reads the stored frames into its own frame
+# type ("read", and "scan" for the input of presentation_aggregates, both from a list of references) and provides the
+# TRANSFORM_FUNCTIONS over that type.
+TRANSFORM_BACKENDS = {
+    "pandas": {"read": read_frames, "scan": read_frames,
+               **{name: getattr(transform, name) for name in TRANSFORM_FUNCTIONS}},
+    "arrow": {"read": read_tables, "scan": _scan_batches,
+              **{name: getattr(arrow_transform, name) for name in TRANSFORM_FUNCTIONS}},
+}
+
+
+def transform_backend(name: str) -> dict:
+    if name not in TRANSFORM_BACKENDS:
+        raise ValueError(f"{name} transform backend is not supported")
+    return TRANSFORM_BACKENDS[name]
+
+
+_products_lookups = {}
+
+
+def cached_products_lookup(backend: dict, products_ref: dict) -> dict:
+    """
+    Products lookup of a stored products frame, read and indexed once per process and reused by every sales
+    partition joined to it in that process. Only the lookup of the latest products frame is kept.
+    """
+    key = (id(backend), products_ref["path"])
+    if key not in _products_lookups:
+        _products_lookups.clear()
+        _products_lookups[key] = backend["products_lookup"](backend["read"]([products_ref]))
+    return _products_lookups[key]
@@ -4,6 +4,9 @@ import pandas as pd
 import pandera.pandas as pa
 from pandera.pandas import Column
 
+from include.validation.memory_lean_schema import memory_lean_schema
+from include.validation.validation_policy import validate
+
 logger = logging.getLogger(__name__)
 
 merged_data_outgoing_schema = pa.DataFrameSchema({
@@ -12,8 +15,7 @@ merged_data_outgoing_schema = pa.DataFrameSchema({
     "Region": Column(str),
     "qty": Column(int),
     "Price": Column(float),
-    # "time_stamp": Column(pa.DateTime),
-    "Time_stamp": Column(str),
+    "Time_stamp": Column(pa.DateTime),
     "discount": Column(float),
     "order_status": Column(str),
     "total_sales": Column(float),
@@ -27,8 +29,11 @@ merged_data_outgoing_schema = pa.DataFrameSchema({
     "weekday": Column(str),
     "hour": Column(int),
     "sales_bucket": Column(str),
-})
+}, name="enriched_data_outgoing")
+
+merged_data_outgoing_lean_schema = memory_lean_schema(merged_data_outgoing_schema)
 
 
-def validate_enriched_data_outgoing_schema(merged_df: pd.DataFrame):
-    return merged_data_outgoing_schema.validate(merged_df)
+def validate_enriched_data_outgoing_schema(merged_df: pd.DataFrame, memory_lean: bool = False):
+    schema = merged_data_outgoing_lean_schema if memory_lean else merged_data_outgoing_schema
+    return validate(schema, merged_df)
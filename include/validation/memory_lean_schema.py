@@ -0,0 +1,16 @@
+import pandas as pd
+import pandera.pandas as pa
+from pandera.pandas import Check
+
+
+def memory_lean_schema(schema: pa.DataFrameSchema) -> pa.DataFrameSchema:
+    """
+    Variant of a schema accepting the dtypes of the memory-lean transforms.
+    Integer columns accept any integer width instead of int64 only. Categorical string columns already pass
+    the str columns and their checks.
+    """
+    integer_columns = [name for name, column in schema.columns.items() if str(column.dtype) == "int64"]
+    is_integer = Check(lambda s: pd.api.types.is_integer_dtype(s.dtype), name="integer_dtype", ignore_na=False)
+    return schema.update_columns({
+        name: {"dtype": None, "checks": [*schema.columns[name].checks, is_integer]} for name in integer_columns
+    })
@@ -5,6 +5,8 @@ import pandera.pandas as pa
 from pandera.pandas import Column
 from pandera.errors import SchemaError
 
+from include.validation.validation_policy import validate
+
 logger = logging.getLogger(__name__)
 
 merged_data_outgoing_schema = pa.DataFrameSchema({
@@ -21,8 +23,8 @@ merged_data_outgoing_schema = pa.DataFrameSchema({
     "rating": Column(float),
     "in_stock": Column(bool),
     "launch_date": Column(pa.DateTime),
-})
+}, name="merged_data_outgoing")
 
 
 def validate_merged_data_outgoing_schema(merged_df:pd.DataFrame):
-    return merged_data_outgoing_schema.validate(merged_df)
+    return validate(merged_data_outgoing_schema, merged_df)
@@ -3,7 +3,10 @@ import pandas as pd
 import pandera.pandas as pa
 
 from pandera.pandas import Column, Check
-from pandera.errors import SchemaError
+from pandera.errors import SchemaError, SchemaErrors
+
+from include.validation.memory_lean_schema import memory_lean_schema
+from include.validation.validation_policy import on_unique_values, validate
 
 logger = logging.getLogger(__name__)
 
@@ -15,26 +18,29 @@ products_entry_schema = pa.DataFrameSchema({
     "in_stock": Column(bool),
     # "launch_date": Column(pa.DateTime, nullable=True),
     "launch_date": Column(str, nullable=True),
-})
+}, name="products_entry")
 
 
 product_outgoing_schema = pa.DataFrameSchema({
     "product_id": Column(int),
-    "category": Column(str, Check(lambda c: c.str.islower())),
-    "brand": Column(str, Check(lambda b: b.str.isupper())),
+    "category": Column(str, Check(on_unique_values(lambda c: c.str.islower()), name="islower")),
+    "brand": Column(str, Check(on_unique_values(lambda b: b.str.isupper()), name="isupper")),
     "rating": Column(float),
     "in_stock": Column(bool),
     "launch_date": Column(str, nullable=True),   # If case of using it for analysis make column to pd.datetime!
-})
+}, name="products_outgoing")
+
+product_outgoing_lean_schema = memory_lean_schema(product_outgoing_schema)
 
 
 def validate_products_entry_schema(products_df:pd.DataFrame):
     try:
-        return products_entry_schema.validate(products_df)
-    except SchemaError as e:
+        return validate(products_entry_schema, products_df)
+    except (SchemaError, SchemaErrors) as e:
         logger.error(f"Entry schema validation failed: {e.failure_cases}")
         return products_df
 
 
-def validate_product_outgoing_schema(products_df:pd.DataFrame):
-    return product_outgoing_schema.validate(products_df)
\ No newline at end of file
+def validate_product_outgoing_schema(products_df: pd.DataFrame, memory_lean: bool = False):
+    schema = product_outgoing_lean_schema if memory_lean else product_outgoing_schema
+    return validate(schema, products_df)
\ No newline at end of file
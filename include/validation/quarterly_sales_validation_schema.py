@@ -4,14 +4,16 @@ import pandas as pd
 import pandera.pandas as pa
 from pandera.pandas import Column
 
+from include.validation.validation_policy import validate
+
 logger = logging.getLogger(__name__)
 
 quarterly_sales_outgoing_schema = pa.DataFrameSchema({
     "quarter": Column(str),
     "category": Column(str),
     "total_sales": Column(float)
-})
+}, name="quarterly_sales_outgoing")
 
 
 def validate_quarterly_sales_outgoing_schema(df: pd.DataFrame) -> pd.DataFrame:
-    return quarterly_sales_outgoing_schema.validate(df)
+    return validate(quarterly_sales_outgoing_schema, df)
@@ -4,6 +4,8 @@ import pandas as pd
 import pandera.pandas as pa
 from pandera.pandas import Column
 
+from include.validation.validation_policy import validate
+
 logger = logging.getLogger(__name__)
 
 sales_revenue_by_region_outgoing_schema = pa.DataFrameSchema({
@@ -11,8 +13,8 @@ sales_revenue_by_region_outgoing_schema = pa.DataFrameSchema({
     "total_sales": Column(float),
     "revenue_share": Column(float),
     "cumulative_revenue_share": Column(float)
-})
+}, name="sales_revenue_by_region_outgoing")
 
 
 def validate_sales_revenue_by_region_outgoing_schema(df: pd.DataFrame) -> pd.DataFrame:
-    return sales_revenue_by_region_outgoing_schema.validate(df)
+    return validate(sales_revenue_by_region_outgoing_schema, df)
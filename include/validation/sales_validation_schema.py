@@ -3,7 +3,10 @@ import pandas as pd
 import pandera.pandas as pa
 
 from pandera.pandas import Column, Check
-from pandera.errors import SchemaError
+from pandera.errors import SchemaError, SchemaErrors
+
+from include.validation.memory_lean_schema import memory_lean_schema
+from include.validation.validation_policy import validate
 
 logger = logging.getLogger(__name__)
 
@@ -17,7 +20,7 @@ sales_entry_schema = pa.DataFrameSchema({
     "Time stamp": pa.Column(str),
     "discount": pa.Column(float),
     "order_status": pa.Column(str)
-})
+}, name="sales_entry")
 
 
 sales_outgoing_schema = pa.DataFrameSchema({
@@ -30,16 +33,19 @@ sales_outgoing_schema = pa.DataFrameSchema({
     "discount": Column(float),
     "order_status": Column(str),
     "total_sales": Column(float)
-})
+}, name="sales_outgoing")
+
+sales_outgoing_lean_schema = memory_lean_schema(sales_outgoing_schema)
 
 
 def validate_sales_entry_schema(sales_df:pd.DataFrame):
     try:
-        return sales_entry_schema.validate(sales_df)
-    except SchemaError as e:
+        return validate(sales_entry_schema, sales_df)
+    except (SchemaError, SchemaErrors) as e:
         logger.error(f"Entry schema validation failed: {e.failure_cases}")
         return sales_df
 
 
-def validate_sales_outgoing_schema(sales_df:pd.DataFrame):
-    return sales_outgoing_schema.validate(sales_df)
+def validate_sales_outgoing_schema(sales_df: pd.DataFrame, memory_lean: bool = False):
+    schema = sales_outgoing_lean_schema if memory_lean else sales_outgoing_schema
+    return validate(schema, sales_df)
@@ -5,6 +5,8 @@ import pandera.pandas as pa
 from pandera.pandas import Column, Check
 from pandera.errors import SchemaError
 
+from include.validation.validation_policy import validate
+
 logger = logging.getLogger(__name__)
 
 sales_seasonality_outgoing_schema = pa.DataFrameSchema({
@@ -12,8 +14,8 @@ sales_seasonality_outgoing_schema = pa.DataFrameSchema({
     "month": Column(str),
     "monthly_total_sales": Column(float),
     "monthly_total_quantity": Column(int)
-})
+}, name="sales_seasonality_outgoing")
 
 
 def validate_sales_seasonality_outgoing_schema(df: pd.DataFrame):
-    return sales_seasonality_outgoing_schema.validate(df)
\ No newline at end of file
+    return validate(sales_seasonality_outgoing_schema, df)
\ No newline at end of file
@@ -0,0 +1,203 @@
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+import pandera.pandas as pa
+from pandera.errors import SchemaErrors
+from pandera.pandas import Check
+
+from include.instrumentation import stage
+
+logger = logging.getLogger(__name__)
+
+# Validation policy, set once per process from the validation section of config.yaml with configure_validation.
+validation_policy = {
+    "default_mode": "full",
+    "sample_rows": 10_000,
+    "chunk_rows": 500_000,
+    "max_workers": 4,
+    "schemas": {},
+}
+
+# Last validation timing of every schema, by schema name.
+validation_timings = {}
+
+
+def configure_validation(policy: dict) -> None:
+    validation_policy.update(policy)
+
+
+def schema_mode(schema: pa.DataFrameSchema) -> str:
+    return validation_policy["schemas"].get(schema.name, validation_policy["default_mode"])
+
+
+def on_unique_values(predicate):
+    """
+    Vectorized element-wise check: the predicate runs on the unique values of the column only,
+    then every row is looked up in the passing values. Meant for string checks on low-cardinality columns.
+    """
+    def check(column: pd.Series) -> pd.Series:
+        uniques = pd.Series(column.dropna().unique())
+        return column.isin(uniques[predicate(uniques).to_numpy(dtype=bool)]) | column.isna()
+    return check
+
+
+def _is_str(column: pd.Series):
+    """
+    Vectorized replacement of the str dtype check of pandera, that calls isinstance on every value.
+    The column (or the categories of a categorical) is scanned in C, single values are only looked at on failure.
+    """
+    values = column.cat.categories if isinstance(column.dtype, pd.CategoricalDtype) else column
+    if pd.api.types.infer_dtype(values, skipna=True) in ("string", "empty"):
+        return True
+    return column.map(lambda value: isinstance(value, str)).astype(bool) | column.isna()
+
+
+# Checks standing for a column dtype, kept by the dtype validation mode.
+DTYPE_CHECKS = {"str_dtype", "integer_dtype"}
+
+_prepared_schemas = {}
+
+
+def _vectorized_schema(schema: pa.DataFrameSchema) -> pa.DataFrameSchema:
+    str_columns = [name for name, column in schema.columns.items() if str(column.dtype) == "str"]
+    str_check = Check(_is_str, name="str_dtype", ignore_na=False)
+    return schema.update_columns({
+        name: {"dtype": None, "checks": [str_check, *schema.columns[name].checks]} for name in str_columns
+    })
+
+
+def _structural_schema(schema: pa.DataFrameSchema) -> pa.DataFrameSchema:
+    structural = schema.update_columns({
+        name: {"checks": [check for check in column.checks if check.name in DTYPE_CHECKS], "nullable": True}
+        for name, column in schema.columns.items()
+    })
+    structural.checks = []
+    return structural
+
+
+def _prepared(schema: pa.DataFrameSchema):
+    """Vectorized and structural variants of a schema, built once per schema object."""
+    if id(schema) not in _prepared_schemas:
+        vectorized = _vectorized_schema(schema)
+        _prepared_schemas[id(schema)] = (schema, vectorized, _structural_schema(vectorized))
+    _, vectorized, structural = _prepared_schemas[id(schema)]
+    return vectorized, structural
+
+
+def _validate_full(schema, df):
+    """Chunks of chunk_rows rows are validated in parallel. Failures of every chunk are reported together."""
+    chunk_rows = validation_policy["chunk_rows"]
+    if len(df.index) <= chunk_rows:
+        return schema.validate(df, lazy=True, inplace=True)
+
+    chunks = [df.iloc[start:start + chunk_rows] for start in range(0, len(df.index), chunk_rows)]
+
+    def validate_chunk(chunk):
+        try:
+            schema.validate(chunk, lazy=True, inplace=True)
+            return []
+        except SchemaErrors as e:
+            return e.schema_errors
+
+    with ThreadPoolExecutor(max_workers=validation_policy["max_workers"], thread_name_prefix="validation") as executor:
+        schema_errors = [error for errors in executor.map(validate_chunk, chunks) for error in errors]
+    if schema_errors:
+        raise SchemaErrors(schema, schema_errors, df)
+    return df
+
+
+def _validate_head(schema, df):
+    schema.validate(df.head(validation_policy["sample_rows"]), lazy=True, inplace=True)
+    return df
+
+
+def _validate_sample(schema, df):
+    sample_rows = min(validation_policy["sample_rows"], len(df.index))
+    schema.validate(df.sample(sample_rows, random_state=0), lazy=True, inplace=True)
+    return df
+
+
+def _validate_structure(schema, df):
+    return schema.validate(df, lazy=True, inplace=True)
+
+
+def _skip(schema, df):
+    return df
+
+
+# full: every row, head / sample: the first or random sample_rows rows, dtype: columns and dtypes only.
+VALIDATION_MODES = {
+    "full": _validate_full,
+    "head": _validate_head,
+    "sample": _validate_sample,
+    "dtype": _validate_structure,
+    "off": _skip,
+}
+
+
+def validate(schema: pa.DataFrameSchema, df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Validates the frame with the mode configured for the schema and records the time it took.
+    Errors are collected lazily, so a SchemaErrors reports every failing column and check at once.
+    The schemas don't coerce, so the frame is validated in place instead of copied first.
+    """
+    mode = schema_mode(schema)
+    if mode not in VALIDATION_MODES:
+        raise ValueError(f"{mode} validation mode is not supported")
+
+    started = time.perf_counter()
+    vectorized, structural = _prepared(schema)
+    try:
+        with stage(f"validate.{schema.name}", rows_in=len(df.index), mode=mode):
+            return VALIDATION_MODES[mode](structural if mode == "dtype" else vectorized, df)
+    finally:
+        seconds = round(time.perf_counter() - started, 3)
+        validation_timings[schema.name] = {"mode": mode, "rows": len(df.index), "seconds": seconds}
+        logger.info(f"Validated {schema.name} schema ({mode}) on {len(df.index)} rows in {seconds} seconds")
+
+
+def validate_table(schema: pa.DataFrameSchema, table, raise_errors: bool = True):
+    """
+    Validates an Arrow table with the same schemas and modes, converting to pandas only the rows the mode needs.
+    In full mode the table is converted and validated one batch of chunk_rows rows at a time.
+    Without raise_errors, like for the entry schemas, failures are only logged.
+    """
+    mode = schema_mode(schema)
+    if mode not in VALIDATION_MODES:
+        raise ValueError(f"{mode} validation mode is not supported")
+    if mode == "off":
+        return table
+
+    sample_rows = min(validation_policy["sample_rows"], table.num_rows)
+    if mode == "full":
+        batches = table.to_batches(max_chunksize=validation_policy["chunk_rows"])
+    elif mode == "sample":
+        batches = [table.take(np.random.default_rng(0).choice(table.num_rows, sample_rows, replace=False))]
+    else:
+        batches = [table.slice(0, sample_rows)]
+
+    started = time.perf_counter()
+    vectorized, structural = _prepared(schema)
+    schema_errors, failed_df = [], None
+    with stage(f"validate.{schema.name}", rows_in=table.num_rows, mode=mode):
+        for batch in batches:
+            df = batch.to_pandas()
+            try:
+                (structural if mode == "dtype" else vectorized).validate(df, lazy=True, inplace=True)
+            except SchemaErrors as e:
+                schema_errors.extend(e.schema_errors)
+                failed_df = df if failed_df is None else failed_df
+    seconds = round(time.perf_counter() - started, 3)
+    validation_timings[schema.name] = {"mode": mode, "rows": table.num_rows, "seconds": seconds}
+    logger.info(f"Validated {schema.name} schema ({mode}) on {table.num_rows} Arrow rows in {seconds} seconds")
+
+    if schema_errors:
+        # SchemaErrors only takes pandas data, the first failing batch stands for the table.
+        errors = SchemaErrors(schema, schema_errors, failed_df)
+        if raise_errors:
+            raise errors
+        logger.error(f"Entry schema validation failed: {errors.failure_cases}")
+    return table
@@ -5,6 +5,8 @@ import pandera.pandas as pa
 from pandera.pandas import Column, Check
 from pandera.errors import SchemaError
 
+from include.validation.validation_policy import validate
+
 logger = logging.getLogger(__name__)
 
 weekly_order_counts_by_status_schema = pa.DataFrameSchema({
@@ -12,8 +14,8 @@ weekly_order_counts_by_status_schema = pa.DataFrameSchema({
     "Pending": Column(float),
     "Shipped": Column(float),
     "Returned": Column(float)
-})
+}, name="weekly_order_counts_by_status")
 
 
 def validate_weekly_order_counts_by_status(df: pd.DataFrame):
-    return weekly_order_counts_by_status_schema.validate(df)
\ No newline at end of file
+    return validate(weekly_order_counts_by_status_schema, df)
\ No newline at end of file
@@ -0,0 +1,51 @@
+import pytest
+
+from benchmarks.run_benchmarks import TRANSFORM_STAGES, parse_rows, regressions, run_benchmarks
+from benchmarks.synthetic_data import iter_sales_chunks, synthetic_sales
+
+THRESHOLDS = {"default": {"max_throughput_drop": 0.2, "max_peak_memory_growth": 0.25, "min_seconds": 0.05,
+                          "min_memory_mb": 16}}
+
+
+def results(rows_per_second, seconds=1.0, peak_memory_mb=100.0):
+    return {"rows": 1_000, "memory_lean": False, "benchmarks": {
+        "transform.sales_data_transformation": {"rows": 1_000, "seconds": seconds, "rows_per_second": rows_per_second,
+                                                "peak_memory_mb": peak_memory_mb}}}
+
+
+def test_synthetic_sales_are_messy_and_reproducible():
+    sales_df = synthetic_sales(20_000, products=100)
+
+    assert list(sales_df.columns[:2]) == ["sales id", "proDuct Id"]
+    assert "Time stamp" in sales_df.columns
+    assert sales_df["Region"].isna().any() and sales_df.duplicated().any()
+    assert (sales_df["proDuct Id"] > 100).any()
+    assert sales_df.equals(synthetic_sales(20_000, products=100))
+    assert [len(chunk) for chunk in iter_sales_chunks(25_000, 100, chunk_rows=10_000)] == [10_000, 10_000, 5_000]
+
+
+def test_every_stage_is_measured():
+    benchmark_results = run_benchmarks(2_000)
+
+    names = set(benchmark_results["benchmarks"])
+    assert {f"transform.{name}" for name, _, _ in TRANSFORM_STAGES} <= names
+    assert {"extract.extract_to_storage", "load.load_targets.replace", "load.load_targets.upsert"} <= names
+    assert all(measures["rows_per_second"] > 0 for measures in benchmark_results["benchmarks"].values())
+    assert regressions(benchmark_results, benchmark_results, THRESHOLDS) == []
+
+
+def test_regressions_beyond_the_thresholds_are_reported():
+    assert regressions(results(850), results(1_000), THRESHOLDS) == []
+    assert len(regressions(results(700), results(1_000), THRESHOLDS)) == 1
+    assert len(regressions(results(1_000, peak_memory_mb=130), results(1_000), THRESHOLDS)) == 1
+    # Too short to compare.
+    assert regressions(results(100, seconds=0.01), results(1_000, seconds=0.001), THRESHOLDS) == []
+
+
+def test_results_of_another_scale_are_not_compared():
+    with pytest.raises(ValueError, match="can't be compared"):
+        regressions(results(1_000), {**results(1_000), "rows": 2_000}, THRESHOLDS)
+
+
+def test_scales_with_suffixes():
+    assert [parse_rows(rows) for rows in ("10k", "1M", "50M", "2500")] == [10_000, 1_000_000, 50_000_000, 2_500]
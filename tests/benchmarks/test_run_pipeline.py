@@ -0,0 +1,140 @@
+import json
+from datetime import datetime, timezone
+from unittest import mock
+
+import sqlalchemy
+
+from benchmarks.run_pipeline import run_pipeline, run_tasks, synthetic_inputs, task_context
+from include.dag_config import RUN_ROWS_TARGETS, load_config
+from include.load import load_targets
+
+
+def test_every_task_runs_locally_and_is_profiled(tmp_path):
+    summary = run_pipeline(str(tmp_path), rows=500, profile=True, top=5)
+
+    assert summary["inputs"] == ["raw/products.json", "raw/sales.csv"]
+    assert [record["task"] for record in summary["tasks"]][0] == "extract_group.extract_files"
+    assert {record["task"] for record in summary["tasks"]} >= {"loading_group.snowflake_batch_loading",
+                                                               "commit_run_state"}
+    assert all(record["state"] == "success" for record in summary["tasks"])
+    assert json.loads((tmp_path / "run.json").read_text()) == summary
+
+    loading = next(record for record in summary["tasks"] if record["task"] == "loading_group.snowflake_batch_loading")
+    assert len(loading["profile"]["hotspots"]) == 5
+    assert any("include/load.py" in row["line"] for row in loading["profile"]["allocations"]["by_pipeline_line"])
+    profile_folder = tmp_path / "profile"
+    assert (profile_folder / "loading_group.snowflake_batch_loading.prof").exists()
+    assert "Memory held at the peak" in (profile_folder / "loading_group.snowflake_batch_loading.txt").read_text()
+
+    engine = sqlalchemy.create_engine(f"sqlite:///{tmp_path / 'business_layer.db'}")
+    with engine.connect() as connection:
+        assert connection.exec_driver_sql("SELECT COUNT(*) FROM enriched_data").scalar() > 0
+    engine.dispose()
+
+
+
+def warehouse_rows(folder, schema: str, table: str) -> int:
+    engine = sqlalchemy.create_engine(f"sqlite:///{folder / f'{schema}.db'}")
+    with engine.connect() as connection:
+        rows = connection.exec_driver_sql(f"SELECT COUNT(*) FROM {table}").scalar()
+    engine.dispose()
+    return rows
+
+
+def test_a_rerun_of_the_same_objects_loads_nothing_and_commits_its_state(tmp_path):
+    def incremental_config(path):
+        config = load_config(path)
+        config["extraction"]["mode"] = "incremental"
+        config["analytics"]["mode"] = "incremental"
+        config["deduplication"]["enabled"] = True
+        for name in RUN_ROWS_TARGETS:
+            config["snowflake"]["targets"][name]["load_mode"] = "upsert"
+        return config
+
+    manifest_file = tmp_path / "storage" / "state" / "extraction_manifest.json"
+    with mock.patch("include.dag_config.load_config", incremental_config):
+        run_pipeline(str(tmp_path), rows=500)
+        first_manifest = json.loads(manifest_file.read_text())
+        loaded_rows = warehouse_rows(tmp_path, "business_layer", "enriched_data")
+        # The files are uploaded again, so they are extracted again and every sales row is dropped as loaded.
+        summary = run_pipeline(str(tmp_path), rows=500)
+
+    assert all(record["state"] == "success" for record in summary["tasks"])
+    assert json.loads(manifest_file.read_text())["watermark"] > first_manifest["watermark"]
+    assert warehouse_rows(tmp_path, "business_layer", "enriched_data") == loaded_rows
+
+
+def test_full_runs_replace_the_committed_sales_sketch(tmp_path):
+    def quantile_config(path):
+        config = load_config(path)
+        config["sales_buckets"]["mode"] = "quantile"
+        return config
+
+    sketch_file = tmp_path / "storage" / "state" / "sales_buckets" / "sketch.json"
+    with mock.patch("include.dag_config.load_config", quantile_config):
+        for _ in range(2):
+            summary = run_pipeline(str(tmp_path), rows=500)
+            assert all(record["state"] == "success" for record in summary["tasks"])
+            # Every full run extracts every sale again, each is counted once.
+            sketch = json.loads(sketch_file.read_text())["sketch"]
+            assert sketch["count"] == warehouse_rows(tmp_path, "business_layer", "enriched_data") > 0
+
+
+def test_partitioned_mode_transforms_every_sales_file_in_its_own_mapped_task(tmp_path):
+    input_folder = synthetic_inputs(str(tmp_path / "inputs"), 600)
+    header, *lines = (tmp_path / "inputs" / "sales.csv").read_text().splitlines(keepends=True)
+    (tmp_path / "inputs" / "sales.csv").unlink()
+    for part, part_lines in enumerate([lines[:300], lines[300:]]):
+        (tmp_path / "inputs" / f"sales_{part}.csv").write_text(header + "".join(part_lines))
+
+    def partitioned_config(path):
+        config = load_config(path)
+        config["transform"]["partitioned"] = True
+        return config
+
+    with mock.patch("include.dag_config.load_config", partitioned_config), \
+            mock.patch("include.load.load_targets", wraps=load_targets) as loading:
+        summary = run_pipeline(str(tmp_path / "run"), input_folder=input_folder)
+
+    assert all(record["state"] == "success" for record in summary["tasks"])
+    partitions = [record for record in summary["tasks"]
+                  if record["task"] == "transform_group.transform_sales_partition"]
+    assert [record["map_index"] for record in partitions] == [0, 1]
+    targets = {target["table"]: target for target in loading.call_args.args[0]}
+    for table in ["sales_data", "merged_data", "enriched_data"]:
+        assert isinstance(targets[table]["reference"], list) and len(targets[table]["reference"]) == 2
+    enriched_rows = sum(reference["rows"] for reference in targets["enriched_data"]["reference"])
+    assert warehouse_rows(tmp_path / "run", "business_layer", "enriched_data") == enriched_rows > 0
+
+
+def test_a_skipped_map_index_leaves_the_results_of_the_others_to_the_downstream_tasks():
+    from airflow.decorators import dag, task
+    from airflow.exceptions import AirflowSkipException
+
+    totals = []
+
+    @dag(schedule=None)
+    def skipping():
+        @task
+        def numbers():
+            return [1, 2, 3]
+
+        @task
+        def odd(number):
+            if number % 2 == 0:
+                raise AirflowSkipException("Even number")
+            return number
+
+        @task
+        def total(values):
+            totals.append(sum(values))
+
+        total(odd.expand(number=numbers()))
+
+    dag = skipping()
+    records = run_tasks(dag, task_context(dag, "manual", datetime.now(timezone.utc), {}))
+
+    assert [(record["task"], record["map_index"], record["state"]) for record in records] == [
+        ("numbers", -1, "success"), ("odd", 0, "success"), ("odd", 1, "skipped"), ("odd", 2, "success"),
+        ("total", -1, "success")]
+    assert totals == [4]
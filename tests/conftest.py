@@ -0,0 +1,35 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+
+@pytest.fixture
+def raw_sales_df():
+    """Sales data as read from the CSV file, with the messy column names and a few rows to clean."""
+    rng = np.random.default_rng(42)
+    rows = 2_000
+    return pd.DataFrame({
+        "sales id": np.arange(rows),
+        "proDuct Id": rng.integers(1, 60, rows),
+        "Region": rng.choice([" North", "south ", "East", "WEST"], rows),
+        "qty": rng.integers(0, 10, rows),
+        "Price": rng.uniform(-5, 300, rows).round(2),
+        "Time stamp": pd.date_range("2024-01-01", periods=rows, freq="97min").astype(str),
+        "discount": rng.choice([0.0, 2.5, 10.0], rows),
+        "order_status": rng.choice(["Pending", "Shipped", "Returned"], rows),
+    })
+
+
+@pytest.fixture
+def raw_products_df():
+    """Products data as read from the JSON file."""
+    rng = np.random.default_rng(7)
+    rows = 50
+    return pd.DataFrame({
+        "product_id": np.arange(1, rows + 1),
+        "category": rng.choice(["Electronics", "Toys", "Books"], rows),
+        "brand": rng.choice(["acme", "Globex"], rows),
+        "rating": rng.uniform(1, 5, rows),
+        "in_stock": rng.choice([True, False], rows),
+        "launch_date": pd.date_range("2020-01-01", periods=rows, freq="W").strftime("%Y-%m-%d"),
+    })
@@ -0,0 +1,35 @@
+import pandas as pd
+
+from include.calendar_dimension import calendar_attributes, calendar_dimension
+
+
+def test_calendar_attributes_match_the_row_by_row_datetime_accessors():
+    timestamps = pd.Series(pd.date_range("2023-12-30", periods=500, freq="37min").astype(str))
+    parsed = pd.to_datetime(timestamps)
+
+    attributes = calendar_attributes(timestamps, ["year", "quarter", "month", "week", "weekday", "hour"])
+
+    assert attributes["year"].tolist() == parsed.dt.year.tolist()
+    assert attributes["quarter"].tolist() == parsed.dt.to_period("Q").astype(str).tolist()
+    assert attributes["month"].tolist() == parsed.dt.month_name().tolist()
+    assert attributes["week"].tolist() == parsed.dt.isocalendar().week.tolist()
+    assert attributes["weekday"].tolist() == parsed.dt.day_name().tolist()
+    assert attributes["hour"].tolist() == parsed.dt.hour.tolist()
+
+
+def test_calendar_dimension_has_one_row_per_distinct_hour():
+    timestamps = pd.Series(pd.to_datetime(["2024-01-01 10:05", "2024-01-01 10:55", None, "2024-01-01 11:00"]))
+
+    codes, dimension = calendar_dimension(timestamps, ["hour"])
+
+    assert dimension["hour"].tolist() == [10, 11]
+    assert codes.tolist() == [0, 0, -1, 1]
+
+
+def test_categorical_calendar_attributes_are_compact():
+    timestamps = pd.Series(pd.date_range("2024-01-01", periods=100, freq="h"))
+
+    attributes = calendar_attributes(timestamps, ["month", "hour"], categorical=True)
+
+    assert isinstance(attributes["month"].dtype, pd.CategoricalDtype)
+    assert attributes["hour"].dtype == "int8"
@@ -0,0 +1,57 @@
+import os
+import sys
+
+import pytest
+
+from include import dag_config
+from include.dag_config import load_config, validate_config
+
+
+def test_config_is_reloaded_only_when_the_file_changes(tmp_path, monkeypatch):
+    monkeypatch.setattr(dag_config, "SNAPSHOT_FOLDER", str(tmp_path / "snapshots"))
+    monkeypatch.setattr(dag_config, "_parsed_configs", {})
+    config_path = tmp_path / "config.yaml"
+    config_path.write_text("transform:\n  bins: [0, 100, .inf]\n")
+
+    config = load_config(str(config_path))
+    assert config == {"transform": {"bins": [0, 100, float("inf")]}}
+    config["transform"]["bins"].append(1)
+    assert load_config(str(config_path)) == {"transform": {"bins": [0, 100, float("inf")]}}
+
+    # A fresh process reads the snapshot, yaml isn't even imported.
+    dag_config._parsed_configs.clear()
+    with monkeypatch.context() as patch:
+        patch.setitem(sys.modules, "yaml", None)
+        assert load_config(str(config_path)) == {"transform": {"bins": [0, 100, float("inf")]}}
+
+    config_path.write_text("transform:\n  bins: [0, 200, .inf]\n")
+    stat = config_path.stat()
+    os.utime(config_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000))
+    assert load_config(str(config_path)) == {"transform": {"bins": [0, 200, float("inf")]}}
+
+
+def incremental_config(analytics_mode: str = "incremental", sales_load_mode: str = "upsert") -> dict:
+    return {"extraction": {"mode": "incremental"}, "analytics": {"mode": analytics_mode},
+            "snowflake": {"targets": {"sales": {"load_mode": sales_load_mode}, "products": {"load_mode": "upsert"},
+                                      "trends": {}}}}
+
+
+def test_incremental_extraction_needs_incremental_analytics_and_upserted_targets():
+    validate_config(incremental_config())
+    validate_config({**incremental_config(analytics_mode="fused"), "extraction": {"mode": "full"}})
+
+    with pytest.raises(ValueError, match="incremental analytics mode"):
+        validate_config(incremental_config(analytics_mode="fused"))
+    with pytest.raises(ValueError, match="upsert load_mode for the sales targets"):
+        validate_config(incremental_config(sales_load_mode="replace"))
+
+
+def test_invalid_config_is_rejected_when_loaded(tmp_path, monkeypatch):
+    monkeypatch.setattr(dag_config, "SNAPSHOT_FOLDER", str(tmp_path / "snapshots"))
+    monkeypatch.setattr(dag_config, "_parsed_configs", {})
+    config_path = tmp_path / "config.yaml"
+    config_path.write_text("extraction: {mode: incremental}\nanalytics: {mode: separate}\n")
+
+    with pytest.raises(ValueError, match="separate mode"):
+        load_config(str(config_path))
+    assert not (tmp_path / "snapshots").exists()
@@ -0,0 +1,79 @@
+import numpy as np
+import pyarrow as pa
+import pytest
+
+from include.deduplication import bloom_add, bloom_contains, commit_fingerprints, deduplicate, load_store
+
+
+@pytest.fixture
+def dedup_config():
+    return {"store_key": "state/fingerprints/sales", "key_columns": None, "bloom_bits": 8192, "bloom_hashes": 3,
+            "max_segments": 2}
+
+
+@pytest.fixture
+def storage_config(tmp_path):
+    return {"backend": "local", "path": str(tmp_path)}
+
+
+def run(df, dedup_config, storage_config, run_id):
+    """Deduplicates a batch and commits its fingerprints, like a successful DAG run."""
+    pending_key = f"{run_id}/fingerprints.bin"
+    df, dropped_rows = deduplicate(df, dedup_config, storage_config, pending_key)
+    commit_fingerprints([pending_key], dedup_config, storage_config)
+    return df, dropped_rows
+
+
+def test_rows_of_earlier_runs_and_repeated_rows_are_dropped(raw_sales_df, dedup_config, storage_config):
+    first_df, dropped_rows = run(raw_sales_df.iloc[:1200], dedup_config, storage_config, "run_1")
+    assert dropped_rows == 0
+
+    # An overlapping file, with a row repeated in the batch itself.
+    batch_df = raw_sales_df.iloc[[*range(1000, 2000), 1500]]
+    second_df, dropped_rows = run(batch_df, dedup_config, storage_config, "run_2")
+
+    assert dropped_rows == 201
+    assert second_df.equals(raw_sales_df.iloc[1200:])
+
+
+def test_pending_fingerprints_are_only_stored_on_commit(raw_sales_df, dedup_config, storage_config):
+    deduplicate(raw_sales_df, dedup_config, storage_config, "failed_run/fingerprints.bin")
+
+    df, dropped_rows = deduplicate(raw_sales_df, dedup_config, storage_config, "run_2/fingerprints.bin")
+
+    assert dropped_rows == 0
+
+
+def test_business_key_fingerprints_on_arrow_tables(raw_sales_df, dedup_config, storage_config):
+    dedup_config["key_columns"] = ["sales id"]
+    run(pa.Table.from_pandas(raw_sales_df.iloc[:500]), dedup_config, storage_config, "run_1")
+
+    corrected_df = raw_sales_df.iloc[400:600].assign(qty=99)
+    table, dropped_rows = run(pa.Table.from_pandas(corrected_df), dedup_config, storage_config, "run_2")
+
+    assert dropped_rows == 100
+    assert table["sales id"].to_pylist() == list(range(500, 600))
+
+
+def test_segments_are_merged_and_the_bloom_filter_rebuilt(raw_sales_df, dedup_config, storage_config):
+    for run_number, start in enumerate(range(0, 2000, 400)):
+        run(raw_sales_df.iloc[start:start + 400], dedup_config, storage_config, f"run_{run_number}")
+    dedup_config["bloom_bits"] = 16384
+    run(raw_sales_df.iloc[:0], dedup_config, storage_config, "resized_run")
+
+    store = load_store(dedup_config, storage_config)
+    assert len(store["index"]["segments"]) <= dedup_config["max_segments"]
+    assert sum(segment["rows"] for segment in store["index"]["segments"]) == 2000
+    assert len(store["bloom"]) * 8 == 16384
+    _, dropped_rows = deduplicate(raw_sales_df, dedup_config, storage_config, "run_last/fingerprints.bin")
+    assert dropped_rows == 2000
+
+
+def test_bloom_filter_has_no_false_negatives():
+    fingerprints = np.random.default_rng(0).integers(0, 2 ** 63, 1000, dtype=np.uint64)
+    bloom = np.zeros(2048, dtype=np.uint8)
+
+    bloom_add(bloom, fingerprints[:500], 4)
+
+    assert bloom_contains(bloom, fingerprints[:500], 4).all()
+    assert bloom_contains(bloom, fingerprints[500:], 4).mean() < 0.05
@@ -0,0 +1,199 @@
+"""Extraction tests against a moto S3 stand-in."""
+
+import gzip
+import io
+
+import boto3
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pytest
+from botocore.client import BaseClient
+
+from include.extract_s3_data import extract_files, extract_to_storage, iter_extract_chunks, try_to_extract
+from include.instrumentation import PeakRss
+from include.intermediate_storage import promote, read_frame
+
+moto = pytest.importorskip("moto")
+
+BUCKET = "test-bucket"
+FOLDER = "raw"
+
+
+@pytest.fixture
+def s3_bucket(monkeypatch):
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    with moto.mock_aws():
+        client = boto3.client("s3", region_name="us-east-1")
+        client.create_bucket(Bucket=BUCKET)
+        yield client
+
+
+def sales_csv(rows):
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame({
+        "sales id": np.arange(rows),
+        "proDuct Id": rng.integers(1, 500, rows),
+        "Region": rng.choice(["north", "south", "east", "west"], rows),
+        "qty": rng.integers(1, 10, rows),
+        "Price": rng.uniform(1, 300, rows).round(2),
+        "Time stamp": "2024-01-01 10:00:00",
+        "discount": rng.choice([0.0, 2.5, 10.0], rows),
+        "order_status": rng.choice(["Pending", "Shipped", "Returned"], rows),
+    })
+    return df.to_csv(index=False).encode("utf-8")
+
+
+def test_streaming_returns_all_rows_in_bounded_chunks(s3_bucket):
+    s3_bucket.put_object(Bucket=BUCKET, Key=f"{FOLDER}/sales.csv", Body=sales_csv(10_000))
+
+    chunks = list(iter_extract_chunks(BUCKET, FOLDER, aws_conn_id=None, file_ext="csv", chunksize=3_000))
+
+    assert [len(chunk) for _, chunk in chunks] == [3_000, 3_000, 3_000, 1_000]
+    assert {key for key, _ in chunks} == {f"{FOLDER}/sales.csv"}
+    streamed = pd.concat([chunk for _, chunk in chunks], ignore_index=True)
+    expected = pd.read_csv(io.BytesIO(sales_csv(10_000)))
+    pd.testing.assert_frame_equal(streamed, expected)
+
+
+def test_streaming_peak_memory_is_about_one_chunk(s3_bucket):
+    body = sales_csv(1_500_000)
+    s3_bucket.put_object(Bucket=BUCKET, Key=f"{FOLDER}/sales.csv", Body=body)
+    del body
+
+    with PeakRss(0.002) as streaming:
+        rows = sum(len(chunk) for _, chunk in
+                   iter_extract_chunks(BUCKET, FOLDER, aws_conn_id=None, file_ext="csv", chunksize=50_000))
+
+    with PeakRss(0.002) as whole_file:
+        dfs = try_to_extract(BUCKET, FOLDER, aws_conn_id=None, file_ext="csv")
+        frame_rows = len(dfs[f"{FOLDER}/sales.csv"])
+        del dfs
+
+    assert rows == frame_rows == 1_500_000
+    assert streaming.growth < whole_file.growth / 2
+
+
+def test_extract_to_storage_writes_chunks_incrementally(s3_bucket, tmp_path):
+    s3_bucket.put_object(Bucket=BUCKET, Key=f"{FOLDER}/sales.csv", Body=sales_csv(10_000))
+    storage_config = {"backend": "local", "path": str(tmp_path), "format": "parquet", "compression": "zstd"}
+
+    references = extract_to_storage(BUCKET, FOLDER, aws_conn_id=None, storage_config=storage_config,
+                                    key_prefix="run", file_exts=["csv"], chunksize=3_000)
+
+    reference = references["files"][f"{FOLDER}/sales.csv"]
+    assert reference["rows"] == 10_000
+    pd.testing.assert_frame_equal(read_frame(reference), pd.read_csv(io.BytesIO(sales_csv(10_000))))
+
+
+def test_extract_files_returns_every_matching_object(s3_bucket):
+    for day in range(1, 4):
+        s3_bucket.put_object(Bucket=BUCKET, Key=f"{FOLDER}/sales_2024-01-0{day}.csv", Body=sales_csv(100))
+    s3_bucket.put_object(Bucket=BUCKET, Key=f"{FOLDER}/products.json", Body=b'[{"product_id": 1, "category": "toys"}]')
+    s3_bucket.put_object(Bucket=BUCKET, Key=f"{FOLDER}/readme.txt", Body=b"not data")
+
+    dfs = extract_files(BUCKET, FOLDER, aws_conn_id=None, max_workers=4)
+
+    assert sorted(dfs) == [f"{FOLDER}/products.json", f"{FOLDER}/sales_2024-01-01.csv",
+                           f"{FOLDER}/sales_2024-01-02.csv", f"{FOLDER}/sales_2024-01-03.csv"]
+    assert len(dfs[f"{FOLDER}/sales_2024-01-02.csv"]) == 100
+    assert list(try_to_extract(BUCKET, FOLDER, aws_conn_id=None, file_ext="json")) == [f"{FOLDER}/products.json"]
+
+
+def test_incremental_extraction_pulls_only_new_or_changed_objects(s3_bucket, tmp_path):
+    storage_config = {"backend": "local", "path": str(tmp_path), "format": "parquet", "compression": "zstd"}
+    manifest_key = "state/extraction_manifest.json"
+
+    def extract(run, incremental=True):
+        extracted = extract_to_storage(BUCKET, FOLDER, aws_conn_id=None, storage_config=storage_config,
+                                       key_prefix=run, manifest_key=manifest_key, incremental=incremental,
+                                       always_extract=["product"])
+        promote(extracted["manifest"], manifest_key, storage_config)
+        return sorted(extracted["files"])
+
+    s3_bucket.put_object(Bucket=BUCKET, Key=f"{FOLDER}/sales_1.csv", Body=sales_csv(10))
+    s3_bucket.put_object(Bucket=BUCKET, Key=f"{FOLDER}/products.json", Body=b'[{"product_id": 1}]')
+    assert extract("run_1") == [f"{FOLDER}/products.json", f"{FOLDER}/sales_1.csv"]
+
+    s3_bucket.put_object(Bucket=BUCKET, Key=f"{FOLDER}/sales_2.csv", Body=sales_csv(20))
+    assert extract("run_2") == [f"{FOLDER}/products.json", f"{FOLDER}/sales_2.csv"]
+    assert extract("run_3") == [f"{FOLDER}/products.json"]
+
+    s3_bucket.put_object(Bucket=BUCKET, Key=f"{FOLDER}/sales_1.csv", Body=sales_csv(30))
+    assert extract("run_4") == [f"{FOLDER}/products.json", f"{FOLDER}/sales_1.csv"]
+
+    assert extract("run_5", incremental=False) == [f"{FOLDER}/products.json", f"{FOLDER}/sales_1.csv",
+                                                   f"{FOLDER}/sales_2.csv"]
+
+
+def test_cached_extraction_downloads_only_changed_objects(s3_bucket, tmp_path, monkeypatch):
+    storage_config = {"backend": "local", "path": str(tmp_path), "format": "parquet", "compression": "zstd"}
+    cache_config = {"enabled": True, "prefix": "cache"}
+    downloaded = []
+    make_api_call = BaseClient._make_api_call
+
+    def counting_api_call(client, operation, params):
+        if operation == "GetObject":
+            downloaded.append(params["Key"])
+        return make_api_call(client, operation, params)
+
+    def extract(run):
+        return extract_to_storage(BUCKET, FOLDER, aws_conn_id=None, storage_config=storage_config, key_prefix=run,
+                                  cache_config=cache_config)["files"]
+
+    s3_bucket.put_object(Bucket=BUCKET, Key=f"{FOLDER}/sales_1.csv", Body=sales_csv(10))
+    s3_bucket.put_object(Bucket=BUCKET, Key=f"{FOLDER}/sales_2.csv", Body=sales_csv(20))
+    first_run = extract("run_1")
+    s3_bucket.put_object(Bucket=BUCKET, Key=f"{FOLDER}/sales_2.csv", Body=sales_csv(30))
+    monkeypatch.setattr(BaseClient, "_make_api_call", counting_api_call)
+    second_run = extract("run_2")
+
+    assert downloaded == [f"{FOLDER}/sales_2.csv"]
+    assert second_run[f"{FOLDER}/sales_1.csv"] == first_run[f"{FOLDER}/sales_1.csv"]
+    assert read_frame(second_run[f"{FOLDER}/sales_2.csv"]).shape[0] == 30
+
+
+def test_projected_reads_parse_only_the_schema_columns_and_kept_rows(s3_bucket, raw_sales_df, raw_products_df,
+                                                                     tmp_path):
+    storage_config = {"backend": "local", "path": str(tmp_path), "format": "parquet", "compression": "zstd"}
+    raw_sales_df.loc[::50, "Region"] = None
+    raw_sales_df["notes"] = "unused"
+    s3_bucket.put_object(Bucket=BUCKET, Key=f"{FOLDER}/sales.csv", Body=raw_sales_df.to_csv(index=False).encode())
+    s3_bucket.put_object(Bucket=BUCKET, Key=f"{FOLDER}/products.json", Body=raw_products_df.to_json(orient="records"))
+
+    extracted = extract_to_storage(BUCKET, FOLDER, aws_conn_id=None, storage_config=storage_config, key_prefix="run",
+                                   chunksize=300, reader="projected")["files"]
+    sales_df = read_frame(extracted[f"{FOLDER}/sales.csv"])
+    inferred_df = try_to_extract(BUCKET, FOLDER, aws_conn_id=None, file_ext="csv")[f"{FOLDER}/sales.csv"]
+
+    assert "notes" not in sales_df.columns and sales_df["sales id"].dtype == "int64"
+    kept = inferred_df["Region"].notna() & (inferred_df["Price"] > 0) & (inferred_df["qty"] > 0)
+    pd.testing.assert_frame_equal(sales_df, inferred_df.loc[kept, sales_df.columns].reset_index(drop=True))
+    pd.testing.assert_frame_equal(read_frame(extracted[f"{FOLDER}/products.json"]), raw_products_df)
+
+
+@pytest.mark.parametrize("reader", ["inferred", "projected"])
+def test_compressed_and_parquet_files_read_like_plain_csv(s3_bucket, tmp_path, reader):
+    storage_config = {"backend": "local", "path": str(tmp_path), "format": "parquet", "compression": "zstd"}
+    body = sales_csv(5_000)
+    expected = pd.read_csv(io.BytesIO(body))
+    parquet_body = io.BytesIO()
+    expected.to_parquet(parquet_body, row_group_size=1_000)
+    bodies = {
+        "sales_plain.csv": body,
+        "sales_gzip.csv.gz": gzip.compress(body),
+        "sales_zstd.csv.zst": pa.compress(body, "zstd", asbytes=True),
+        "sales_lines.jsonl.gz": gzip.compress(expected.to_json(orient="records", lines=True).encode()),
+        "sales_columnar.parquet": parquet_body.getvalue(),
+    }
+    for name, object_body in bodies.items():
+        s3_bucket.put_object(Bucket=BUCKET, Key=f"{FOLDER}/{name}", Body=object_body)
+
+    extracted = extract_to_storage(BUCKET, FOLDER, aws_conn_id=None, storage_config=storage_config, key_prefix="run",
+                                   chunksize=1_500, reader=reader)["files"]
+
+    assert sorted(extracted) == sorted(f"{FOLDER}/{name}" for name in bodies)
+    for name in bodies:
+        pd.testing.assert_frame_equal(read_frame(extracted[f"{FOLDER}/{name}"]), expected, obj=name)
@@ -0,0 +1,109 @@
+import threading
+
+import pytest
+
+from include import instrumentation
+from include.instrumentation import count_bytes, frame_rows, instrumented, rows_dropped, stage
+from include.intermediate_storage import read_table, write_frame
+from include.transform import merging_sales_data_with_products_data, products_data_transformation, \
+    sales_data_transformation
+
+
+@pytest.fixture
+def records(monkeypatch):
+    """Stage records emitted to an in-memory sink, in the order the stages ended."""
+    emitted = []
+    monkeypatch.setitem(instrumentation.METRIC_SINKS, "memory", emitted.append)
+    monkeypatch.setitem(instrumentation.instrumentation_policy, "sinks", ["memory"])
+    monkeypatch.setitem(instrumentation.instrumentation_policy, "enabled", True)
+    return emitted
+
+
+def test_transform_stages_record_rows_and_drops(raw_sales_df, raw_products_df, records):
+    sales_df = sales_data_transformation(raw_sales_df.copy())
+    products_df = products_data_transformation(raw_products_df.copy())
+    merging_sales_data_with_products_data(sales_df, products_df)
+
+    by_stage = {record["stage"]: record for record in records}
+    sales_record = by_stage["transform.sales_data_transformation"]
+    assert sales_record["status"] == "ok"
+    assert sales_record["rows_in"] == 2_000 and sales_record["rows_out"] == len(sales_df.index)
+    assert sales_record["rows_dropped"]["unpriced"] > 0
+    assert sum(sales_record["rows_dropped"].values()) == 2_000 - len(sales_df.index)
+    assert sales_record["wall_seconds"] > 0 and sales_record["peak_rss_mb"] > 0
+    assert by_stage["transform.merging_sales_data_with_products_data"]["rows_dropped"]["orphans"] > 0
+    # The validations of the chain are stages of their own.
+    assert "validate.sales_outgoing" in by_stage
+
+
+def test_bytes_are_counted_in_every_enclosing_stage(raw_products_df, records, tmp_path):
+    storage_config = {"backend": "local", "path": str(tmp_path)}
+    with stage("outer") as outer:
+        with stage("inner"):
+            reference = write_frame(raw_products_df, "products", storage_config)
+        read_table(reference)
+        count_bytes("bytes_read", 10)
+
+    inner, _ = records
+    assert inner["bytes_written"] == outer["bytes_written"] == reference["bytes"] > 0
+    assert inner["bytes_read"] == 0 and outer["bytes_read"] == reference["bytes"] + 10
+
+
+def test_failed_stages_are_emitted(records):
+    @instrumented
+    def failing(df):
+        rows_dropped("everything", 3, 0)
+        raise RuntimeError("failed")
+
+    with pytest.raises(RuntimeError):
+        failing([{"path": "a", "rows": 3}])
+
+    [record] = records
+    assert record["stage"] == f"{__name__.rsplit('.', 1)[-1]}.failing"
+    assert record["status"] == "error" and record["rows_in"] == 3 and record["rows_dropped"] == {"everything": 3}
+
+
+def test_unknown_sinks_are_rejected(records, monkeypatch):
+    monkeypatch.setitem(instrumentation.instrumentation_policy, "sinks", ["prometheus"])
+    with pytest.raises(ValueError, match="prometheus metric sink is not supported"):
+        with stage("stage"):
+            pass
+
+
+def test_failing_sinks_do_not_hide_the_stage_error(records, monkeypatch):
+    def broken_sink(record):
+        raise KeyError("peak_rss_mb")
+
+    monkeypatch.setitem(instrumentation.METRIC_SINKS, "broken", broken_sink)
+    monkeypatch.setitem(instrumentation.instrumentation_policy, "sinks", ["broken", "memory"])
+    with pytest.raises(RuntimeError, match="failed"):
+        with stage("stage"):
+            raise RuntimeError("failed")
+
+    [record] = records
+    assert record["status"] == "error"
+
+
+def test_nested_stages_share_the_rss_sampler_of_the_outer_stage(records):
+    def samplers():
+        return [thread for thread in threading.enumerate() if thread.name == "rss_sampler"]
+
+    with stage("outer"):
+        with stage("inner"):
+            with stage("innermost"):
+                assert len(samplers()) == 1
+    assert samplers() == []
+
+    innermost, inner, outer = records
+    assert 0 < innermost["peak_rss_mb"] <= inner["peak_rss_mb"] <= outer["peak_rss_mb"]
+
+
+def test_nothing_is_recorded_when_disabled(raw_sales_df, records, monkeypatch):
+    monkeypatch.setitem(instrumentation.instrumentation_policy, "enabled", False)
+    sales_data_transformation(raw_sales_df.copy())
+    assert records == []
+
+
+def test_rows_of_references():
+    assert frame_rows({"sales": [{"path": "a", "rows": 2}, {"path": "b", "rows": 3}], "manifest": "key"}) == 5
+    assert frame_rows("key") is None
@@ -0,0 +1,77 @@
+import os
+
+import pandas as pd
+import pytest
+
+from include.intermediate_storage import read_frame, read_frames, write_frame, write_frame_chunks
+
+
+@pytest.fixture(params=["parquet", "arrow"])
+def storage_config(request, tmp_path):
+    return {"backend": "local", "path": str(tmp_path), "format": request.param, "compression": "zstd"}
+
+
+def frame(rows: int = 5, start: int = 0) -> pd.DataFrame:
+    return pd.DataFrame({
+        "sales_id": pd.Series(range(start, start + rows), dtype="int64"),
+        "product_id": pd.Series(range(rows), dtype="int32"),
+        "qty": pd.Series(range(rows), dtype="int8"),
+        "Price": [float(row) + 0.5 for row in range(rows)],
+        "Region": pd.Categorical(["North", "South", "North", "East", "South"][:rows]),
+        "order_status": ["Pending", "Shipped", None, "Returned", "Pending"][:rows],
+        "in_stock": [True, False, True, True, False][:rows],
+        "Time_stamp": pd.date_range("2024-01-01", periods=rows, freq="h"),
+    })
+
+
+def test_frame_round_trip_keeps_the_dtypes(storage_config):
+    df = frame()
+
+    reference = write_frame(df, "run/task/sales", storage_config)
+
+    assert reference["rows"] == 5 and reference["columns"] == list(df.columns)
+    assert reference["format"] == storage_config["format"] and reference["bytes"] > 0
+    pd.testing.assert_frame_equal(read_frame(reference), df)
+
+
+def test_read_frame_projects_the_columns(storage_config):
+    reference = write_frame(frame(), "run/task/sales", storage_config)
+
+    projected = read_frame(reference, columns=["Time_stamp", "Region", "qty"])
+
+    assert list(projected.columns) == ["Time_stamp", "Region", "qty"]
+    pd.testing.assert_frame_equal(projected, frame()[["Time_stamp", "Region", "qty"]])
+
+
+def test_chunks_and_references_are_concatenated(storage_config):
+    chunks = [frame(), frame(start=5)]
+    reference = write_frame_chunks(chunks, "run/task/chunked", storage_config)
+    other = write_frame(frame(start=10), "run/task/other", storage_config)
+
+    combined = read_frames([reference, other], columns=["sales_id", "qty"])
+
+    assert reference["rows"] == 10
+    assert combined["sales_id"].tolist() == list(range(15))
+    assert combined["qty"].dtype == "int8"
+
+
+def test_chunks_with_other_column_types_are_rejected(storage_config):
+    mismatched = frame().assign(Time_stamp="not a date")
+
+    with pytest.raises(ValueError, match="doesn't match the column types"):
+        write_frame_chunks([frame(), mismatched], "run/task/mismatched", storage_config)
+
+
+def test_chunk_column_types_are_widened_for_later_chunks(storage_config):
+    first = pd.DataFrame({"qty": [1.0, 2.0], "brand": [None, None], "sales_id": [0, 1]})
+    second = pd.DataFrame({"qty": [2.5, 3.0], "brand": ["acme", None], "sales_id": [2, 3]})
+    third = pd.DataFrame({"qty": [4, 5], "brand": ["Globex", "acme"], "sales_id": [4, 5]})
+    first = first.astype({"qty": "int64"})
+
+    reference = write_frame_chunks([first, second, third], "run/raw/sales", storage_config)
+
+    expected = pd.DataFrame({"qty": [1.0, 2.0, 2.5, 3.0, 4.0, 5.0],
+                             "brand": [None, None, "acme", None, "Globex", "acme"], "sales_id": range(6)})
+    assert reference["rows"] == 6
+    pd.testing.assert_frame_equal(read_frame(reference), expected)
+    assert os.listdir(os.path.dirname(reference["path"])) == [f"sales.{storage_config['format']}"]
@@ -0,0 +1,229 @@
+"""Loader tests against local stand-ins: a fake Snowflake cursor and SQLite."""
+
+import pandas as pd
+import pyarrow.parquet as pq
+import pytest
+import sqlalchemy
+
+from include.intermediate_storage import write_frame
+from include.load import (bulk_load, insert_load, load_targets, merge_statements, prepare_statements,
+                          replace_statements, stage_and_copy, swap_statements, write_parquet_files)
+
+
+class RecordingCursor:
+    """Fake Snowflake cursor, that records the executed statements."""
+
+    def __init__(self):
+        self.statements = []
+
+    def execute(self, statement):
+        self.statements.append(statement)
+
+
+def frame(rows):
+    return pd.DataFrame({
+        "sales_id": range(rows),
+        "Region": ["north", "south"] * (rows // 2),
+        "Time_stamp": pd.date_range("2024-01-01", periods=rows, freq="h"),
+        "total_sales": [1.5] * rows,
+    })
+
+
+def test_write_parquet_files_splits_by_max_rows(tmp_path):
+    paths = write_parquet_files(frame(10), str(tmp_path), max_rows_per_file=4)
+
+    assert [pq.read_metadata(path).num_rows for path in paths] == [4, 4, 2]
+    roundtrip = pd.concat([pd.read_parquet(path) for path in paths], ignore_index=True)
+    pd.testing.assert_frame_equal(roundtrip, frame(10), check_dtype=False)
+
+
+def test_stage_and_copy_puts_every_file_then_copies_once():
+    cursor = RecordingCursor()
+
+    stage_and_copy(cursor, ["/tmp/part_00000.parquet", "/tmp/part_00001.parquet"], "cleaned_layer", "sales_data")
+
+    puts, copy = cursor.statements[:2], cursor.statements[2:]
+    assert [statement.split()[1] for statement in puts] == ["'file:///tmp/part_00000.parquet'",
+                                                             "'file:///tmp/part_00001.parquet'"]
+    stage = puts[0].split()[2]
+    assert stage.startswith("'@cleaned_layer.%sales_data/load_")
+    assert len(copy) == 1
+    assert copy[0].startswith(f"COPY INTO cleaned_layer.sales_data FROM {stage} FILE_FORMAT = (TYPE = PARQUET")
+    assert "MATCH_BY_COLUMN_NAME = CASE_INSENSITIVE" in copy[0]
+
+
+def test_bulk_load_creates_table_and_stages_files(tmp_path, monkeypatch):
+    cursor = RecordingCursor()
+    engine = sqlalchemy.create_engine("sqlite://")
+
+    monkeypatch.setattr("include.load.stage_and_copy",
+                        lambda _, paths, schema, table: stage_and_copy(cursor, paths, schema, table))
+
+    with engine.begin() as connection:
+        bulk_load(frame(10), connection, "main", "sales_data", max_rows_per_file=3)
+        columns = [column["name"] for column in sqlalchemy.inspect(connection).get_columns("sales_data")]
+
+    assert columns == ["sales_id", "Region", "Time_stamp", "total_sales"]
+    assert sum(statement.startswith("PUT") for statement in cursor.statements) == 4
+    assert cursor.statements[-1].startswith("COPY INTO main.sales_data")
+
+
+def test_insert_load_replaces_small_tables():
+    engine = sqlalchemy.create_engine("sqlite://")
+
+    with engine.begin() as connection:
+        insert_load(frame(4), connection, "main", "sales_data")
+        insert_load(frame(2), connection, "main", "sales_data")
+        loaded = pd.read_sql_table("sales_data", connection)
+
+    assert loaded["sales_id"].tolist() == [0, 1]
+
+
+@pytest.fixture
+def sqlite_engine(tmp_path):
+    return sqlalchemy.create_engine(f"sqlite:///{tmp_path / 'warehouse.db'}")
+
+
+@pytest.fixture
+def storage_config(tmp_path):
+    return {"backend": "local", "path": str(tmp_path / "storage"), "format": "parquet", "compression": "zstd"}
+
+
+def test_load_targets_loads_every_table_and_reports_rows(sqlite_engine, storage_config):
+    targets = [{"reference": write_frame(frame(rows), f"frame_{rows}", storage_config), "schema": "main",
+                "table": f"table_{rows}"} for rows in (2, 4, 6)]
+
+    reports = load_targets(targets, sqlite_engine, max_workers=3)
+
+    assert [(report["table"], report["rows"]) for report in reports] == [("table_2", 2), ("table_4", 4),
+                                                                         ("table_6", 6)]
+    with sqlite_engine.connect() as connection:
+        assert len(pd.read_sql_table("table_6", connection)) == 6
+
+
+def test_all_or_nothing_keeps_published_tables_when_a_target_fails(sqlite_engine, storage_config):
+    insert_load(frame(2), sqlite_engine, "main", "sales_data")
+    targets = [{"reference": write_frame(frame(4), "sales", storage_config), "schema": "main", "table": "sales_data"},
+               {"reference": write_frame(frame(0), "empty", storage_config), "schema": "main", "table": "empty"}]
+
+    with pytest.raises(ValueError, match="empty"):
+        load_targets(targets, sqlite_engine, all_or_nothing=True)
+    with sqlite_engine.connect() as connection:
+        assert len(pd.read_sql_table("sales_data", connection)) == 2
+
+    load_targets(targets[:1], sqlite_engine, all_or_nothing=True)
+    with sqlite_engine.connect() as connection:
+        assert len(pd.read_sql_table("sales_data", connection)) == 4
+        assert not sqlalchemy.inspect(connection).has_table("sales_data__staging")
+
+
+def test_snowflake_merge_statement_matches_on_business_keys():
+    from snowflake.sqlalchemy import snowdialect
+
+    statements = merge_statements(snowdialect.dialect(), "cleaned_layer", "sales_data", "sales_data__staging",
+                                  ["sales_id", "Region", "total_sales"], ["sales_id"])
+
+    assert statements == [
+        'MERGE INTO cleaned_layer.sales_data AS target USING cleaned_layer.sales_data__staging AS source '
+        'ON target.sales_id = source.sales_id '
+        'WHEN MATCHED THEN UPDATE SET target."Region" = source."Region", target.total_sales = source.total_sales '
+        'WHEN NOT MATCHED THEN INSERT (sales_id, "Region", total_sales) '
+        'VALUES (source.sales_id, source."Region", source.total_sales)',
+    ]
+
+
+def test_snowflake_publish_statements_are_dml_only():
+    """Snowflake commits every DDL statement on its own, the transaction publishing the targets has none."""
+    from snowflake.sqlalchemy import snowdialect
+
+    dialect = snowdialect.dialect()
+    statements = [*replace_statements(dialect, "presentation_layer", "sales_trends", "sales_trends__staging",
+                                      ["quarter", "total_sales"]),
+                  *merge_statements(dialect, "cleaned_layer", "sales_data", "sales_data__staging",
+                                    ["sales_id", "total_sales"], ["sales_id"])]
+
+    assert [statement.split()[0] for statement in statements] == ["DELETE", "INSERT", "MERGE"]
+    assert prepare_statements(dialect, "cleaned_layer", "sales_data", "sales_data__staging", ["sales_id"]) == [
+        "CREATE TABLE IF NOT EXISTS cleaned_layer.sales_data LIKE cleaned_layer.sales_data__staging"]
+
+
+def test_all_or_nothing_keeps_published_tables_when_publishing_fails(sqlite_engine, storage_config):
+    insert_load(frame(2), sqlite_engine, "main", "sales_data")
+    with sqlite_engine.begin() as connection:
+        # Same columns as the staging table, a constraint on the new rows fails the INSERT after sales_data was
+        # replaced.
+        connection.exec_driver_sql('CREATE TABLE merged_data (sales_id BIGINT CHECK (sales_id < 3), "Region" TEXT, '
+                                   '"Time_stamp" DATETIME, total_sales FLOAT)')
+        frame(2).to_sql("merged_data", connection, index=False, if_exists="append")
+    targets = [{"reference": write_frame(frame(4), "sales", storage_config), "schema": "main", "table": "sales_data"},
+               {"reference": write_frame(frame(4), "merged", storage_config), "schema": "main",
+                "table": "merged_data"}]
+
+    with pytest.raises(sqlalchemy.exc.IntegrityError, match="CHECK constraint"):
+        load_targets(targets, sqlite_engine, max_workers=1, all_or_nothing=True)
+    with sqlite_engine.connect() as connection:
+        assert len(pd.read_sql_table("sales_data", connection)) == 2
+        assert len(pd.read_sql_table("merged_data", connection)) == 2
+
+
+def test_upsert_updates_matched_rows_and_inserts_new_ones(sqlite_engine, storage_config):
+    target = {"schema": "main", "table": "sales_data", "load_mode": "upsert", "merge_keys": ["sales_id"]}
+    first_batch = frame(4)
+    second_batch = frame(4).assign(sales_id=[2, 3, 4, 5], total_sales=[9.0, 9.0, 9.0, 9.0])
+
+    load_targets([{**target, "reference": write_frame(first_batch, "first", storage_config)}], sqlite_engine)
+    reports = load_targets([{**target, "reference": write_frame(second_batch, "second", storage_config)}],
+                           sqlite_engine, all_or_nothing=True)
+
+    assert reports[0]["rows"] == 4
+    with sqlite_engine.connect() as connection:
+        loaded = pd.read_sql_query("SELECT sales_id, total_sales FROM sales_data ORDER BY sales_id", connection)
+        assert not sqlalchemy.inspect(connection).has_table("sales_data__staging")
+    assert loaded["sales_id"].tolist() == [0, 1, 2, 3, 4, 5]
+    assert loaded["total_sales"].tolist() == [1.5, 1.5, 9.0, 9.0, 9.0, 9.0]
+
+
+@pytest.mark.parametrize("all_or_nothing", [False, True])
+def test_upsert_of_an_empty_batch_leaves_the_target_unchanged(sqlite_engine, storage_config, all_or_nothing):
+    target = {"schema": "main", "table": "sales_data", "load_mode": "upsert", "merge_keys": ["sales_id"]}
+    load_targets([{**target, "reference": write_frame(frame(4), "first", storage_config)}], sqlite_engine)
+
+    reports = load_targets([{**target, "reference": write_frame(frame(0), "empty", storage_config)},
+                            {"reference": write_frame(frame(2), "products", storage_config), "schema": "main",
+                             "table": "products_data"}], sqlite_engine, all_or_nothing=all_or_nothing)
+
+    assert [(report["table"], report["rows"]) for report in reports] == [("sales_data", 0), ("products_data", 2)]
+    with sqlite_engine.connect() as connection:
+        assert len(pd.read_sql_table("sales_data", connection)) == 4
+        assert len(pd.read_sql_table("products_data", connection)) == 2
+        assert not sqlalchemy.inspect(connection).has_table("sales_data__staging")
+
+
+def test_all_or_nothing_swaps_replaced_targets_whose_columns_changed(sqlite_engine, storage_config):
+    status = pd.DataFrame({"week": [1, 2], "Pending": [1.0, 2.0], "Shipped": [3.0, 4.0]})
+    target = {"schema": "main", "table": "sales_status"}
+    load_targets([{**target, "reference": write_frame(status, "first", storage_config)}], sqlite_engine,
+                 all_or_nothing=True)
+
+    # A status without orders in the first run, and a week read back as text.
+    second = status.assign(Returned=[5.0, 6.0], week=["1", "2"])
+    load_targets([{**target, "reference": write_frame(second, "second", storage_config)},
+                  {"reference": write_frame(frame(2), "sales", storage_config), "schema": "main",
+                   "table": "sales_data"}], sqlite_engine, all_or_nothing=True)
+
+    with sqlite_engine.connect() as connection:
+        published = pd.read_sql_table("sales_status", connection)
+        inspector = sqlalchemy.inspect(connection)
+        assert [column["name"] for column in inspector.get_columns("sales_status")] == list(second.columns)
+        assert not inspector.has_table("sales_status__staging")
+        assert len(pd.read_sql_table("sales_data", connection)) == 2
+    pd.testing.assert_frame_equal(published, second)
+
+
+def test_snowflake_swap_statement_replaces_the_target_with_its_staging_table():
+    from snowflake.sqlalchemy import snowdialect
+
+    dialect = snowdialect.dialect()
+
+    assert swap_statements(dialect, "presentation_layer", "sales_status", "sales_status__staging") == [
+        "ALTER TABLE presentation_layer.sales_status SWAP WITH presentation_layer.sales_status__staging"]
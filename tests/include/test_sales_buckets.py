@@ -0,0 +1,92 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from include.sales_buckets import commit_sales_sketches, committed_bins, load_sketch, new_sketch, \
+    record_sales_sketch, sales_bucket_bins, sketch_from_json, sketch_merge, sketch_quantiles, sketch_to_json, \
+    sketch_update
+
+
+@pytest.fixture
+def buckets_config():
+    return {"mode": "quantile", "bins": [0, 100, 500, float("inf")], "quantiles": [0.5, 0.9], "sketch_size": 200,
+            "store_key": "state/sales_buckets"}
+
+
+@pytest.fixture
+def storage_config(tmp_path):
+    return {"backend": "local", "path": str(tmp_path)}
+
+
+def sales(seed, rows=50_000, scale=1.0):
+    return np.random.default_rng(seed).lognormal(4, 1, rows) * scale
+
+
+def commit_run(run_id, values, buckets_config, storage_config):
+    """Records the sketch of a batch and commits it, like a successful DAG run."""
+    pending_key = f"{run_id}/sales_sketch.json"
+    record_sales_sketch(pd.DataFrame({"total_sales": values}), buckets_config, storage_config, pending_key)
+    commit_sales_sketches([pending_key], buckets_config, storage_config)
+
+
+def test_merged_batch_sketches_approximate_the_quantiles(buckets_config):
+    batches = [sales(seed, scale=1 + seed / 10) for seed in range(8)]
+    sketch = new_sketch(200)
+    for batch in batches:
+        sketch = sketch_merge(sketch, sketch_from_json(sketch_to_json(sketch_update(new_sketch(200), batch))))
+
+    values = np.sort(np.concatenate(batches))
+    assert sketch["count"] == len(values)
+    assert sum(len(level) * 2 ** h for h, level in enumerate(sketch["levels"])) == len(values)
+    assert sum(len(level) for level in sketch["levels"]) < 1_000
+    quantiles = [0.1, 0.5, 0.9, 0.99]
+    ranks = np.searchsorted(values, sketch_quantiles(sketch, quantiles)) / len(values)
+    np.testing.assert_allclose(ranks, quantiles, atol=0.02)
+    assert sketch_quantiles(sketch, [0, 1]) == [values[0], values[-1]]
+
+
+def test_bins_are_frozen_per_period(buckets_config, storage_config):
+    # Before any history, the configured bins.
+    assert sales_bucket_bins(buckets_config, storage_config, "2024-01") == buckets_config["bins"]
+    commit_run("run_1", sales(1), buckets_config, storage_config)
+
+    february_bins = sales_bucket_bins(buckets_config, storage_config, "2024-02")
+    commit_run("run_2", sales(2, scale=10), buckets_config, storage_config)
+
+    assert february_bins[1] == pytest.approx(np.exp(4), rel=0.05)
+    assert sales_bucket_bins(buckets_config, storage_config, "2024-01") == buckets_config["bins"]
+    assert sales_bucket_bins(buckets_config, storage_config, "2024-02") == february_bins
+    assert sales_bucket_bins(buckets_config, storage_config, "2024-03")[1] > february_bins[1] * 2
+
+
+def test_retried_commits_count_a_run_once(buckets_config, storage_config):
+    commit_run("run_1", sales(1), buckets_config, storage_config)
+    commit_sales_sketches(["run_1/sales_sketch.json"], buckets_config, storage_config)
+
+    assert load_sketch(buckets_config, storage_config)["count"] == 50_000
+
+
+def test_quantiles_must_make_the_buckets(buckets_config, storage_config):
+    commit_run("run_1", sales(1), buckets_config, storage_config)
+    with pytest.raises(ValueError, match="quantiles don't make the 3 sales buckets"):
+        sales_bucket_bins({**buckets_config, "quantiles": [0.5]}, storage_config, "2024-01")
+
+
+def test_committed_bins_stay_frozen_until_refrozen(buckets_config, storage_config):
+    def run(run_id, values, refreeze=False):
+        bins = committed_bins(buckets_config, storage_config, refreeze=refreeze)
+        pending_key = f"{run_id}/sales_sketch.json"
+        record_sales_sketch(pd.DataFrame({"total_sales": values}), buckets_config, storage_config, pending_key, bins)
+        return bins, pending_key
+
+    first_bins, pending_key = run("run_1", sales(1))
+    commit_sales_sketches([pending_key], buckets_config, storage_config)
+    # The sketch of run_1 doesn't move the bins the partial aggregates were bucketed with.
+    assert run("run_2", sales(2, scale=10))[0] == first_bins == buckets_config["bins"]
+
+    refrozen_bins, pending_key = run("run_3", sales(3), refreeze=True)
+    assert refrozen_bins[1] == pytest.approx(np.exp(4), rel=0.05)
+    # A refreeze of a run that fails before its commit is forgotten.
+    assert committed_bins(buckets_config, storage_config) == first_bins
+    commit_sales_sketches([pending_key], buckets_config, storage_config)
+    assert committed_bins(buckets_config, storage_config) == refrozen_bins
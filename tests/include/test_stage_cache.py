@@ -0,0 +1,70 @@
+import os
+import time
+
+import pandas as pd
+import pytest
+
+from include.intermediate_storage import list_files, read_frame, write_frame
+from include.stage_cache import cached, evict
+
+
+@pytest.fixture
+def storage_config(tmp_path):
+    return {"backend": "local", "path": str(tmp_path)}
+
+
+@pytest.fixture
+def cache_config():
+    return {"enabled": True, "prefix": "cache", "max_bytes": 10_000_000, "max_age_hours": 24}
+
+
+def run_stage(inputs, cache_config, storage_config, calls, rows=3):
+    def compute(folder):
+        calls.append(folder)
+        return write_frame(pd.DataFrame({"total_sales": range(rows)}), f"{folder or 'run'}/out", storage_config)
+    return cached("transform", inputs, compute, cache_config, storage_config, settings={"memory_lean": True})
+
+
+def test_unchanged_inputs_are_a_hit(cache_config, storage_config):
+    calls = []
+    first = run_stage({"path": "sales", "rows": 10}, cache_config, storage_config, calls)
+    second = run_stage({"path": "sales", "rows": 10}, cache_config, storage_config, calls)
+    changed = run_stage({"path": "sales", "rows": 11}, cache_config, storage_config, calls)
+
+    assert len(calls) == 2 and second == first and changed != first
+    assert read_frame(second)["total_sales"].tolist() == [0, 1, 2]
+
+
+def test_failed_stages_are_not_cached(cache_config, storage_config):
+    def failing(folder):
+        write_frame(pd.DataFrame({"total_sales": [1.0]}), f"{folder}/out", storage_config)
+        raise RuntimeError("failed")
+
+    with pytest.raises(RuntimeError):
+        cached("transform", {"path": "sales"}, failing, cache_config, storage_config)
+    calls = []
+    run_stage({"path": "sales"}, cache_config, storage_config, calls)
+    assert len(calls) == 1
+
+
+def test_disabled_cache_writes_to_the_run(cache_config, storage_config):
+    calls = []
+    run_stage({"path": "sales"}, {**cache_config, "enabled": False}, storage_config, calls)
+    assert calls == [None] and list_files("cache", storage_config) == []
+
+
+def test_least_recently_used_and_old_entries_are_evicted(cache_config, storage_config, tmp_path):
+    calls = []
+    for day in range(3):
+        run_stage({"day": day}, cache_config, storage_config, calls, rows=20_000)
+    entries = sorted(os.listdir(tmp_path / "cache"), key=lambda key: calls.index(f"cache/{key}"))
+    entry_bytes = sum(file["bytes"] for file in list_files(f"cache/{entries[0]}", storage_config))
+    # The oldest entry is used again, the second one becomes the least recently used.
+    run_stage({"day": 0}, cache_config, storage_config, calls, rows=20_000)
+
+    assert evict({**cache_config, "max_bytes": entry_bytes * 2.5}, storage_config) == [entries[1]]
+    old = time.time() - 48 * 3600
+    os.utime(tmp_path / "cache" / entries[2] / "entry.json", (old, old))
+    os.utime(tmp_path / "cache" / entries[2] / "out.parquet", (old, old))
+    assert evict(cache_config, storage_config) == [entries[2]]
+    assert os.listdir(tmp_path / "cache") == [entries[0]]
@@ -0,0 +1,104 @@
+import warnings
+
+import pandas as pd
+import pytest
+
+from include import parallel_aggregation
+from include.transform import average_sales_and_units_by_sales_bucket, finalize_partial_aggregates, lookup_join, \
+    merge_partial_aggregates, merged_data_enriched, merging_sales_data_with_products_data, partial_aggregates, \
+    presentation_aggregates, products_data_transformation, products_lookup, quarterly_sales_by_category, \
+    sales_data_transformation, sales_revenue_by_region, sales_seasonality, weekly_order_counts_by_status
+
+
+def enrich(raw_sales_df, raw_products_df, memory_lean=False):
+    sales_df = sales_data_transformation(raw_sales_df.copy(), memory_lean=memory_lean)
+    products_df = products_data_transformation(raw_products_df.copy(), memory_lean=memory_lean)
+    merged_df = merging_sales_data_with_products_data(sales_df, products_df, memory_lean=memory_lean)
+    return merged_data_enriched(merged_df, memory_lean=memory_lean)
+
+
+@pytest.fixture
+def enriched_df(raw_sales_df, raw_products_df):
+    return enrich(raw_sales_df, raw_products_df)
+
+
+def test_fused_analytics_match_the_separate_functions(enriched_df):
+    fused = presentation_aggregates(enriched_df.copy())
+
+    separate = {
+        "sales_trends": quarterly_sales_by_category(enriched_df.copy()),
+        "sales_ranking": sales_revenue_by_region(enriched_df.copy()),
+        "sales_seasonality": sales_seasonality(enriched_df.copy()),
+        "sales_status": weekly_order_counts_by_status(enriched_df.copy()),
+        "average_sales_and_units_sales_bucket": average_sales_and_units_by_sales_bucket(enriched_df.copy()),
+    }
+    assert fused.keys() == separate.keys()
+    for name, expected in separate.items():
+        pd.testing.assert_frame_equal(fused[name], expected)
+
+
+def test_merged_partial_aggregates_match_a_full_recomputation(enriched_df):
+    first_batch, second_batch = enriched_df.iloc[:700], enriched_df.iloc[700:]
+
+    merged = merge_partial_aggregates(partial_aggregates(first_batch), partial_aggregates(second_batch))
+
+    incremental = finalize_partial_aggregates(merged)
+    full = presentation_aggregates(enriched_df)
+    for name, expected in full.items():
+        pd.testing.assert_frame_equal(incremental[name], expected, check_categorical=False)
+
+
+def test_memory_lean_transforms_keep_the_values_in_compact_dtypes(raw_sales_df, raw_products_df, enriched_df):
+    lean_df = enrich(raw_sales_df, raw_products_df, memory_lean=True)
+
+    assert isinstance(lean_df["Region"].dtype, pd.CategoricalDtype)
+    assert lean_df["sales_id"].dtype.itemsize < 8
+    assert lean_df.memory_usage(deep=True).sum() * 3 < enriched_df.memory_usage(deep=True).sum()
+    pd.testing.assert_frame_equal(lean_df, enriched_df, check_dtype=False, check_categorical=False)
+
+    lean_aggregates = presentation_aggregates(lean_df)
+    for name, expected in presentation_aggregates(enriched_df).items():
+        pd.testing.assert_frame_equal(lean_aggregates[name], expected, check_dtype=False, check_categorical=False,
+                                      check_column_type=False)
+
+
+@pytest.mark.parametrize("memory_lean", [False, True])
+def test_transforms_do_not_set_values_on_slices(raw_sales_df, raw_products_df, memory_lean):
+    with warnings.catch_warnings():
+        warnings.simplefilter("error", pd.errors.SettingWithCopyWarning)
+        enrich(raw_sales_df, raw_products_df, memory_lean=memory_lean)
+
+
+@pytest.mark.parametrize("duplicated_products", [False, True])
+def test_lookup_join_matches_a_merge_and_counts_orphans(raw_sales_df, raw_products_df, duplicated_products):
+    sales_df = sales_data_transformation(raw_sales_df.copy())
+    products_df = products_data_transformation(raw_products_df.copy())
+    if duplicated_products:
+        products_df = pd.concat([products_df, products_df.iloc[:3].assign(rating=0.5)], ignore_index=True)
+
+    joined_df, orphan_rows = lookup_join(sales_df, products_lookup(products_df))
+
+    expected = sales_df.merge(products_df, on="product_id", how="inner")
+    assert orphan_rows == (~sales_df["product_id"].isin(products_df["product_id"])).sum() > 0
+    pd.testing.assert_frame_equal(joined_df.sort_values(["sales_id", "rating"], ignore_index=True),
+                                  expected.sort_values(["sales_id", "rating"], ignore_index=True))
+
+
+@pytest.mark.parametrize("memory_lean", [False, True])
+def test_parallel_aggregates_are_identical_to_the_serial_ones(raw_sales_df, raw_products_df, memory_lean,
+                                                              monkeypatch):
+    monkeypatch.setattr(parallel_aggregation, "MIN_ROWS_PER_WORKER", 100)
+    df = enrich(raw_sales_df, raw_products_df, memory_lean=memory_lean)
+
+    serial_partials = partial_aggregates(df)
+    parallel_partials = partial_aggregates(df, workers=3)
+    for name, expected in serial_partials.items():
+        pd.testing.assert_frame_equal(parallel_partials[name], expected, check_exact=True)
+    parallel_aggregates = presentation_aggregates(df, workers=5)
+    for name, expected in presentation_aggregates(df).items():
+        pd.testing.assert_frame_equal(parallel_aggregates[name], expected, check_exact=True)
+
+
+def test_parallel_workers_are_not_forked_from_the_task_process():
+    # The threads of the task process, like the RSS sampler, may hold locks a forked worker would wait on.
+    assert parallel_aggregation._pool_context().get_start_method() in ("forkserver", "spawn")
@@ -0,0 +1,93 @@
+import pandas as pd
+import pyarrow as pa
+import pytest
+from pandera.errors import SchemaErrors
+
+from include.intermediate_storage import iter_batches, write_frame
+from include.transform import SALES_BUCKET_BINS
+from include.transform_backends import TRANSFORM_BACKENDS
+from include.validation.validation_policy import validation_policy
+
+
+def run_chain(backend, raw_sales_df, raw_products_df, memory_lean, sales_bins=SALES_BUCKET_BINS):
+    """Runs the transform chain of a backend on copies of the raw frames and returns every step as pandas."""
+    def to_backend(df):
+        return pa.Table.from_pandas(df, preserve_index=False) if backend is TRANSFORM_BACKENDS["arrow"] else df.copy()
+
+    def to_pandas(frame):
+        return frame.to_pandas() if isinstance(frame, pa.Table) else frame.reset_index(drop=True)
+
+    sales = backend["sales_data_transformation"](to_backend(raw_sales_df), memory_lean=memory_lean)
+    products = backend["products_data_transformation"](to_backend(raw_products_df), memory_lean=memory_lean)
+    merged = backend["merging_sales_data_with_products_data"](sales, products, memory_lean=memory_lean)
+    steps = {"sales": to_pandas(sales), "products": to_pandas(products), "merged": to_pandas(merged).copy()}
+    enriched = backend["merged_data_enriched"](merged, memory_lean=memory_lean, sales_bins=sales_bins)
+    steps["enriched"] = to_pandas(enriched)
+    steps["aggregates"] = backend["presentation_aggregates"](enriched)
+    return steps
+
+
+@pytest.mark.parametrize("memory_lean", [False, True])
+def test_arrow_backend_matches_the_pandas_reference(raw_sales_df, raw_products_df, memory_lean):
+    expected = run_chain(TRANSFORM_BACKENDS["pandas"], raw_sales_df, raw_products_df, memory_lean)
+    actual = run_chain(TRANSFORM_BACKENDS["arrow"], raw_sales_df, raw_products_df, memory_lean)
+
+    for step in ["sales", "products", "merged", "enriched"]:
+        # The memory-lean pandas path downcasts the integers, Arrow keeps them 64 bits wide.
+        pd.testing.assert_frame_equal(actual[step], expected[step], check_dtype=not memory_lean,
+                                      check_categorical=False)
+    for name, aggregate_df in expected["aggregates"].items():
+        pd.testing.assert_frame_equal(actual["aggregates"][name], aggregate_df, check_dtype=not memory_lean,
+                                      check_categorical=False, check_column_type=False)
+
+
+def test_arrow_buckets_match_the_pandas_reference_with_quantile_bins(raw_sales_df, raw_products_df):
+    sales_bins = [0, 37.5, 212.25, float("inf")]
+    expected = run_chain(TRANSFORM_BACKENDS["pandas"], raw_sales_df, raw_products_df, False, sales_bins)
+    actual = run_chain(TRANSFORM_BACKENDS["arrow"], raw_sales_df, raw_products_df, False, sales_bins)
+
+    pd.testing.assert_series_equal(actual["enriched"]["sales_bucket"], expected["enriched"]["sales_bucket"],
+                                   check_categorical=False)
+    assert expected["enriched"]["sales_bucket"].value_counts().min() > 50
+
+
+def test_arrow_presentation_aggregates_scan_stored_batches(raw_sales_df, raw_products_df, tmp_path):
+    arrow = TRANSFORM_BACKENDS["arrow"]
+    enriched = arrow["merged_data_enriched"](arrow["merging_sales_data_with_products_data"](
+        arrow["sales_data_transformation"](pa.Table.from_pandas(raw_sales_df, preserve_index=False)),
+        arrow["products_data_transformation"](pa.Table.from_pandas(raw_products_df, preserve_index=False))))
+    reference = write_frame(enriched, "run/enriched", {"backend": "local", "path": str(tmp_path)})
+
+    scanned = arrow["presentation_aggregates"](iter_batches(reference, batch_rows=100))
+
+    for name, aggregate_df in arrow["presentation_aggregates"](enriched).items():
+        pd.testing.assert_frame_equal(scanned[name], aggregate_df, check_categorical=False)
+
+
+def test_arrow_backend_coerces_malformed_timestamps_like_pandas(raw_sales_df, raw_products_df, monkeypatch):
+    raw_sales_df.loc[[3, 700], "Time stamp"] = ["not a date", "2024-13-45 25:00:00"]
+    for backend in TRANSFORM_BACKENDS.values():
+        with pytest.raises(SchemaErrors, match="non-nullable series 'Time_stamp'"):
+            run_chain(backend, raw_sales_df, raw_products_df, False)
+
+    monkeypatch.setitem(validation_policy, "default_mode", "dtype")
+    expected = TRANSFORM_BACKENDS["pandas"]["sales_data_transformation"](raw_sales_df.copy())
+    actual = TRANSFORM_BACKENDS["arrow"]["sales_data_transformation"](
+        pa.Table.from_pandas(raw_sales_df, preserve_index=False))
+
+    assert expected["Time_stamp"].isna().sum() == 2
+    pd.testing.assert_frame_equal(actual.to_pandas(), expected.reset_index(drop=True))
+
+
+def test_arrow_presentation_aggregates_of_no_batch_match_the_pandas_reference(raw_sales_df, raw_products_df):
+    enriched = run_chain(TRANSFORM_BACKENDS["pandas"], raw_sales_df, raw_products_df, False)["enriched"]
+
+    expected = TRANSFORM_BACKENDS["pandas"]["presentation_aggregates"](enriched.iloc[:0])
+    actual = TRANSFORM_BACKENDS["arrow"]["presentation_aggregates"]([])
+
+    for name, aggregate_df in expected.items():
+        assert aggregate_df.empty
+        pd.testing.assert_frame_equal(actual[name], aggregate_df, check_categorical=False, check_index_type=False,
+                                      check_column_type=False)
+    assert actual["sales_seasonality"]["monthly_total_quantity"].dtype == "int64"
+    assert list(actual["sales_status"].columns) == ["week", "Pending", "Shipped", "Returned"]
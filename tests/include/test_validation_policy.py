@@ -0,0 +1,69 @@
+import pandas as pd
+import pandera.pandas as pa
+import pytest
+from pandera.errors import SchemaErrors
+from pandera.pandas import Check, Column
+
+from include.validation.validation_policy import on_unique_values, validate, validation_policy, validation_timings
+
+schema = pa.DataFrameSchema({
+    "qty": Column(int, Check.greater_than(0)),
+    "category": Column(str, Check(on_unique_values(lambda c: c.str.islower()), name="islower")),
+}, name="test_sales")
+
+
+@pytest.fixture
+def sales_df():
+    return pd.DataFrame({"qty": range(1, 1001), "category": ["toys", "books"] * 500})
+
+
+@pytest.fixture
+def policy(monkeypatch):
+    def set_policy(**policy):
+        for key, value in policy.items():
+            monkeypatch.setitem(validation_policy, key, value)
+    return set_policy
+
+
+def test_full_mode_collects_the_failures_of_every_chunk(sales_df, policy):
+    policy(default_mode="full", chunk_rows=300)
+    sales_df.loc[[10, 950], "qty"] = -1
+    sales_df.loc[500, "category"] = "Toys"
+
+    with pytest.raises(SchemaErrors) as error:
+        validate(schema, sales_df)
+
+    failure_cases = error.value.failure_cases
+    assert sorted(failure_cases["index"].tolist()) == [10, 500, 950]
+    assert validation_timings["test_sales"]["mode"] == "full"
+
+
+def test_head_mode_checks_only_the_first_rows(sales_df, policy):
+    policy(default_mode="head", sample_rows=100)
+    sales_df.loc[950, "qty"] = -1
+
+    assert validate(schema, sales_df) is sales_df
+
+
+def test_dtype_mode_checks_the_structure_only(sales_df, policy):
+    policy(default_mode="full", schemas={"test_sales": "dtype"})
+    sales_df.loc[950, "qty"] = -1
+    validate(schema, sales_df)
+
+    sales_df["category"] = 1
+    with pytest.raises(SchemaErrors):
+        validate(schema, sales_df)
+
+
+def test_off_mode_skips_the_validation(sales_df, policy):
+    policy(schemas={"test_sales": "off"})
+
+    assert validate(schema, sales_df.drop(columns=["qty"])) is not None
+
+
+def test_checks_on_unique_values_handle_categoricals_and_missing_values():
+    column = pd.Series(["toys", None, "Books", "toys"])
+    is_lower = on_unique_values(lambda c: c.str.islower())
+
+    assert is_lower(column).tolist() == [True, True, False, True]
+    assert is_lower(column.astype("category")).tolist() == [True, True, False, True]